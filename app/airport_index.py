@@ -0,0 +1,193 @@
+"""
+Search index over the airports the fare models know.
+
+The index is built once per process from ``names_data.json`` (the airports
+the models were trained on and their display names), with the alternative
+names in ``airport_names.csv`` added as search aliases. It provides:
+
+- display labels ("Name (IATA)") for the selectors, computed once;
+- ``search``: prefix and fuzzy search by IATA code, city or airport name;
+- ``codes`` / ``ids``: normalization of codes or labels to IATA codes and to
+  the integer airport IDs of the route table used by the predictors;
+- ``destinations``: the airports reachable from an origin on a route the
+  models have real distance and duration data for (routes the route table
+  had to estimate are left out).
+"""
+import difflib
+import functools
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from model_registry import MODELS_DIR
+from route_table import RouteTable, get_route_table
+
+NAMES_FILE = 'names_data.json'
+ALIASES_FILE = 'airport_names.csv'
+
+# Fuzzy matches scoring below this ratio are dropped
+FUZZY_CUTOFF = 0.75
+
+_WORD = re.compile(r"[a-z0-9]+")
+
+
+def _words(text: str) -> list:
+    return _WORD.findall(text.lower())
+
+
+class AirportIndex:
+    """
+    Airports keyed by IATA code, with labels, search and route coverage.
+
+    Parameters
+    ----------
+    names : dict
+        IATA code mapped to display name, in display order.
+    route_table : RouteTable
+        Table whose airport IDs and route coverage the index uses.
+    aliases : dict
+        Optional IATA code mapped to a list of alternative names, searched
+        but not displayed.
+    """
+
+    def __init__(self, names: dict, route_table: RouteTable, aliases: dict = None):
+        self.names = dict(names)
+        self.airports = list(self.names)
+        self.labels = {code: f"{name} ({code})" for code, name in self.names.items()}
+        self.route_table = route_table
+        aliases = aliases or {}
+
+        # Codes and labels both normalize to the code
+        self._normalize = {code: code for code in self.airports}
+        self._normalize.update({label: code for code, label in self.labels.items()})
+
+        # Every searchable word of an airport: its name, city and aliases
+        self._words = {
+            code: sorted(set(_words(name)).union(*(_words(alias) for alias in aliases.get(code, []))))
+            for code, name in self.names.items()
+        }
+        self._text = {
+            code: ' '.join([name.lower(), *(alias.lower() for alias in aliases.get(code, []))])
+            for code, name in self.names.items()
+        }
+
+        # Routes with real data, by airport ID
+        missing = set(self.airports) - set(route_table.ids)
+        if missing:
+            raise KeyError(f"Airports missing from the route table: {', '.join(sorted(missing))}")
+        self._covered = ~np.asarray(route_table.estimated, dtype=bool)
+
+    @classmethod
+    def from_files(cls, models_dir: str = MODELS_DIR, route_table: RouteTable = None) -> 'AirportIndex':
+        """Build the index from ``names_data.json`` and ``airport_names.csv``."""
+        with open(os.path.join(models_dir, NAMES_FILE)) as f:
+            names = json.load(f)
+        aliases = {}
+        aliases_path = os.path.join(models_dir, ALIASES_FILE)
+        if os.path.isfile(aliases_path):
+            extra = pd.read_csv(aliases_path, header=None, names=['name', 'code'])
+            for name, code in extra.itertuples(index=False, name=None):
+                if code in names:
+                    aliases.setdefault(code, []).append(name)
+        return cls(names, route_table if route_table is not None else get_route_table(), aliases)
+
+    def __len__(self) -> int:
+        return len(self.airports)
+
+    def __contains__(self, code) -> bool:
+        return code in self.names
+
+    def label(self, code: str) -> str:
+        """Display label "Name (IATA)" of ``code``."""
+        return self.labels.get(code, code)
+
+    def code(self, value: str) -> str:
+        """
+        IATA code of ``value``, given either as a code or as a "Name (IATA)"
+        label. Unknown values are returned unchanged.
+        """
+        code = self._normalize.get(value)
+        if code is None and isinstance(value, str) and value.endswith(')') and '(' in value:
+            code = value[value.rindex('(') + 1:-1]
+        return code if code is not None else value
+
+    def codes(self, values) -> list:
+        """IATA codes of a batch of codes or labels (see `code`)."""
+        normalize = self._normalize
+        return [normalize.get(value) or self.code(value) for value in values]
+
+    def ids(self, values) -> np.ndarray:
+        """
+        Route table airport IDs of a batch of codes or labels.
+
+        Raises
+        ------
+        KeyError
+            If an airport is not covered by the route table.
+        """
+        return self.route_table.airport_ids(self.codes(values))
+
+    def destinations(self, origin: str) -> list:
+        """
+        Codes of the airports the models cover a route to from ``origin``,
+        in display order (``origin`` itself excluded).
+        """
+        origin_id = self.route_table.ids[self.code(origin)]
+        covered = self._covered[origin_id]
+        return [code for code in self.airports
+                if code != self.code(origin) and covered[self.route_table.ids[code]]]
+
+    def search(self, query: str, limit: int = 10, codes=None) -> list:
+        """
+        Codes of the airports matching ``query``, best match first.
+
+        Matches are ranked as: exact IATA code, IATA code prefix, prefix of a
+        word of the name, city or an alias, substring of those, and finally
+        fuzzy matches of the query against those words (for typos).
+
+        Parameters
+        ----------
+        query : str
+            Text typed by the user; an empty query matches every airport.
+        limit : int
+            Maximum number of codes returned; None for no limit.
+        codes : list of str
+            Optional subset of airports to search (e.g. `destinations`).
+        """
+        codes = self.airports if codes is None else [self.code(code) for code in codes]
+        query = query.strip().lower()
+        if not query:
+            return codes[:limit]
+
+        ranked = []
+        query_words = _words(query)
+        for position, code in enumerate(codes):
+            words = self._words[code]
+            if code.lower() == query:
+                rank = (0, 0.0)
+            elif code.lower().startswith(query):
+                rank = (1, 0.0)
+            elif query_words and all(any(word.startswith(q) for word in words) for q in query_words):
+                rank = (2, 0.0)
+            elif query in self._text[code]:
+                rank = (3, 0.0)
+            else:
+                # Best similarity of each query word to any word of the airport
+                scores = [max((difflib.SequenceMatcher(None, q, word).ratio() for word in words), default=0.0)
+                          for q in query_words]
+                score = min(scores, default=0.0)
+                if score < FUZZY_CUTOFF:
+                    continue
+                rank = (4, -score)
+            ranked.append((rank, position, code))
+        ranked.sort()
+        return [code for _, _, code in ranked[:limit]]
+
+
+@functools.lru_cache(maxsize=None)
+def get_airport_index() -> AirportIndex:
+    """Return the process-wide airport index, built on first use."""
+    return AirportIndex.from_files()
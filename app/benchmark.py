@@ -0,0 +1,260 @@
+"""
+Offline latency and throughput benchmark for the three prediction paths.
+
+Each predictor is broken down into stages, timed separately at every batch
+size:
+
+- 'model_load': deserializing the artifact (reloaded from disk every run);
+- 'features': building the model input frame from columnar request data;
+- 'cyclical': the sin/cos encodings used by the predictor
+  (`cyclical_transform`, `encode_cyclical_features` or `encode_cyclical`);
+- 'encode': building the model input the app scores from the input frame
+  (`pipeline_fast_path.model_inputs`, i.e. the NumPy replica of the
+  pipeline's preprocessing, or the exported trees' encoding with
+  AIRFARE_TREE_RUNTIME=numpy);
+- 'predict': the model call the app makes on a ready-made input (the booster
+  or the exported trees, or the network for multi-city);
+- 'pipeline': the fitted scikit-learn pipeline on the input frame, which the
+  app only falls back to (one-way and return);
+- 'request': the public batched predictor, end to end.
+
+The prediction cache and the fare cube are disabled (unless
+AIRFARE_CACHE_SIZE or AIRFARE_FARE_CUBE is set) so the numbers describe the
+models rather than cache hits. Results are written as JSON with p50/p95/p99
+latency and rows per second, and can be compared with a previous run. From the repository root:
+
+    python app/benchmark.py --output bench.json
+    python app/benchmark.py --output new.json --compare bench.json
+"""
+import os
+
+# Measure the models, not the cache or the fare cube
+os.environ.setdefault('AIRFARE_CACHE_SIZE', '0')
+os.environ.setdefault('AIRFARE_FARE_CUBE', '0')
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import time
+
+import numpy as np
+import pandas as pd
+
+from model_registry import registry
+from models.encoding import encode_cyclical
+from models.sets import cyclical_transform
+from pipeline_fast_path import model_inputs
+import predict_nohops
+import predict_nohops_return
+import predict_withhops
+from route_table import get_route_table
+
+BATCH_SIZES = (1, 10, 100, 1_000, 10_000, 100_000)
+CABINS = ('coach', 'premium coach', 'business', 'first')
+
+
+###############################################################################
+#
+#   INPUTS
+#
+###############################################################################
+
+def make_requests(n: int, seed: int = 0) -> dict:
+    """Random but reproducible columnar request data for ``n`` itineraries."""
+    rng = np.random.default_rng(seed)
+    codes = np.array(get_route_table().codes)
+    origin = rng.integers(0, len(codes), n)
+    dest = (origin + rng.integers(1, len(codes), n)) % len(codes)
+    today = datetime.date(2024, 1, 1)
+    days = rng.integers(0, 365, n)
+    hours, minutes = rng.integers(0, 24, n), rng.integers(0, 60, n)
+    n_hops = rng.integers(2, 5, n)
+    return {
+        'dates': (pd.Timestamp(today) + pd.to_timedelta(days, unit='D')).strftime('%Y-%m-%d'),
+        'times': [f'{h:02d}:{m:02d}' for h, m in zip(hours, minutes)],
+        'origins': codes[origin],
+        'dests': codes[dest],
+        'cabins': np.array(CABINS)[rng.integers(0, len(CABINS), n)],
+        'search_dates': [today] * n,
+        'depart_dates': [today + datetime.timedelta(days=int(d)) for d in days],
+        'depart_times': [datetime.time(int(h), int(m)) for h, m in zip(hours, minutes)],
+        'is_basic_econ': rng.random(n) < 0.2,
+        'n_hops': n_hops,
+        'cabin_lists': [list(np.array(CABINS)[rng.integers(0, len(CABINS), k)]) for k in n_hops],
+    }
+
+
+###############################################################################
+#
+#   STAGES
+#
+###############################################################################
+
+def one_way_stages(r: dict) -> dict:
+    model = registry.get(predict_nohops.MODEL_NAME)
+    live_model = registry.get(predict_nohops.LIVE_MODEL_NAME)
+    args = (r['dates'], r['times'], r['origins'], r['dests'], r['cabins'])
+    frame = predict_nohops.build_nohops_input_frame(*args)
+    features, predict = model_inputs(live_model, frame)
+    return {
+        'features': lambda: predict_nohops.build_nohops_input_frame(*args),
+        'cyclical': lambda: cyclical_transform(frame),
+        'encode': lambda: model_inputs(live_model, frame),
+        'predict': lambda: predict(features),
+        'pipeline': lambda: model.predict(frame),
+        'request': lambda: predict_nohops.predict_nohops_flight_fare_batch(*args),
+    }
+
+
+def return_stages(r: dict) -> dict:
+    model = registry.get(predict_nohops_return.MODEL_NAME)
+    live_model = registry.get(predict_nohops_return.LIVE_MODEL_NAME)
+    args = (r['dates'], r['times'], r['origins'], r['dests'], r['cabins'])
+    frame = predict_nohops_return.build_nohops_return_input_frame(*args)
+    features, predict = model_inputs(live_model, frame)
+    return {
+        'features': lambda: predict_nohops_return.build_nohops_return_input_frame(*args),
+        'cyclical': lambda: predict_nohops_return.encode_cyclical_features(frame),
+        'encode': lambda: model_inputs(live_model, frame),
+        'predict': lambda: predict(features),
+        'pipeline': lambda: model.predict(frame),
+        'request': lambda: predict_nohops_return.predict_nohops_return_flight_fare_batch(*args),
+    }
+
+
+def multi_city_stages(r: dict) -> dict:
+    model = registry.get(predict_withhops.NETWORK_NAME)
+    args = (r['origins'], r['dests'], r['search_dates'], r['depart_dates'],
+            r['depart_times'], r['is_basic_econ'], r['n_hops'], r['cabin_lists'])
+    features = predict_withhops.build_neural_network_input(*args)
+    depart_dates = pd.DatetimeIndex(r['depart_dates'])
+    periodic = [
+        depart_dates.weekday.to_numpy(),
+        depart_dates.month.to_numpy(),
+        np.array([t.hour for t in r['depart_times']]),
+        np.array([t.minute for t in r['depart_times']]),
+    ]
+
+    return {
+        'features': lambda: predict_withhops.build_neural_network_input(*args),
+        'cyclical': lambda: encode_cyclical(periodic, ['dayofweek', 'month', 'hour', 'minute']),
+        'predict': lambda: model.predict(features, verbose=0),
+        'request': lambda: predict_withhops.predict_neural_network_batch(*args),
+    }
+
+
+PREDICTORS = {
+    'one_way': (predict_nohops.MODEL_NAME, one_way_stages),
+    'return': (predict_nohops_return.MODEL_NAME, return_stages),
+    'multi_city': (predict_withhops.NETWORK_NAME, multi_city_stages),
+}
+
+
+###############################################################################
+#
+#   TIMING
+#
+###############################################################################
+
+def measure(func, batch_size: int, min_runs: int, min_seconds: float) -> dict:
+    """
+    Call ``func`` at least ``min_runs`` times and for at least ``min_seconds``
+    (after one warm-up call) and summarize the per-call latencies.
+    """
+    func()
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < min_runs or time.perf_counter() - start < min_seconds:
+        t0 = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - t0)
+    latencies = np.array(latencies)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        'batch_size': batch_size,
+        'runs': len(latencies),
+        'p50_ms': p50 * 1e3,
+        'p95_ms': p95 * 1e3,
+        'p99_ms': p99 * 1e3,
+        'rows_per_second': batch_size / latencies.mean(),
+    }
+
+
+def run(predictors, batch_sizes, min_runs: int, min_seconds: float, load_runs: int) -> list:
+    results = []
+    for predictor in predictors:
+        model_name, stages = PREDICTORS[predictor]
+        if not os.path.isfile(registry.path(model_name)):
+            print(f"Skipping {predictor}: {model_name} not found")
+            continue
+        row = measure(lambda: registry.reload(model_name), 1, load_runs, 0)
+        results.append({'predictor': predictor, 'stage': 'model_load', **row})
+        for batch_size in batch_sizes:
+            for stage, func in stages(make_requests(batch_size)).items():
+                # Big batches are slow enough that a few runs are representative
+                runs = max(3, min_runs // max(1, batch_size // 1_000))
+                row = measure(func, batch_size, runs, min_seconds if batch_size < 10_000 else 0)
+                results.append({'predictor': predictor, 'stage': stage, **row})
+                print(f"{predictor:>10}  {stage:>10}  {batch_size:>7}  "
+                      f"p50 {row['p50_ms']:9.3f}ms  p99 {row['p99_ms']:9.3f}ms  {row['rows_per_second']:12.0f} rows/s")
+    return results
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(results: list, baseline_path: str):
+    """Print the p50 ratio to a previous run for every matching measurement."""
+    with open(baseline_path) as f:
+        baseline = {(r['predictor'], r['stage'], r['batch_size']): r for r in json.load(f)['results']}
+    print(f"\np50 vs {baseline_path} (>1 is slower):")
+    for r in results:
+        old = baseline.get((r['predictor'], r['stage'], r['batch_size']))
+        if old and old['p50_ms'] > 0:
+            print(f"{r['predictor']:>10}  {r['stage']:>10}  {r['batch_size']:>7}  {r['p50_ms'] / old['p50_ms']:6.2f}x")
+
+
+###############################################################################
+#
+#   ENTRY POINT
+#
+###############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fare predictors")
+    parser.add_argument('--predictors', nargs='+', choices=list(PREDICTORS), default=list(PREDICTORS))
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=list(BATCH_SIZES))
+    parser.add_argument('--min-runs', type=int, default=50, help="Minimum timed calls per measurement")
+    parser.add_argument('--min-seconds', type=float, default=0.5, help="Minimum time spent per measurement")
+    parser.add_argument('--load-runs', type=int, default=5, help="Timed reloads per model")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help="Previous results file to compare against")
+    args = parser.parse_args()
+
+    results = run(args.predictors, args.batch_sizes, args.min_runs, args.min_seconds, args.load_runs)
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'results': results}, f, indent=2)
+    print(f"Wrote {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
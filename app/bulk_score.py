@@ -0,0 +1,334 @@
+"""
+Bulk fare scoring of CSV or Parquet files.
+
+Streams the input in chunks, sends every row to the predictor of its trip
+type and writes the fares to a Parquet file as each chunk is scored, so
+memory stays bounded by the chunk size whatever the size of the file.
+
+Input columns (one row per itinerary, airports as IATA codes):
+
+- ``trip``: 'one_way', 'return' or 'multi_city'. When the column is missing
+  or empty, rows with a ``return_date`` are return trips, rows with
+  ``cabins`` are multi-city trips and the others are one-way (or every row
+  is of the ``--trip`` type when given);
+- ``origin``, ``destination``, ``depart_date`` (YYYY-MM-DD) and
+  ``depart_time`` (HH:MM, default 10:00): every trip;
+- ``depart_cabin`` (default coach): one-way and return trips;
+- ``return_date``, ``return_time`` and ``return_cabin``: return trips;
+- ``cabins`` (cabins of each trip separated by ``|``), ``basic_economy``
+  (default false) and ``search_date`` (default today): multi-city trips.
+
+The output keeps every input column and adds ``trip``, ``fare`` (total fare),
+``depart_fare`` and ``return_fare`` (return trips only) and ``error`` (why a
+row could not be scored, its fares are then null).
+
+With ``--workers N`` chunks are scored by N processes, each loading its own
+models, while this process reads the input and writes the results in input
+order; at most two chunks per worker are in flight.
+
+From the repository root:
+
+    python app/bulk_score.py itineraries.csv fares.parquet [--chunk-size 100000] [--workers 4]
+"""
+import os
+
+# Rows of a bulk file are mostly distinct: caching them would only hold memory
+os.environ.setdefault('AIRFARE_CACHE_SIZE', '0')
+
+import argparse
+import collections
+import datetime
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from airport_index import get_airport_index
+from predict_nohops import predict_nohops_flight_fare_batch
+from predict_nohops_return import predict_nohops_return_flight_fare_batch
+from predict_withhops import predict_neural_network_batch
+
+TRIPS = ('one_way', 'return', 'multi_city')
+CABINS = ('coach', 'premium coach', 'business', 'first')
+CHUNK_SIZE = 100_000
+
+RESULT_SCHEMA = pa.schema([
+    ('trip', pa.string()),
+    ('fare', pa.float64()),
+    ('depart_fare', pa.float64()),
+    ('return_fare', pa.float64()),
+    ('error', pa.string()),
+])
+
+
+###############################################################################
+#
+#   READING AND WRITING
+#
+###############################################################################
+
+def read_chunks(path: str, chunk_size: int = CHUNK_SIZE):
+    """
+    Return the Arrow schema of the input file and an iterator over its rows
+    as DataFrames of at most ``chunk_size`` rows. CSV columns are read as
+    strings, Parquet columns keep their types.
+    """
+    if path.endswith('.parquet'):
+        parquet_file = pq.ParquetFile(path)
+        chunks = (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=chunk_size))
+        return parquet_file.schema_arrow, chunks
+    columns = pd.read_csv(path, nrows=0).columns
+    schema = pa.schema([(name, pa.string()) for name in columns])
+    return schema, iter(pd.read_csv(path, dtype=str, chunksize=chunk_size))
+
+
+class ParquetChunkWriter:
+    """
+    Appends DataFrames with a fixed schema to a Parquet file, one row group
+    per chunk (the index is not written, as in `models.sets.save_sets`).
+    """
+
+    def __init__(self, path: str, schema: pa.Schema):
+        self.schema = schema
+        self._writer = pq.ParquetWriter(path, schema)
+
+    def write(self, df: pd.DataFrame):
+        self._writer.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False))
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def output_schema(input_schema: pa.Schema) -> pa.Schema:
+    """Input columns followed by the result columns (which replace inputs of the same name)."""
+    result_names = set(RESULT_SCHEMA.names)
+    return pa.schema([field for field in input_schema if field.name not in result_names] + list(RESULT_SCHEMA))
+
+
+###############################################################################
+#
+#   SCORING
+#
+###############################################################################
+
+def _column(chunk: pd.DataFrame, name: str, default=None) -> pd.Series:
+    if name in chunk:
+        column = chunk[name]
+        return column.where(column.notna(), default) if default is not None else column
+    return pd.Series(default, index=chunk.index, dtype=object)
+
+
+def _dates(values: pd.Series) -> pd.Series:
+    return pd.to_datetime(values, format='%Y-%m-%d', errors='coerce')
+
+
+def _times(values: pd.Series) -> pd.Series:
+    return pd.to_datetime(values, format='%H:%M', errors='coerce')
+
+
+def _empty(values: pd.Series) -> pd.Series:
+    return values.isna() | (values.astype(str).str.strip() == '')
+
+
+def trip_types(chunk: pd.DataFrame, default: str = None) -> pd.Series:
+    """Trip type of every row: its ``trip`` column, else ``default``, else inferred from its columns."""
+    if default is not None:
+        inferred = pd.Series(default, index=chunk.index, dtype=object)
+    else:
+        inferred = pd.Series('one_way', index=chunk.index, dtype=object)
+        inferred[~_empty(_column(chunk, 'cabins'))] = 'multi_city'
+        inferred[~_empty(_column(chunk, 'return_date'))] = 'return'
+    trip = _column(chunk, 'trip')
+    return trip.where(~_empty(trip), inferred).astype(str).str.strip().str.lower()
+
+
+def score_chunk(chunk: pd.DataFrame, default_trip: str = None, today: datetime.date = None) -> pd.DataFrame:
+    """
+    Score every row of ``chunk`` with the predictor of its trip type, one
+    batched call per trip type.
+
+    Rows that cannot be scored (unknown trip type or airport, unparseable
+    dates or times, unknown cabins) get null fares and an ``error``; the
+    other rows of the chunk are still scored.
+    """
+    today = today or datetime.date.today()
+    airport_index = get_airport_index()
+    n = len(chunk)
+    trip = trip_types(chunk, default_trip)
+    fare = np.full(n, np.nan)
+    depart_fare = np.full(n, np.nan)
+    return_fare = np.full(n, np.nan)
+    error = np.full(n, None, dtype=object)
+
+    def reject(mask, message):
+        # Keep the first error of every row
+        error[np.asarray(mask, dtype=bool) & pd.isna(error)] = message
+
+    def valid(mask):
+        return np.nonzero(np.asarray(mask, dtype=bool) & pd.isna(error))[0]
+
+    def score(rows, predict):
+        # A missing model artifact rejects its rows rather than the whole file
+        try:
+            return predict()
+        except FileNotFoundError as e:
+            error[rows] = str(e)
+            return None
+
+    origin = _column(chunk, 'origin').astype(object)
+    destination = _column(chunk, 'destination').astype(object)
+    depart_date = _dates(_column(chunk, 'depart_date'))
+    depart_time = _times(_column(chunk, 'depart_time', '10:00'))
+    depart_cabin = _column(chunk, 'depart_cabin', 'coach').astype(str).str.lower()
+
+    reject(~trip.isin(TRIPS), "unknown trip type")
+    reject(~origin.isin(airport_index.airports), "unknown origin")
+    reject(~destination.isin(airport_index.airports), "unknown destination")
+    reject(origin == destination, "origin and destination are the same")
+    reject(depart_date.isna(), "invalid depart_date")
+    reject(depart_time.isna(), "invalid depart_time")
+
+    # One-way
+    is_one_way = (trip == 'one_way').to_numpy()
+    reject(is_one_way & ~depart_cabin.isin(CABINS).to_numpy(), "unknown depart_cabin")
+    rows = valid(is_one_way)
+    fares = score(rows, lambda: predict_nohops_flight_fare_batch(
+        depart_date.iloc[rows].dt.strftime('%Y-%m-%d').to_numpy(),
+        depart_time.iloc[rows].dt.strftime('%H:%M').to_numpy(),
+        origin.iloc[rows].to_numpy(), destination.iloc[rows].to_numpy(),
+        depart_cabin.iloc[rows].to_numpy())) if len(rows) else None
+    if fares is not None:
+        fare[rows] = fares
+
+    # Return: both legs of every trip in one model call
+    return_date = _dates(_column(chunk, 'return_date'))
+    return_time = _times(_column(chunk, 'return_time', '10:00'))
+    return_cabin = _column(chunk, 'return_cabin', 'coach').astype(str).str.lower()
+    is_return = (trip == 'return').to_numpy()
+    reject(is_return & return_date.isna().to_numpy(), "invalid return_date")
+    reject(is_return & return_time.isna().to_numpy(), "invalid return_time")
+    reject(is_return & (return_date < depart_date).to_numpy(), "return_date is before depart_date")
+    reject(is_return & ~depart_cabin.isin(CABINS).to_numpy(), "unknown depart_cabin")
+    reject(is_return & ~return_cabin.isin(CABINS).to_numpy(), "unknown return_cabin")
+    rows = valid(is_return)
+    legs = score(rows, lambda: predict_nohops_return_flight_fare_batch(
+        np.concatenate([depart_date.iloc[rows].dt.strftime('%Y-%m-%d'), return_date.iloc[rows].dt.strftime('%Y-%m-%d')]),
+        np.concatenate([depart_time.iloc[rows].dt.strftime('%H:%M'), return_time.iloc[rows].dt.strftime('%H:%M')]),
+        np.concatenate([origin.iloc[rows], destination.iloc[rows]]),
+        np.concatenate([destination.iloc[rows], origin.iloc[rows]]),
+        np.concatenate([depart_cabin.iloc[rows], return_cabin.iloc[rows]]))) if len(rows) else None
+    if legs is not None:
+        depart_fare[rows], return_fare[rows] = legs[:len(rows)], legs[len(rows):]
+        fare[rows] = depart_fare[rows] + return_fare[rows]
+
+    # Multi-city: the per-row parsing of cabins only runs on multi-city rows
+    is_multi_city = (trip == 'multi_city').to_numpy()
+    cabins = pd.Series([[]] * n, index=chunk.index, dtype=object)
+    multi_city = np.nonzero(is_multi_city)[0]
+    cabins.iloc[multi_city] = [
+        [cabin.strip() for cabin in trip_cabins.lower().split('|') if cabin.strip()]
+        for trip_cabins in _column(chunk, 'cabins', '').iloc[multi_city].astype(str)]
+    search_date = _dates(_column(chunk, 'search_date', today.isoformat()))
+    basic_economy = _column(chunk, 'basic_economy', False).astype(str).str.strip().str.lower().isin(('true', '1', 'yes'))
+    n_hops = cabins.map(len).to_numpy()
+    reject(is_multi_city & (n_hops == 0), "no cabins")
+    reject(is_multi_city & ~cabins.map(set(CABINS).issuperset).to_numpy(), "unknown cabins")
+    reject(is_multi_city & search_date.isna().to_numpy(), "invalid search_date")
+    rows = valid(is_multi_city)
+    fares = score(rows, lambda: predict_neural_network_batch(
+        origins=origin.iloc[rows].to_numpy(),
+        dests=destination.iloc[rows].to_numpy(),
+        search_dates=search_date.iloc[rows],
+        depart_dates=depart_date.iloc[rows],
+        depart_times=depart_time.iloc[rows].dt.time.to_numpy(),
+        is_basic_econ=basic_economy.iloc[rows].to_numpy(),
+        n_hops=n_hops[rows],
+        cabins=cabins.iloc[rows].tolist())) if len(rows) else None
+    if fares is not None:
+        fare[rows] = fares
+
+    result = chunk.drop(columns=[name for name in RESULT_SCHEMA.names if name in chunk])
+    return result.assign(trip=trip.to_numpy(), fare=fare, depart_fare=depart_fare,
+                         return_fare=return_fare, error=error)
+
+
+###############################################################################
+#
+#   ENTRY POINT
+#
+###############################################################################
+
+# Thread pool limits of a worker process, kept for its lifetime
+_thread_limits = None
+
+
+def _init_worker():
+    # One thread per worker process: the workers already use every core.
+    # Setting OMP_NUM_THREADS here would be too late, as the forked worker
+    # inherits OpenMP and BLAS already initialized by this process
+    global _thread_limits
+    from threadpoolctl import threadpool_limits
+    _thread_limits = threadpool_limits(1)
+
+
+def score_file(input_path: str, output_path: str, chunk_size: int = CHUNK_SIZE,
+               workers: int = 1, default_trip: str = None) -> dict:
+    """
+    Score every row of ``input_path`` and write the results to the Parquet
+    file ``output_path``, chunk by chunk and in input order.
+
+    Returns the number of rows read, scored and rejected.
+    """
+    input_schema, chunks = read_chunks(input_path, chunk_size)
+    stats = collections.Counter()
+
+    def record(scored):
+        writer.write(scored)
+        stats['rows'] += len(scored)
+        stats['rejected'] += int(scored['error'].notna().sum())
+
+    with ParquetChunkWriter(output_path, output_schema(input_schema)) as writer:
+        if workers <= 1:
+            for chunk in chunks:
+                record(score_chunk(chunk, default_trip))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor:
+                # Bounded queue of chunks in flight, written back in input order
+                in_flight = collections.deque()
+                for chunk in chunks:
+                    in_flight.append(executor.submit(score_chunk, chunk, default_trip))
+                    if len(in_flight) >= 2 * workers:
+                        record(in_flight.popleft().result())
+                while in_flight:
+                    record(in_flight.popleft().result())
+    stats['scored'] = stats['rows'] - stats['rejected']
+    return dict(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score the itineraries of a CSV or Parquet file")
+    parser.add_argument('input', help="CSV or .parquet file of itineraries")
+    parser.add_argument('output', help="Parquet file to write the fares to")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="Rows read and scored at a time")
+    parser.add_argument('--workers', type=int, default=1, help="Processes scoring chunks in parallel")
+    parser.add_argument('--trip', choices=TRIPS, help="Trip type of the rows without a 'trip' value")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    stats = score_file(args.input, args.output, args.chunk_size, args.workers, args.trip)
+    elapsed = time.perf_counter() - start
+    print(f"Scored {stats.get('scored', 0)} of {stats.get('rows', 0)} rows ({stats.get('rejected', 0)} rejected) "
+          f"in {elapsed:.1f}s -> {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from predict_nohops import predict_nohops_flight_fare_batch
+from predict_nohops_return import predict_nohops_return_flight_fare_batch
+
+
+###############################################################################
+#
+#   HELPERS
+#
+###############################################################################
+
+def date_window(centre: datetime.date, window_days: int, min_date: datetime.date = None, max_date: datetime.date = None) -> pd.DatetimeIndex:
+    """
+    Return every day within ``window_days`` of ``centre``, clipped to the
+    optional ``[min_date, max_date]`` range.
+    """
+    start = centre - datetime.timedelta(days=window_days)
+    end = centre + datetime.timedelta(days=window_days)
+    if min_date is not None:
+        start = max(start, min_date)
+    if max_date is not None:
+        end = min(end, max_date)
+    return pd.date_range(start, end, freq='D')
+
+
+###############################################################################
+#
+#   CALENDARS
+#
+###############################################################################
+
+def one_way_fare_calendar(
+        centre_date: datetime.date,
+        window_days: int,
+        input_time: str,
+        starting_airport: str,
+        destination_airport: str,
+        cabin_type: str,
+        min_date: datetime.date = None,
+        max_date: datetime.date = None) -> pd.DataFrame:
+    """
+    Predict the one-way fare for every departure day in a window around
+    ``centre_date`` with a single batched model call.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per departure day with the columns 'date' and 'fare'.
+    """
+    dates = date_window(centre_date, window_days, min_date, max_date)
+    n = len(dates)
+    fares = predict_nohops_flight_fare_batch(
+        dates.strftime('%Y-%m-%d'), [input_time] * n,
+        [starting_airport] * n, [destination_airport] * n, [cabin_type] * n)
+    return pd.DataFrame({'date': dates, 'fare': fares})
+
+
+def return_fare_calendar(
+        depart_centre: datetime.date,
+        return_centre: datetime.date,
+        window_days: int,
+        depart_time: str,
+        return_time: str,
+        starting_airport: str,
+        destination_airport: str,
+        depart_cabin: str,
+        return_cabin: str,
+        min_date: datetime.date = None,
+        max_date: datetime.date = None) -> pd.DataFrame:
+    """
+    Predict the return fare for every departure x return day pair in a window
+    around ``depart_centre`` and ``return_centre``.
+
+    The legs are priced independently, so only one prediction per candidate
+    departure day and one per candidate return day is needed. Both legs go
+    through the model in a single batched call and the pair totals are an
+    outer sum, keeping only pairs where the return is not before departure.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per valid pair with the columns 'depart_date', 'return_date',
+        'depart_fare', 'return_fare' and 'fare' (the total).
+    """
+    depart_dates = date_window(depart_centre, window_days, min_date, max_date)
+    return_dates = date_window(return_centre, window_days, min_date, max_date)
+    n_dep, n_ret = len(depart_dates), len(return_dates)
+    fares = predict_nohops_return_flight_fare_batch(
+        np.concatenate([depart_dates.strftime('%Y-%m-%d'), return_dates.strftime('%Y-%m-%d')]),
+        [depart_time] * n_dep + [return_time] * n_ret,
+        [starting_airport] * n_dep + [destination_airport] * n_ret,
+        [destination_airport] * n_dep + [starting_airport] * n_ret,
+        [depart_cabin] * n_dep + [return_cabin] * n_ret)
+    depart_fares, return_fares = fares[:n_dep], fares[n_dep:]
+
+    dep_idx, ret_idx = np.nonzero(
+        depart_dates.to_numpy()[:, None] <= return_dates.to_numpy()[None, :])
+    return pd.DataFrame({
+        'depart_date': depart_dates[dep_idx],
+        'return_date': return_dates[ret_idx],
+        'depart_fare': depart_fares[dep_idx],
+        'return_fare': return_fares[ret_idx],
+        'fare': depart_fares[dep_idx] + return_fares[ret_idx],
+    })
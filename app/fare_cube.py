@@ -0,0 +1,307 @@
+"""
+Precomputed fares for every cell of the one-way and return feature grids.
+
+The XGBoost fare models only see the route, the day of week, month, hour and
+minute of departure and the cabin, so their whole input space on the covered
+routes is a small grid:
+
+    origin x destination x 7 weekdays x 12 months x 24 hours x minutes x 4 cabins
+
+``FareCube.build`` scores every cell once with batched inference and stores
+the fares as one array indexed by integer dimensions (airport IDs of the
+route table, weekday, month - 1, hour, minute bucket, cabin). Only the
+quarter hours are on the grid, matching the steps of the UI's time inputs;
+other minutes, uncovered routes and unknown cabins fall back to live
+inference in the predictors.
+
+A cube is saved as a ``.npy`` file (float32 by default, float16 to halve
+its size at the cost of rounding fares to about 0.5 dollars) with the grid
+and the fingerprint of the model artifact it was built from in a ``.json``
+next to it. ``get_fare_cube`` memory-maps it and ignores it as soon as the
+artifact no longer matches, so a retrained model never serves stale fares.
+
+Build the cubes of every model artifact present, from the repository root:
+
+    python app/fare_cube.py [--dtype float16]
+
+Set ``AIRFARE_FARE_CUBE=0`` to always use live inference.
+"""
+import argparse
+import datetime
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from airport_index import get_airport_index
+from model_registry import MODELS_DIR, registry
+from pipeline_fast_path import model_inputs
+
+USE_FARE_CUBE = os.environ.get('AIRFARE_FARE_CUBE', '1') != '0'
+
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+MINUTES = (0, 15, 30, 45)
+CABINS = ('coach', 'premium coach', 'business', 'first')
+
+# Rows scored per model call while building
+BATCH_SIZE = 250_000
+
+
+def cube_path(model_name: str, models_dir: str = MODELS_DIR) -> str:
+    """Path of the cube built for the artifact ``model_name``."""
+    return os.path.join(models_dir, f"fare_cube_{os.path.splitext(model_name)[0]}.npy")
+
+
+def select_rows(columns, rows):
+    """Rows ``rows`` of a DataFrame or of a dict of columns."""
+    if isinstance(columns, pd.DataFrame):
+        return columns.iloc[rows]
+    return {name: np.asarray(values)[rows] for name, values in columns.items()}
+
+
+def _grid_dates(year: int = 2024) -> np.ndarray:
+    # One date per (weekday, month): the first day of the month falling on that weekday
+    dates = np.empty((7, 12), dtype=object)
+    for month in range(1, 13):
+        first = datetime.date(year, month, 1)
+        for offset in range(7):
+            day = first + datetime.timedelta(days=offset)
+            dates[day.weekday(), month - 1] = day.isoformat()
+    return dates
+
+
+###############################################################################
+#
+#   FARE CUBE
+#
+###############################################################################
+
+class FareCube:
+    """
+    Fares of one model over the whole feature grid.
+
+    Parameters
+    ----------
+    fares : np.ndarray
+        ``(n_airports, n_airports, 7, 12, 24, len(minutes), len(cabins))``
+        fares, NaN for the cells that were not scored.
+    airports : list of str
+        IATA codes in airport ID order (the route table's).
+    minutes : tuple of int
+        Minutes on the grid.
+    cabins : tuple of str
+        Cabins on the grid.
+    model_name : str
+        Artifact the fares were predicted with.
+    version : str
+        Fingerprint of that artifact (see `ModelRegistry.file_version`).
+    """
+
+    def __init__(self, fares, airports, minutes, cabins, model_name: str, version: str):
+        self.fares = fares
+        self.airports = list(airports)
+        self.minutes = tuple(minutes)
+        self.cabins = tuple(cabins)
+        self.model_name = model_name
+        self.version = version
+        self._airport_ids = {code: i for i, code in enumerate(self.airports)}
+        self._weekday_ids = {name: i for i, name in enumerate(DAY_NAMES)}
+        self._cabin_ids = {cabin: i for i, cabin in enumerate(self.cabins)}
+        self._minute_ids = np.full(60, -1, dtype=np.intp)
+        self._minute_ids[list(self.minutes)] = np.arange(len(self.minutes))
+
+    @classmethod
+    def build(cls, model_name: str, build_frame, minutes=MINUTES, cabins=CABINS,
+              dtype=np.float32, batch_size: int = BATCH_SIZE) -> 'FareCube':
+        """
+        Score the whole grid with the model ``model_name``.
+
+        Parameters
+        ----------
+        model_name : str
+            Artifact of the fitted pipeline.
+        build_frame : callable
+            The predictor's input frame builder, taking columnar dates, times,
+            starting airports, destination airports and cabins.
+        minutes, cabins : tuple
+            Minutes and cabins on the grid.
+        dtype : np.dtype
+            Dtype of the stored fares (float32 or float16).
+        batch_size : int
+            Rows scored per model call.
+        """
+        version = registry.file_version(model_name)
+        pipeline = registry.get(model_name)
+        airport_index = get_airport_index()
+        airports = airport_index.route_table.codes
+        routes = [(origin, dest) for origin in airport_index.airports for dest in airport_index.destinations(origin)]
+
+        fares = np.full((len(airports), len(airports), 7, 12, 24, len(minutes), len(cabins)), np.nan, dtype=dtype)
+        dates = _grid_dates()
+        weekday, month, hour, minute, cabin = (grid.ravel() for grid in np.indices((7, 12, 24, len(minutes), len(cabins))))
+        cell_dates = dates[weekday, month]
+        cell_times = np.array([f"{h:02d}:{m:02d}" for h, m in zip(hour, np.asarray(minutes)[minute])], dtype=object)
+        cell_cabins = np.asarray(cabins, dtype=object)[cabin]
+        cells = len(weekday)
+
+        routes_per_batch = max(1, batch_size // cells)
+        for start in range(0, len(routes), routes_per_batch):
+            batch = routes[start:start + routes_per_batch]
+            frame = build_frame(
+                np.tile(cell_dates, len(batch)), np.tile(cell_times, len(batch)),
+                np.repeat([origin for origin, _ in batch], cells),
+                np.repeat([dest for _, dest in batch], cells),
+                np.tile(cell_cabins, len(batch)))
+            features, predict = model_inputs(pipeline, frame)
+            predicted = np.asarray(predict(features), dtype=np.float64).reshape(len(batch), cells)
+            for (origin, dest), route_fares in zip(batch, predicted):
+                fares[airport_index.route_table.ids[origin], airport_index.route_table.ids[dest]] = \
+                    route_fares.reshape(fares.shape[2:])
+        return cls(fares, airports, minutes, cabins, model_name, version)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: str = 'r') -> 'FareCube':
+        """Load a cube written by `save`, memory-mapping the fares by default."""
+        with open(os.path.splitext(path)[0] + '.json') as f:
+            meta = json.load(f)
+        fares = np.load(path, mmap_mode=mmap_mode)
+        return cls(fares, meta['airports'], meta['minutes'], meta['cabins'], meta['model_name'], meta['version'])
+
+    def save(self, path: str):
+        """Write the fares to ``path`` (.npy) and the grid to a .json next to it."""
+        np.save(path, self.fares)
+        with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+            json.dump({
+                'model_name': self.model_name,
+                'version': self.version,
+                'airports': self.airports,
+                'minutes': list(self.minutes),
+                'cabins': list(self.cabins),
+                'dtype': str(self.fares.dtype),
+            }, f)
+
+    def lookup(self, columns, names) -> tuple:
+        """
+        Look up the fares of the rows of ``columns``.
+
+        Parameters
+        ----------
+        columns : pd.DataFrame or dict
+            Input columns built by the predictor.
+        names : tuple of str
+            Names of the origin, destination, day name, month, hour, minute
+            and cabin columns in ``columns``.
+
+        Returns
+        -------
+        tuple
+            ``(fares, hit)``: float64 fares (NaN where missed) and the boolean
+            mask of the rows found on the grid.
+        """
+        origin, dest, day, month, hour, minute, cabin = (np.asarray(columns[name]) for name in names)
+        idx = [
+            np.fromiter((self._airport_ids.get(code, -1) for code in origin), dtype=np.intp, count=len(origin)),
+            np.fromiter((self._airport_ids.get(code, -1) for code in dest), dtype=np.intp, count=len(dest)),
+            np.fromiter((self._weekday_ids.get(name, -1) for name in day), dtype=np.intp, count=len(day)),
+            np.where((month >= 1) & (month <= 12), month - 1, -1).astype(np.intp),
+            np.where((hour >= 0) & (hour < 24), hour, -1).astype(np.intp),
+            np.where((minute >= 0) & (minute < 60), self._minute_ids[np.clip(minute, 0, 59)], -1),
+            np.fromiter((self._cabin_ids.get(name, -1) for name in cabin), dtype=np.intp, count=len(cabin)),
+        ]
+        on_grid = np.logical_and.reduce([i >= 0 for i in idx])
+        fares = np.full(len(on_grid), np.nan)
+        fares[on_grid] = self.fares[tuple(i[on_grid] for i in idx)]
+        return fares, ~np.isnan(fares)
+
+
+###############################################################################
+#
+#   SHARED CUBES
+#
+###############################################################################
+
+# Model name -> (model version, file stamp, cube or None)
+_cubes = {}
+_cubes_lock = threading.Lock()
+
+
+def _file_stamp(path: str) -> tuple:
+    # Changes whenever the file is written again; None if there is none
+    try:
+        file_stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return file_stat.st_mtime_ns, file_stat.st_size
+
+
+def get_fare_cube(model_name: str) -> FareCube:
+    """
+    Return the cube of ``model_name`` if one was built for the artifact as it
+    is now (loaded or on disk), else None.
+    """
+    if not USE_FARE_CUBE:
+        return None
+    version = registry.version(model_name) or registry.file_version(model_name)
+    path = cube_path(model_name)
+    with _cubes_lock:
+        cached_version, stamp, cube = _cubes.get(model_name, (None, None, None))
+        # A missing or stale cube is cached as None too, and only looked for
+        # again once the model or the cube file changes
+        if cached_version == version and (cube is not None or _file_stamp(path) == stamp):
+            return cube
+        stamp = _file_stamp(path)
+        cube = FareCube.load(path) if stamp is not None else None
+        if cube is not None and cube.version != version:
+            cube = None
+        _cubes[model_name] = (version, stamp, cube)
+        return cube
+
+
+def lookup_fares(model_name: str, columns, names) -> tuple:
+    """
+    Look up the rows of ``columns`` in the cube of ``model_name``.
+
+    Returns ``(fares, hit)`` like `FareCube.lookup`; every row misses when
+    there is no valid cube.
+    """
+    cube = get_fare_cube(model_name)
+    if cube is None:
+        n = len(columns[names[0]])
+        return np.full(n, np.nan), np.zeros(n, dtype=bool)
+    return cube.lookup(columns, names)
+
+
+###############################################################################
+#
+#   ENTRY POINT
+#
+###############################################################################
+
+def main():
+    import predict_nohops
+    import predict_nohops_return
+
+    parser = argparse.ArgumentParser(description="Precompute the fare cubes of the one-way and return models")
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default='float32')
+    args = parser.parse_args()
+
+    for model_name, build_frame in (
+            (predict_nohops.MODEL_NAME, predict_nohops.build_nohops_input_frame),
+            (predict_nohops_return.MODEL_NAME, predict_nohops_return.build_nohops_return_input_frame)):
+        if registry.file_version(model_name) is None:
+            print(f"{model_name}: not found, skipped")
+            continue
+        start = time.perf_counter()
+        cube = FareCube.build(model_name, build_frame, dtype=np.dtype(args.dtype))
+        path = cube_path(model_name)
+        cube.save(path)
+        scored = int((~np.isnan(cube.fares)).sum())
+        print(f"{model_name}: {scored} cells in {time.perf_counter() - start:.1f}s, "
+              f"{cube.fares.nbytes / 2 ** 20:.1f} MiB -> {path}")
+
+
+if __name__ == '__main__':
+    main()
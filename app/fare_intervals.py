@@ -0,0 +1,328 @@
+"""
+Prediction intervals for the fare models, from calibration residuals.
+
+For each model, ``IntervalTable.calibrate`` scores a held-out set with known
+fares and takes the log ratio of every actual fare to its prediction. The
+split-conformal quantiles of those residuals at both tails (with the
+``(n + 1)`` finite-sample correction) are stored per group:
+
+- one-way and return models: per (origin, destination, cabin) route;
+- multi-city network: per (number of trips, highest cabin booked), as the
+  network does not see the airports themselves.
+
+Groups with fewer than ``--min-count`` residuals fall back to the quantiles
+of their cabin, then to those of the whole set. An interval is then
+``[fare * exp(low), fare * exp(high)]``, so it scales with the fare, and
+looking it up is a few array indexing operations on the batch the predictor
+already holds.
+
+A table is saved as a ``.npz`` of float32 quantiles with the groups, the
+coverage and the fingerprint of the model artifact in a ``.json`` next to
+it. ``get_interval_table`` ignores a table as soon as the artifact no
+longer matches, and the predictors then return no interval (NaN bounds).
+
+Calibrate on a held-out split saved with `models.sets.save_sets` (the model
+input columns and the fares), from the repository root:
+
+    python app/fare_intervals.py one_way data/processed/ [--split val] [--coverage 0.8]
+
+Set ``AIRFARE_FARE_INTERVALS=0`` to never return intervals.
+"""
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from model_registry import MODELS_DIR, registry
+
+USE_FARE_INTERVALS = os.environ.get('AIRFARE_FARE_INTERVALS', '1') != '0'
+
+COVERAGE = 0.8
+MIN_COUNT = 30
+
+# Cabins from lowest to highest class
+CABINS = ('coach', 'premium coach', 'business', 'first')
+_CABIN_RANKS = {cabin: rank for rank, cabin in enumerate(CABINS)}
+
+
+def intervals_path(model_name: str, models_dir: str = MODELS_DIR) -> str:
+    """Path of the interval table calibrated for the artifact ``model_name``."""
+    return os.path.join(models_dir, f"fare_intervals_{os.path.splitext(model_name)[0]}.npz")
+
+
+def top_cabins(cabins) -> np.ndarray:
+    """Highest class cabin of each itinerary, given as lists of cabins."""
+    return np.array([max(itinerary_cabins, key=lambda cabin: _CABIN_RANKS.get(cabin, -1), default='')
+                     for itinerary_cabins in cabins], dtype=object)
+
+
+def _group_bounds(groups: np.ndarray, residuals: np.ndarray, n_groups: int, coverage: float, min_count: int):
+    # Split-conformal quantiles of both tails of every group, NaN for small groups
+    order = np.lexsort((residuals, groups))
+    residuals = residuals[order]
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    tail = (1 - coverage) / 2
+    low = np.clip(np.floor((counts + 1) * tail) - 1, 0, None).astype(np.intp)
+    high = np.minimum(np.ceil((counts + 1) * (1 - tail)) - 1, counts - 1).astype(np.intp)
+    bounds = np.full((n_groups, 2), np.nan, dtype=np.float32)
+    enough = counts >= max(min_count, 1)
+    bounds[enough, 0] = residuals[starts[enough] + low[enough]]
+    bounds[enough, 1] = residuals[starts[enough] + high[enough]]
+    return bounds, counts
+
+
+###############################################################################
+#
+#   INTERVAL TABLE
+#
+###############################################################################
+
+class IntervalTable:
+    """
+    Log-ratio residual quantiles of one model per group of requests.
+
+    Parameters
+    ----------
+    keys : tuple of str
+        Names of the grouping keys; the last one is the fallback key
+        (the cabin).
+    levels : list of list
+        Values of each key, in index order.
+    bounds : np.ndarray
+        ``(*map(len, levels), 2)`` low and high quantiles of every group,
+        NaN for the groups with too few residuals.
+    fallback_bounds : np.ndarray
+        ``(len(levels[-1]), 2)`` quantiles per value of the last key.
+    overall_bounds : np.ndarray
+        ``(2,)`` quantiles of all the residuals.
+    coverage : float
+        Fraction of actual fares the intervals were calibrated to contain.
+    model_name : str
+        Artifact the residuals were computed with.
+    version : str
+        Fingerprint of that artifact (see `ModelRegistry.file_version`).
+    """
+
+    def __init__(self, keys, levels, bounds, fallback_bounds, overall_bounds, coverage: float,
+                 model_name: str, version: str):
+        self.keys = tuple(keys)
+        self.levels = [list(level) for level in levels]
+        self.bounds = bounds
+        self.fallback_bounds = fallback_bounds
+        self.overall_bounds = overall_bounds
+        self.coverage = coverage
+        self.model_name = model_name
+        self.version = version
+        self._ids = [{value: i for i, value in enumerate(level)} for level in self.levels]
+
+    @classmethod
+    def calibrate(cls, keys: dict, fares, actual, model_name: str, coverage: float = COVERAGE,
+                  min_count: int = MIN_COUNT) -> 'IntervalTable':
+        """
+        Compute the quantiles from predicted and actual fares.
+
+        Parameters
+        ----------
+        keys : dict
+            Name of each grouping key mapped to its value for every fare,
+            the fallback key (the cabin) last.
+        fares, actual : array-like
+            Predicted and actual fares; pairs that are not both positive are
+            left out.
+        model_name : str
+            Artifact the fares were predicted with.
+        coverage : float
+            Fraction of actual fares the intervals should contain.
+        min_count : int
+            Fewest residuals a group needs to get its own quantiles.
+        """
+        fares = np.asarray(fares, dtype=np.float64)
+        actual = np.asarray(actual, dtype=np.float64)
+        valid = (fares > 0) & (actual > 0)
+        residuals = np.log(actual[valid] / fares[valid])
+
+        levels, ids = [], []
+        for values in keys.values():
+            level, inverse = np.unique(np.asarray(values)[valid], return_inverse=True)
+            levels.append(level.tolist())
+            ids.append(inverse)
+        shape = tuple(len(level) for level in levels)
+        groups = np.ravel_multi_index(ids, shape) if ids else np.zeros(len(residuals), dtype=np.intp)
+
+        bounds, _ = _group_bounds(groups, residuals, int(np.prod(shape)), coverage, min_count)
+        fallback_bounds, _ = _group_bounds(ids[-1], residuals, shape[-1], coverage, min_count)
+        overall_bounds, _ = _group_bounds(np.zeros(len(residuals), dtype=np.intp), residuals, 1, coverage, 1)
+        return cls(list(keys), levels, bounds.reshape(shape + (2,)), fallback_bounds, overall_bounds[0],
+                   coverage, model_name, registry.file_version(model_name))
+
+    @classmethod
+    def load(cls, path: str) -> 'IntervalTable':
+        """Load a table written by `save`."""
+        with open(os.path.splitext(path)[0] + '.json') as f:
+            meta = json.load(f)
+        with np.load(path) as arrays:
+            return cls(meta['keys'], meta['levels'], arrays['bounds'], arrays['fallback_bounds'],
+                       arrays['overall_bounds'], meta['coverage'], meta['model_name'], meta['version'])
+
+    def save(self, path: str):
+        """Write the quantiles to ``path`` (.npz) and the groups to a .json next to it."""
+        np.savez(path, bounds=self.bounds, fallback_bounds=self.fallback_bounds, overall_bounds=self.overall_bounds)
+        with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+            json.dump({
+                'model_name': self.model_name,
+                'version': self.version,
+                'coverage': self.coverage,
+                'keys': list(self.keys),
+                'levels': self.levels,
+            }, f)
+
+    def interval(self, fares, *keys) -> tuple:
+        """
+        Bounds of the intervals around ``fares``.
+
+        Parameters
+        ----------
+        fares : array-like
+            Predicted fares.
+        *keys : array-like
+            Value of every grouping key for each fare, in the order of
+            ``self.keys``.
+
+        Returns
+        -------
+        tuple
+            ``(lower, upper)`` float64 arrays.
+        """
+        fares = np.asarray(fares, dtype=np.float64)
+        idx = [np.fromiter((ids.get(value, -1) for value in values), dtype=np.intp, count=len(fares))
+               for ids, values in zip(self._ids, keys)]
+        known = np.logical_and.reduce([i >= 0 for i in idx])
+        bounds = np.full((len(fares), 2), np.nan)
+        bounds[known] = self.bounds[tuple(i[known] for i in idx)]
+
+        # Small or unknown groups use their cabin's quantiles, then the overall ones
+        missing = np.isnan(bounds[:, 0]) & (idx[-1] >= 0)
+        bounds[missing] = self.fallback_bounds[idx[-1][missing]]
+        missing = np.isnan(bounds[:, 0])
+        bounds[missing] = self.overall_bounds
+        return fares * np.exp(bounds[:, 0]), fares * np.exp(bounds[:, 1])
+
+
+###############################################################################
+#
+#   SHARED TABLES
+#
+###############################################################################
+
+# Model name -> (model version, file stamp, table or None)
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def _file_stamp(path: str) -> tuple:
+    # Changes whenever the file is written again; None if there is none
+    try:
+        file_stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return file_stat.st_mtime_ns, file_stat.st_size
+
+
+def get_interval_table(model_name: str) -> IntervalTable:
+    """
+    Return the interval table of ``model_name`` if one was calibrated for the
+    artifact as it is now (loaded or on disk), else None.
+    """
+    if not USE_FARE_INTERVALS:
+        return None
+    version = registry.version(model_name) or registry.file_version(model_name)
+    path = intervals_path(model_name)
+    with _tables_lock:
+        cached_version, stamp, table = _tables.get(model_name, (None, None, None))
+        # A missing or stale table is cached as None too, and only looked for
+        # again once the model or the table file changes
+        if cached_version == version and (table is not None or _file_stamp(path) == stamp):
+            return table
+        stamp = _file_stamp(path)
+        table = IntervalTable.load(path) if stamp is not None else None
+        if table is not None and table.version != version:
+            table = None
+        _tables[model_name] = (version, stamp, table)
+        return table
+
+
+def fare_intervals(model_name: str, fares, *keys) -> tuple:
+    """
+    Bounds of the intervals around the ``fares`` predicted by ``model_name``.
+
+    Returns ``(lower, upper)`` like `IntervalTable.interval`, both NaN when
+    there is no valid table.
+    """
+    table = get_interval_table(model_name)
+    if table is None:
+        return np.full(len(fares), np.nan), np.full(len(fares), np.nan)
+    return table.interval(fares, *keys)
+
+
+###############################################################################
+#
+#   ENTRY POINT
+#
+###############################################################################
+
+def main():
+    import predict_nohops
+    import predict_nohops_return
+    import predict_withhops
+    from pipeline_fast_path import model_inputs
+
+    parser = argparse.ArgumentParser(description="Calibrate the prediction intervals of a fare model")
+    parser.add_argument('model', choices=['one_way', 'return', 'multi_city'])
+    parser.add_argument('path', help="Folder of the X_<split>.parquet and y_<split>.parquet sets")
+    parser.add_argument('--split', default='val', help="Held-out split to calibrate on (default: val)")
+    parser.add_argument('--coverage', type=float, default=COVERAGE)
+    parser.add_argument('--min-count', type=int, default=MIN_COUNT)
+    args = parser.parse_args()
+
+    # Same layout as models.sets.save_sets
+    X = pd.read_parquet(os.path.join(args.path, f'X_{args.split}.parquet'))
+    y = pd.read_parquet(os.path.join(args.path, f'y_{args.split}.parquet'))['target'].to_numpy()
+
+    if args.model == 'multi_city':
+        model_name = predict_withhops.NETWORK_NAME
+        features = X.to_numpy(dtype=np.float32)
+        fares = registry.get(model_name).predict(features, verbose=0)[:, 0]
+        classes = registry.get(predict_withhops.CABIN_ENCODER_NAME).classes_
+        cabin_columns = features[:, predict_withhops.N_NUMERIC_FEATURES:] > 0
+        keys = {
+            'n_hops': features[:, 14].astype(np.int64),
+            'cabin': top_cabins([classes[row] for row in cabin_columns]),
+        }
+    else:
+        module = predict_nohops if args.model == 'one_way' else predict_nohops_return
+        model_name = module.MODEL_NAME
+        features, predict = model_inputs(registry.get(model_name), X)
+        fares = predict(features)
+        keys = {
+            'origin': X['startingAirport'].to_numpy(),
+            'destination': X['destinationAirport'].to_numpy(),
+            'cabin': X['cabin_type'].to_numpy(),
+        }
+
+    table = IntervalTable.calibrate(keys, fares, y, model_name, args.coverage, args.min_count)
+    path = intervals_path(model_name)
+    table.save(path)
+
+    lower, upper = table.interval(fares, *keys.values())
+    covered = float(np.mean((y >= lower) & (y <= upper)))
+    groups = int((~np.isnan(table.bounds[..., 0])).sum())
+    print(f"{model_name}: {groups} groups with their own quantiles, "
+          f"{covered:.1%} of {len(y)} fares covered (target {args.coverage:.0%}) -> {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Timing spans and counters for the prediction paths.
+
+A request (one press of "Predict!" or one HTTP call) is wrapped in
+``request(path)``; inside it, ``span(stage)`` times each step (model
+acquisition, features, inference, rendering). Every span is:
+
+- added to the request's ``Trace``, which the UI shows in its debug panel;
+- aggregated per (path, stage) into process-wide counters, exported in the
+  Prometheus text format by ``prometheus_text`` (served on the HTTP
+  service's ``/metrics``).
+
+``count`` adds to a counter and ``observe`` records a value (e.g. a batch
+size) whose count, sum and maximum are exported like the spans.
+
+Each finished request is also logged as one JSON line on the
+'airfare.metrics' logger; set ``AIRFARE_METRICS_LOG`` to a file path to
+append those lines to a file.
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+METRICS_LOG = os.environ.get('AIRFARE_METRICS_LOG')
+
+logger = logging.getLogger('airfare.metrics')
+if METRICS_LOG:
+    _handler = logging.FileHandler(METRICS_LOG)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+
+_current = contextvars.ContextVar('airfare_trace', default=None)
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_observations = {}
+
+
+class Trace:
+    """Stage timings of one request, in the order the stages ran."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.started = time.time()
+        self.spans = []
+        self.total_seconds = None
+        self.error = None
+
+    def as_dict(self) -> dict:
+        return {
+            'path': self.path,
+            'started': self.started,
+            'total_seconds': self.total_seconds,
+            'error': self.error,
+            'spans': [{'stage': stage, 'seconds': seconds} for stage, seconds in self.spans],
+        }
+
+
+def _record(path: str, stage: str, seconds: float):
+    with _lock:
+        entry = _spans.setdefault((path, stage), [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+
+@contextlib.contextmanager
+def request(path: str):
+    """
+    Trace one request on ``path`` (e.g. 'one_way'), yielding its ``Trace``.
+
+    Spans opened anywhere below, including inside the predictors, are
+    attached to it.
+    """
+    trace = Trace(path)
+    token = _current.set(trace)
+    start = time.perf_counter()
+    try:
+        yield trace
+    except Exception as e:
+        trace.error = type(e).__name__
+        count('errors', path=path)
+        raise
+    finally:
+        trace.total_seconds = time.perf_counter() - start
+        _current.reset(token)
+        _record(path, 'total', trace.total_seconds)
+        count('requests', path=path)
+        logger.info(json.dumps(trace.as_dict()))
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    """Time the body as ``stage`` of the current request (if any)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        trace = _current.get()
+        if trace is not None:
+            trace.spans.append((stage, seconds))
+        _record(trace.path if trace is not None else '', stage, seconds)
+
+
+def count(name: str, value: float = 1, path: str = None):
+    """Add ``value`` to the counter ``name``, labelled with the current request path by default."""
+    if path is None:
+        trace = _current.get()
+        path = trace.path if trace is not None else ''
+    with _lock:
+        _counters[(name, path)] = _counters.get((name, path), 0) + value
+
+
+def observe(name: str, value: float, path: str = None):
+    """Record one value of ``name`` (count, sum and maximum), labelled like `count`."""
+    if path is None:
+        trace = _current.get()
+        path = trace.path if trace is not None else ''
+    with _lock:
+        entry = _observations.setdefault((name, path), [0, 0.0, value])
+        entry[0] += 1
+        entry[1] += value
+        entry[2] = max(entry[2], value)
+
+
+def snapshot() -> dict:
+    """Return the aggregated spans, counters and observations as plain dicts."""
+    with _lock:
+        return {
+            'spans': [
+                {'path': path, 'stage': stage, 'count': n, 'seconds_sum': total, 'seconds_max': longest}
+                for (path, stage), (n, total, longest) in sorted(_spans.items())
+            ],
+            'counters': [
+                {'name': name, 'path': path, 'value': value}
+                for (name, path), value in sorted(_counters.items())
+            ],
+            'observations': [
+                {'name': name, 'path': path, 'count': n, 'sum': total, 'max': largest}
+                for (name, path), (n, total, largest) in sorted(_observations.items())
+            ],
+        }
+
+
+def prometheus_text() -> str:
+    """Render the aggregated spans, counters and observations in the Prometheus text format."""
+    metrics = snapshot()
+    lines = [
+        '# HELP airfare_stage_seconds Time spent in each stage of a prediction request.',
+        '# TYPE airfare_stage_seconds summary',
+    ]
+    for s in metrics['spans']:
+        labels = f'path="{s["path"]}",stage="{s["stage"]}"'
+        lines.append(f'airfare_stage_seconds_sum{{{labels}}} {s["seconds_sum"]:.9f}')
+        lines.append(f'airfare_stage_seconds_count{{{labels}}} {s["count"]}')
+    lines.append('# HELP airfare_stage_seconds_max Longest time spent in each stage.')
+    lines.append('# TYPE airfare_stage_seconds_max gauge')
+    for s in metrics['spans']:
+        lines.append(f'airfare_stage_seconds_max{{path="{s["path"]}",stage="{s["stage"]}"}} {s["seconds_max"]:.9f}')
+    for name in sorted({c['name'] for c in metrics['counters']}):
+        lines.append(f'# TYPE airfare_{name}_total counter')
+        for c in metrics['counters']:
+            if c['name'] == name:
+                lines.append(f'airfare_{name}_total{{path="{c["path"]}"}} {c["value"]}')
+    for name in sorted({o['name'] for o in metrics['observations']}):
+        observations = [o for o in metrics['observations'] if o['name'] == name]
+        lines.append(f'# TYPE airfare_{name} summary')
+        for o in observations:
+            lines.append(f'airfare_{name}_sum{{path="{o["path"]}"}} {o["sum"]}')
+            lines.append(f'airfare_{name}_count{{path="{o["path"]}"}} {o["count"]}')
+        lines.append(f'# TYPE airfare_{name}_max gauge')
+        for o in observations:
+            lines.append(f'airfare_{name}_max{{path="{o["path"]}"}} {o["max"]}')
+    return '\n'.join(lines) + '\n'
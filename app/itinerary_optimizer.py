@@ -0,0 +1,235 @@
+"""
+Search for the cheapest multi-city itineraries.
+
+Given a starting airport, the cities to visit, a window for the first
+departure and the cabins allowed, every ordering of the cities is combined
+with every departure date, time and cabin choice, and the candidates are
+scored with the multi-city network in large batches.
+
+The network only sees the first origin, the final destination, the number
+of trips, the first departure and which cabins are booked. That keeps the
+search small:
+
+- orderings are enumerated as an array and their total distance and
+  duration come from the route table in one lookup, so orderings over the
+  optional ``max_total_distance`` / ``max_total_duration`` bounds are
+  dropped before any scoring;
+- orderings sharing the same final destination get the same fare, so only
+  the shortest one per destination is scored;
+- cabins are enumerated as sets rather than per-trip assignments.
+
+Large searches score several chunks at once on the threads of the shared
+prediction pool: the network's matrix products release the GIL, the models
+are not loaded again in other processes, and nothing is forked from the
+multithreaded app. A search has at most the session's share of the pool in
+flight (``AIRFARE_SESSION_CONCURRENCY``, default: 2).
+"""
+import collections
+import datetime
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from predict_withhops import predict_neural_network_batch
+from prediction_pool import pool
+from route_table import get_route_table
+
+CABINS = ('coach', 'premium coach', 'business', 'first')
+
+# Orderings are enumerated exhaustively, so keep the number of cities small
+MAX_CITIES = 8
+
+# Candidates scored per model call (and per task on the prediction pool)
+CHUNK_SIZE = 50_000
+
+
+###############################################################################
+#
+#   CANDIDATES
+#
+###############################################################################
+
+def enumerate_routes(origin: str, cities, max_total_distance: float = None, max_total_duration: float = None) -> pd.DataFrame:
+    """
+    Enumerate the orderings that start at ``origin`` and visit every city once.
+
+    Orderings over the distance (miles) or duration (days) bounds are dropped,
+    and of the orderings ending in the same city only the shortest is kept,
+    since the network prices them identically.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per kept ordering with the columns 'route' (tuple of IATA
+        codes), 'destination', 'n_trips', 'total_distance' and
+        'total_duration'.
+    """
+    cities = [city for city in dict.fromkeys(cities) if city != origin]
+    if not cities:
+        raise ValueError("Choose at least one city to visit other than the origin")
+    if len(cities) > MAX_CITIES:
+        raise ValueError(f"Choose at most {MAX_CITIES} cities to visit")
+
+    table = get_route_table()
+    city_ids = table.airport_ids(cities)
+    origin_id = table.airport_ids([origin])[0]
+    orders = np.array(list(itertools.permutations(range(len(cities)))), dtype=np.intp).reshape(-1, len(cities))
+    stops = np.column_stack([np.full(len(orders), origin_id), city_ids[orders]])
+
+    distances, durations = table.lookup(stops[:, :-1], stops[:, 1:])
+    total_distance = distances.sum(axis=1)
+    total_duration = durations.sum(axis=1)
+
+    keep = np.ones(len(stops), dtype=bool)
+    if max_total_distance is not None:
+        keep &= total_distance <= max_total_distance
+    if max_total_duration is not None:
+        keep &= total_duration <= max_total_duration
+    # The network does not accept itineraries that end where they start
+    keep &= stops[:, -1] != origin_id
+
+    routes = pd.DataFrame({
+        'route': [tuple(table.codes[i] for i in row) for row in stops[keep]],
+        'destination': [table.codes[i] for i in stops[keep, -1]],
+        'n_trips': len(cities),
+        'total_distance': total_distance[keep],
+        'total_duration': total_duration[keep],
+    })
+    return (routes.sort_values('total_distance', kind='stable')
+                  .drop_duplicates('destination')
+                  .reset_index(drop=True))
+
+
+def cabin_sets(allowed, n_trips: int) -> list:
+    """
+    Every distinct set of cabins that ``n_trips`` trips can book from ``allowed``,
+    as per-trip lists (the first cabin of the set fills the remaining trips).
+    """
+    allowed = list(dict.fromkeys(allowed))
+    sets = []
+    for size in range(1, min(len(allowed), n_trips) + 1):
+        for combination in itertools.combinations(allowed, size):
+            sets.append(list(combination) + [combination[0]] * (n_trips - size))
+    return sets
+
+
+###############################################################################
+#
+#   SCORING
+#
+###############################################################################
+
+def _score_chunk(chunk: dict) -> np.ndarray:
+    return predict_neural_network_batch(**chunk)
+
+
+def _chunks(inputs: dict, n: int, chunk_size: int):
+    for start in range(0, n, chunk_size):
+        yield {key: values[start:start + chunk_size] for key, values in inputs.items()}
+
+
+def optimize_itineraries(
+        origin: str,
+        cities,
+        first_departure: datetime.date,
+        last_departure: datetime.date,
+        search_date: datetime.date,
+        depart_times=(datetime.time(10, 0),),
+        cabins=CABINS,
+        is_basic_econ: bool = False,
+        top_k: int = 10,
+        max_total_distance: float = None,
+        max_total_duration: float = None,
+        workers: int = 1,
+        chunk_size: int = CHUNK_SIZE,
+        session=None) -> pd.DataFrame:
+    """
+    Return the ``top_k`` cheapest itineraries starting at ``origin`` and
+    visiting every city in ``cities``.
+
+    Parameters
+    ----------
+    origin : str
+        IATA code of the starting airport.
+    cities : list of str
+        IATA codes of the cities to visit, in any order.
+    first_departure, last_departure : datetime.date
+        Window for the departure of the first trip (inclusive).
+    search_date : datetime.date
+        Date the fares are searched on (usually today).
+    depart_times : list of datetime.time
+        Candidate departure times for the first trip.
+    cabins : list of str
+        Cabins allowed on any trip; basic economy only allows 'coach'.
+    is_basic_econ : bool
+        Whether the fares are basic economy.
+    top_k : int
+        Number of itineraries to return.
+    max_total_distance, max_total_duration : float
+        Optional bounds on the whole itinerary, in miles and days.
+    workers : int
+        Chunks scored at once on the shared prediction pool, capped by the
+        pool's per-session limit (``AIRFARE_SESSION_CONCURRENCY``, default
+        2) and its threads; 1 scores them on the calling thread.
+    chunk_size : int
+        Candidates per model call.
+    session : hashable
+        Key of the caller's session on the prediction pool (e.g. the
+        Streamlit session ID).
+
+    Returns
+    -------
+    pd.DataFrame
+        The cheapest itineraries, cheapest first, with the columns 'route',
+        'depart_date', 'depart_time', 'cabins', 'fare', 'total_distance'
+        and 'total_duration'.
+    """
+    routes = enumerate_routes(origin, cities, max_total_distance, max_total_duration)
+    dates = pd.date_range(first_departure, last_departure, freq='D').date
+    depart_times = list(depart_times)
+    cabin_options = cabin_sets(['coach'] if is_basic_econ else cabins, int(routes['n_trips'].iloc[0])) if len(routes) else []
+    if routes.empty or not len(dates) or not depart_times or not cabin_options:
+        return pd.DataFrame(columns=['route', 'depart_date', 'depart_time', 'cabins', 'fare', 'total_distance', 'total_duration'])
+
+    # Every combination of ordering, date, time and cabin set, as flat indices
+    route_idx, date_idx, time_idx, cabin_idx = (
+        grid.ravel() for grid in np.indices((len(routes), len(dates), len(depart_times), len(cabin_options))))
+    n = len(route_idx)
+
+    inputs = {
+        'origins': [origin] * n,
+        'dests': routes['destination'].to_numpy()[route_idx],
+        'search_dates': [search_date] * n,
+        'depart_dates': dates[date_idx],
+        'depart_times': [depart_times[i] for i in time_idx],
+        'is_basic_econ': np.full(n, is_basic_econ),
+        'n_hops': routes['n_trips'].to_numpy()[route_idx],
+        'cabins': [cabin_options[i] for i in cabin_idx],
+    }
+    chunks = _chunks(inputs, n, chunk_size)
+    in_flight = min(workers, pool.per_session)
+    if in_flight > 1 and n > chunk_size:
+        # A window of chunks on the pool, collected in order
+        pending, results = collections.deque(), []
+        for chunk in chunks:
+            if len(pending) >= in_flight:
+                results.append(pending.popleft().result())
+            pending.append(pool.submit(_score_chunk, chunk, session=session))
+        results += [future.result() for future in pending]
+        fares = np.concatenate(results)
+    else:
+        fares = np.concatenate([_score_chunk(chunk) for chunk in chunks])
+
+    k = min(top_k, n)
+    best = np.argpartition(fares, k - 1)[:k]
+    best = best[np.argsort(fares[best], kind='stable')]
+    return pd.DataFrame({
+        'route': [' → '.join(route) for route in routes['route'].to_numpy()[route_idx[best]]],
+        'depart_date': dates[date_idx[best]],
+        'depart_time': [depart_times[i] for i in time_idx[best]],
+        'cabins': [', '.join(sorted(set(cabin_options[i]))) for i in cabin_idx[best]],
+        'fare': fares[best],
+        'total_distance': routes['total_distance'].to_numpy()[route_idx[best]],
+        'total_duration': routes['total_duration'].to_numpy()[route_idx[best]],
+    })
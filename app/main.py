@@ -8,13 +8,39 @@
 # sys.path.append(os.path.abspath(os.path.join(current_dir, 'models')))
 
 import datetime
-import json
+import math
+import altair as alt
 import streamlit as st
+from concurrent.futures import CancelledError
 from datetime import datetime as d
-
-from predict_nohops import predict_nohops_flight_fare
-from predict_nohops_return import predict_nohops_return_flight_fare, encode_cyclical_features
-from predict_withhops import predict_neural_network
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from startup import timed, WARM_UP
+from airport_index import get_airport_index
+from model_registry import registry
+with timed('import predict_nohops'):
+    from predict_nohops import predict_nohops_flight_fare
+with timed('import predict_nohops_return'):
+    from predict_nohops_return import predict_nohops_return_flight_fare_batch, encode_cyclical_features
+with timed('import predict_withhops'):
+    from predict_withhops import predict_neural_network, NETWORK_NAME as NN_MODEL_NAME, CABIN_ENCODER_NAME
+from fare_calendar import one_way_fare_calendar, return_fare_calendar
+from instrumentation import request, span
+from itinerary_optimizer import optimize_itineraries, MAX_CITIES
+from model_server import MODEL_SERVER, ModelServerClient
+from model_versions import watch_models
+from prediction_pool import pool
+
+# With a model server running, predictions are made by its workers, which
+# share one copy of the models, and this process loads none
+if MODEL_SERVER:
+    model_server = ModelServerClient(MODEL_SERVER)
+    predict_nohops_flight_fare = model_server.function('predict_nohops_flight_fare')
+    predict_nohops_return_flight_fare_batch = model_server.function('predict_nohops_return_flight_fare_batch')
+    predict_neural_network = model_server.function('predict_neural_network')
+    one_way_fare_calendar = model_server.function('one_way_fare_calendar')
+    return_fare_calendar = model_server.function('return_fare_calendar')
+    optimize_itineraries = model_server.function('optimize_itineraries')
 
 
 ###############################################################################
@@ -28,19 +54,207 @@ def print_trip_summary(trips: list):
         print(trip, end="\n")
 
 
+def current_session_id():
+    """ID of the browser session running the script, used to cap its share of the prediction pool."""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else None
+
+
+class Speculation:
+    """A prediction started ahead of Predict, see `speculate`."""
+
+    def __init__(self, predict, future=None, wanted: bool = False):
+        self.predict = predict
+        self.future = future
+        # Whether it should start as soon as the session has room on the pool
+        self.wanted = wanted
+
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+
+    def result(self):
+        """
+        The speculative result, or a new prediction on the script thread if
+        none was started or it was cancelled. An error of the speculative
+        prediction is raised, as Predict would have raised it.
+        """
+        if self.future is not None:
+            try:
+                return self.future.result()
+            except CancelledError:
+                pass
+        return self.predict()
+
+
+def _start_speculation(name: str, predict):
+    def run():
+        with request(f"{name}_speculative"):
+            return predict()
+    return pool.submit(run, session=current_session_id(), blocking=False)
+
+
+def speculate(name: str, inputs: tuple, predict, eager: bool = True) -> Speculation:
+    """
+    Start ``predict`` on the shared pool once a tab's inputs are valid and
+    the user has changed them, so that pressing Predict only collects a
+    result that is usually ready.
+
+    Every tab runs on the first script run, so nothing is started then: a
+    tab speculates once its inputs change. With ``eager=False`` (the fare
+    calendars, which score hundreds of dates) nothing is started and
+    Predict runs the prediction itself.
+
+    The speculation is kept in the session state with the inputs it was
+    started for, and cancelled and replaced when they change. It never
+    waits for a slot of the session: when the session already has its share
+    of the pool in flight, it starts on a later run, or Predict runs the
+    prediction itself. It runs as its own request ('<name>_speculative'), so
+    its stages still show up in the metrics.
+    """
+    speculations = st.session_state.setdefault("speculative", {})
+    entry = speculations.get(name)
+    if entry is not None and entry[0] == inputs:
+        speculation = entry[1]
+        if speculation.wanted and speculation.future is None:
+            speculation.future = _start_speculation(name, speculation.predict)
+        return speculation
+
+    if entry is not None:
+        entry[1].cancel()
+    speculation = Speculation(predict, wanted=eager and entry is not None)
+    if speculation.wanted:
+        speculation.future = _start_speculation(name, predict)
+    speculations[name] = (inputs, speculation)
+    return speculation
+
+
+def remember_result(name: str, inputs: tuple, result):
+    """Keep the last prediction of a tab with the inputs it was made for."""
+    st.session_state[f"last_result_{name}"] = (inputs, result)
+
+
+def last_result(name: str, inputs: tuple):
+    """The last prediction of a tab if it was made for ``inputs``, else None."""
+    entry = st.session_state.get(f"last_result_{name}")
+    return entry[1] if entry is not None and entry[0] == inputs else None
+
+
+def show_trace(trace):
+    """Keep ``trace`` for the debug panel, redrawing the whole page if the panel is open."""
+    st.session_state["last_trace"] = trace
+    if st.session_state.get("show_timings"):
+        # Tabs are fragments, so the sidebar is only redrawn by a full rerun;
+        # the tab shows its remembered result again
+        st.rerun()
+
+
+def fare_text(fare: float, lower: float = math.nan, upper: float = math.nan) -> str:
+    """A predicted fare in markdown, followed by its interval when there is one."""
+    text = f"**:green[${fare:.2f}]**"
+    if not (math.isnan(lower) or math.isnan(upper)):
+        text += f" (likely between ${lower:.2f} and ${upper:.2f})"
+    return text
+
+
+def show_one_way_result(result):
+    """Render a one-way prediction: a fare and its interval, or a fare calendar for flexible dates."""
+    if isinstance(result, tuple):
+        st.write(f'Predicted fare for one-way trip: {fare_text(*result)}')
+    else:
+        cheapest = result.loc[result['fare'].idxmin()]
+        st.write(f"Cheapest day: **{cheapest['date']:%Y/%m/%d}** at **:green[${cheapest['fare']:.2f}]**")
+        st.altair_chart(one_way_calendar_heatmap(result), use_container_width=True)
+
+
+def show_return_result(result):
+    """Render a return prediction: the fare and interval of each leg, or a fare calendar for flexible dates."""
+    if isinstance(result, tuple):
+        depart, ret = result
+        st.write(f'Predicted fare for departing trip: {fare_text(*depart)}')
+        st.write(f'Predicted fare for returning trip: {fare_text(*ret)}')
+    else:
+        cheapest = result.loc[result['fare'].idxmin()]
+        st.write(f"Cheapest dates: **{cheapest['depart_date']:%Y/%m/%d} - {cheapest['return_date']:%Y/%m/%d}** at **:green[${cheapest['fare']:.2f}]**")
+        st.altair_chart(return_calendar_heatmap(result), use_container_width=True)
+
+
+def show_multi_city_result(result: tuple):
+    """Render a multi-city prediction and its interval."""
+    st.write(f'Predicted fare for multi-city trip: {fare_text(*result)}')
+
+
+def show_itineraries(results):
+    """Render the cheapest itineraries found by the optimizer."""
+    if results.empty:
+        st.error("💀 No itinerary matches these choices.")
+    else:
+        st.write(f"Cheapest itinerary: **{results['route'].iloc[0]}** at **:green[${results['fare'].iloc[0]:.2f}]**")
+        st.dataframe(
+            results.rename(columns={
+                'route': 'Route', 'depart_date': 'First departure', 'depart_time': 'Time',
+                'cabins': 'Cabins', 'fare': 'Fare ($)', 'total_distance': 'Distance (miles)',
+                'total_duration': 'Travel time (days)'}),
+            hide_index=True, use_container_width=True)
+
+
+def show_comparison(comparison: dict):
+    """Render the fare of every model, or *unavailable* for the ones that failed."""
+    for model_label, fare in comparison.items():
+        if isinstance(fare, Exception):
+            st.write(f"{model_label}: *unavailable*")
+        else:
+            st.write(f"{model_label}: **:green[${fare:.2f}]**")
+
+
+def default_index(options: list, code: str) -> int:
+    """Position of ``code`` in ``options``, or 0 if it is not one of them."""
+    return options.index(code) if code in options else 0
+
+
+def one_way_calendar_heatmap(calendar):
+    """Draw a one-way fare calendar as a week x weekday heatmap."""
+    calendar = calendar.assign(
+        week=calendar['date'].dt.to_period('W').dt.start_time,
+        weekday=calendar['date'].dt.day_name())
+    return alt.Chart(calendar).mark_rect().encode(
+        x=alt.X('week:T', title='Week starting', timeUnit='yearmonthdate'),
+        y=alt.Y('weekday:O', title=None, sort=weekday_order),
+        color=alt.Color('fare:Q', title='Fare ($)', scale=alt.Scale(scheme='redyellowgreen', reverse=True)),
+        tooltip=[alt.Tooltip('date:T', title='Date'), alt.Tooltip('fare:Q', title='Fare ($)', format='.2f')])
+
+
+def return_calendar_heatmap(calendar):
+    """Draw a return fare calendar as a departure x return date heatmap."""
+    return alt.Chart(calendar).mark_rect().encode(
+        x=alt.X('return_date:O', title='Return date', timeUnit='yearmonthdate'),
+        y=alt.Y('depart_date:O', title='Departure date', timeUnit='yearmonthdate'),
+        color=alt.Color('fare:Q', title='Total fare ($)', scale=alt.Scale(scheme='redyellowgreen', reverse=True)),
+        tooltip=[
+            alt.Tooltip('depart_date:T', title='Departure'),
+            alt.Tooltip('return_date:T', title='Return'),
+            alt.Tooltip('fare:Q', title='Total fare ($)', format='.2f')])
+
+
 ###############################################################################
 #
 #   PROPERTIES
 #
 ###############################################################################
 
-# Import distance data from dataset
-with open("models/distance_data.json", "r") as f:
-    distance_data = json.load(f)
+# Airport names, IATA codes and covered routes, built once per process
+airport_index = get_airport_index()
+airport_codes = airport_index.airports
 
-# Import airport names and IATA codes mapping
-with open("models/names_data.json", "r") as f:
-    names_data = json.load(f)
+# Load the multi-city network off the script thread, so the One way and Return
+# tabs are usable straight away (with the Keras runtime this also imports
+# TensorFlow)
+if WARM_UP and not MODEL_SERVER:
+    registry.warm_up([CABIN_ENCODER_NAME, NN_MODEL_NAME])
+
+# Swap retrained models in without a restart (see model_versions.py)
+if not MODEL_SERVER:
+    watch_models()
 
 # Session stateS
 if "disabled" not in st.session_state:
@@ -48,11 +262,18 @@ if "disabled" not in st.session_state:
 if "number_of_stops" not in st.session_state:
     st.session_state["number_of_stops"] = None
 
-# Parse full airport names and IATA codes
-airport_names = [f"{names_data[k]} ({k})" for k in names_data.keys()]
-
 # Define today's date for all tabs
 todays_date = datetime.datetime.today().date()
+last_bookable_date = todays_date + datetime.timedelta(days=365)
+
+# Flexible dates windows (in days either side of the chosen dates)
+ow_max_flex_days = 183
+rt_max_flex_days = 30
+weekday_order = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+# Chunks of a large itinerary search scored at once on the prediction pool,
+# as many as a session may have in flight there
+optimizer_workers = pool.per_session
 
 # Journey summary
 journey_summary = f"""
@@ -80,6 +301,7 @@ spinner_msg = "On it, just a bit more..."
 
 # Error messages
 error_same_orig_dest = "💀 Origin and destination cannot be the same!"
+error_return_date = "💀 Choose a return date."
 error_mc = "💀 The first trip's origin and the final trip's destination cannot be the same in multi-city mode."
 
 ###############################################################################
@@ -106,13 +328,15 @@ tab_one_way, tab_return, tab_multicity = st.tabs(["One way", "Return", "Multi-ci
 #
 ###############################################################################
 
-with tab_one_way:
+@st.fragment
+def one_way_tab():
     st.header("Predict a one-way ticket")
     ow_orig_dest_cols = st.columns(2)
     with ow_orig_dest_cols[0]:
-        ow_origin_airport = st.selectbox("From", airport_names, index=0)
+        ow_origin_airport = st.selectbox("From", airport_codes, index=0, format_func=airport_index.label)
     with ow_orig_dest_cols[1]:
-        ow_destination_airport = st.selectbox("To", airport_names, index=1)
+        ow_destination_airport = st.selectbox(
+            "To", airport_index.destinations(ow_origin_airport), index=0, format_func=airport_index.label)
 
     if ow_destination_airport == ow_origin_airport:
         st.error(error_same_orig_dest)
@@ -139,32 +363,89 @@ with tab_one_way:
                     help="If you choose 'Basic economy only', you can only book a 'coach' cabin.",          
                     disabled=st.session_state.disabled)
                 ow_cabin = "Coach"
+
+    ow_flex = st.toggle(
+        "Flexible dates?", key="ow_flex",
+        help="Predict the fare for every day around your chosen date and show them as a calendar.")
+    if ow_flex:
+        ow_flex_days = st.slider("Days either side", min_value=1, max_value=ow_max_flex_days, value=7, key="ow_flex_days")
     
      # Trip summary
     st.write("--------")
     st.write(journey_summary)
     summary_container = st.container(border=True)
-    summary_container.write(f"**From:** {ow_origin_airport}")
-    summary_container.write(f"**To:** {ow_destination_airport}")
-    summary_container.write(f"**Date:** {ow_dte}")
+    summary_container.write(f"**From:** {airport_index.label(ow_origin_airport)}")
+    summary_container.write(f"**To:** {airport_index.label(ow_destination_airport)}")
+    summary_container.write(f"**Date:** {ow_dte}{f' (± {ow_flex_days} days)' if ow_flex else ''}")
     summary_container.write(f"**Time:** {ow_tme}")
     summary_container.write(f"**Basic economy:** {'Yes' if ow_basic_econ else 'No'}")
     summary_container.write(f"**Cabin:** {ow_cabin}")
     summary_container.write("\n")
 
+    # Start predicting as soon as the inputs are valid, so Predict is instant
+    ow_inputs = (ow_origin_airport, ow_destination_airport, ow_dte, ow_tme, ow_cabin,
+                 ow_flex_days if ow_flex else None)
+    input_date = ow_dte.strftime('%Y-%m-%d')
+    input_time = ow_tme.strftime('%H:%M')
+    if ow_destination_airport != ow_origin_airport:
+        if ow_flex:
+            ow_future = speculate('one_way', ow_inputs, lambda: one_way_fare_calendar(
+                ow_dte, ow_flex_days, input_time, ow_origin_airport, 
+                ow_destination_airport, ow_cabin.lower(), 
+                min_date=todays_date, max_date=last_bookable_date), eager=False)
+        else:
+            ow_future = speculate('one_way', ow_inputs, lambda: tuple(map(float, predict_nohops_flight_fare(
+                input_date, input_time, ow_origin_airport, 
+                ow_destination_airport, ow_cabin.lower(), with_interval=True))))
+
     if st.button("Predict!", key="predict_one_way"):
         if ow_destination_airport == ow_origin_airport:
             st.error(error_same_orig_dest)
         else:
-            # Proceed with prediction only if multicity is not selected
-            with st.spinner(spinner_msg):
-                # Prepare input data for the prediction function
-                input_date = ow_dte.strftime('%Y-%m-%d')
-                input_time = ow_tme.strftime('%H:%M')
-                ow_predicted_fare = predict_nohops_flight_fare(
-                    input_date, input_time, ow_origin_airport, 
-                    ow_destination_airport, ow_cabin.lower())
-                st.write(f'Predicted fare for one-way trip: **:green[${ow_predicted_fare:.2f}]**')
+            with st.spinner(spinner_msg), request('one_way') as trace:
+                with span('speculative'):
+                    ow_result = ow_future.result()
+                with span('rendering'):
+                    show_one_way_result(ow_result)
+            remember_result('one_way', ow_inputs, ow_result)
+            show_trace(trace)
+    else:
+        ow_result = last_result('one_way', ow_inputs)
+        if ow_result is not None:
+            show_one_way_result(ow_result)
+
+    with st.expander("Compare models"):
+        st.caption("Predict this flight with every model at once.")
+        if st.button("Compare!", key="compare_one_way"):
+            if ow_destination_airport == ow_origin_airport:
+                st.error(error_same_orig_dest)
+            else:
+                with st.spinner(spinner_msg), request('compare') as trace:
+                    # The models are independent, so they run concurrently on the shared pool
+                    ow_comparison = pool.run({
+                        "One-way model": lambda: predict_nohops_flight_fare(
+                            input_date, input_time, ow_origin_airport, 
+                            ow_destination_airport, ow_cabin.lower()),
+                        "Return model (one leg)": lambda: predict_nohops_return_flight_fare_batch(
+                            [input_date], [input_time], [ow_origin_airport], 
+                            [ow_destination_airport], [ow_cabin.lower()])[0],
+                        "Multi-city model (one trip)": lambda: predict_neural_network(
+                            origin=ow_origin_airport, dest=ow_destination_airport, 
+                            search_date=todays_date, depart_date=ow_dte, depart_time=ow_tme, 
+                            is_basic_econ=ow_basic_econ, n_hops=1, cabins=[ow_cabin.lower()]).item(),
+                    }, session=current_session_id(), return_exceptions=True)
+                    with span('rendering'):
+                        show_comparison(ow_comparison)
+                remember_result('compare_one_way', ow_inputs + (ow_basic_econ,), ow_comparison)
+                show_trace(trace)
+        else:
+            ow_comparison = last_result('compare_one_way', ow_inputs + (ow_basic_econ,))
+            if ow_comparison is not None:
+                show_comparison(ow_comparison)
+
+
+with tab_one_way:
+    one_way_tab()
 
 
 ###############################################################################
@@ -173,13 +454,15 @@ with tab_one_way:
 #
 ###############################################################################
 
-with tab_return:
+@st.fragment
+def return_tab():
     st.header("Predict a return ticket")
     rt_orig_dest_cols = st.columns(2)
     with rt_orig_dest_cols[0]:
-        rt_origin_airport = st.selectbox("From ", airport_names, index=0)
+        rt_origin_airport = st.selectbox("From ", airport_codes, index=0, format_func=airport_index.label)
     with rt_orig_dest_cols[1]:
-        rt_destination_airport = st.selectbox("To ", airport_names, index=1)
+        rt_destination_airport = st.selectbox(
+            "To ", airport_index.destinations(rt_origin_airport), index=0, format_func=airport_index.label)
     if rt_destination_airport == rt_origin_airport:
         st.error(error_same_orig_dest)
 
@@ -217,15 +500,21 @@ with tab_return:
                                         disabled=st.session_state.disabled)
             rt_dep_cabin = "Coach"
             rt_ret_cabin = "Coach"
+
+    rt_flex = st.toggle(
+        "Flexible dates? ", key="rt_flex",
+        help="Predict the total fare for every departure and return day pair around your chosen dates and show them as a calendar.")
+    if rt_flex:
+        rt_flex_days = st.slider("Days either side ", min_value=1, max_value=rt_max_flex_days, value=3, key="rt_flex_days")
     
     # Trip summary
     st.write("--------")
     st.write(journey_summary)
     summary_container = st.container(border=True)
-    summary_container.write(f"**From:** {rt_origin_airport}")
-    summary_container.write(f"**To:** {rt_destination_airport}")
+    summary_container.write(f"**From:** {airport_index.label(rt_origin_airport)}")
+    summary_container.write(f"**To:** {airport_index.label(rt_destination_airport)}")
     if len(rt_dtes) == 2:
-        summary_container.write(f"**Dates:** {rt_dtes[0]} - {rt_dtes[1]}")
+        summary_container.write(f"**Dates:** {rt_dtes[0]} - {rt_dtes[1]}{f' (± {rt_flex_days} days)' if rt_flex else ''}")
     else:
         summary_container.write(f"**Dates:** {rt_dtes[0]} - ")
     summary_container.write(f"**Basic economy:** {'Yes' if rt_basic_econ else 'No'}")
@@ -235,25 +524,54 @@ with tab_return:
     summary_container.write(f"**Cabin (returning flight):** {rt_ret_cabin}")
     summary_container.write("\n")
     
+    # Start predicting as soon as the inputs are valid, so Predict is instant
+    rt_inputs = (rt_origin_airport, rt_destination_airport, tuple(rt_dtes), rt_dep_tme, rt_ret_tme,
+                 rt_dep_cabin, rt_ret_cabin, rt_flex_days if rt_flex else None)
+    if rt_destination_airport != rt_origin_airport and len(rt_dtes) == 2:
+        dep_input_date = rt_dtes[0].strftime('%Y-%m-%d')
+        dep_input_time = rt_dep_tme.strftime('%H:%M')
+        ret_input_date = rt_dtes[1].strftime('%Y-%m-%d')
+        ret_input_time = rt_ret_tme.strftime('%H:%M')
+        if rt_flex:
+            rt_future = speculate('return', rt_inputs, lambda: return_fare_calendar(
+                rt_dtes[0], rt_dtes[1], rt_flex_days, 
+                dep_input_time, ret_input_time, rt_origin_airport, 
+                rt_destination_airport, rt_dep_cabin.lower(), rt_ret_cabin.lower(), 
+                min_date=todays_date, max_date=last_bookable_date), eager=False)
+        else:
+            def predict_legs():
+                # Score both legs with a single model call
+                fares, lower, upper = predict_nohops_return_flight_fare_batch(
+                    [dep_input_date, ret_input_date], 
+                    [dep_input_time, ret_input_time], 
+                    [rt_origin_airport, rt_destination_airport], 
+                    [rt_destination_airport, rt_origin_airport], 
+                    [rt_dep_cabin.lower(), rt_ret_cabin.lower()], with_interval=True)
+                return tuple((float(f), float(l), float(u)) for f, l, u in zip(fares, lower, upper))
+
+            rt_future = speculate('return', rt_inputs, predict_legs)
+
     if st.button("Predict!", key="predict_return"):
         if rt_destination_airport == rt_origin_airport:
             st.error(error_same_orig_dest)
+        elif len(rt_dtes) < 2:
+            st.error(error_return_date)
         else:
-            # Proceed with prediction only if multicity is not selected
-            with st.spinner(spinner_msg):
-                # Prepare input data for the prediction function
-                dep_input_date = rt_dtes[0].strftime('%Y-%m-%d')
-                dep_input_time = rt_dep_tme.strftime('%H:%M')
-                ret_input_date = rt_dtes[1].strftime('%Y-%m-%d')
-                ret_input_time = rt_ret_tme.strftime('%H:%M')
-                rt_predicted_dep_fare = predict_nohops_return_flight_fare(
-                    dep_input_date, dep_input_time, rt_origin_airport, 
-                    rt_destination_airport, rt_dep_cabin.lower())
-                rt_predicted_ret_fare = predict_nohops_return_flight_fare(
-                    ret_input_date, ret_input_time, rt_destination_airport, 
-                    rt_origin_airport, rt_ret_cabin.lower())
-                st.write(f'Predicted fare for departing trip: **:green[${rt_predicted_dep_fare:.2f}]**')
-                st.write(f'Predicted fare for returning trip: **:green[${rt_predicted_ret_fare:.2f}]**')
+            with st.spinner(spinner_msg), request('return') as trace:
+                with span('speculative'):
+                    rt_result = rt_future.result()
+                with span('rendering'):
+                    show_return_result(rt_result)
+            remember_result('return', rt_inputs, rt_result)
+            show_trace(trace)
+    else:
+        rt_result = last_result('return', rt_inputs)
+        if rt_result is not None:
+            show_return_result(rt_result)
+
+
+with tab_return:
+    return_tab()
 
 
 ###############################################################################
@@ -261,7 +579,8 @@ with tab_return:
 #   TAB 3: MULTI-CITY
 #
 ###############################################################################
-with tab_multicity:
+@st.fragment
+def multi_city_tab():
     mc_origin_at_each_hop = []
     mc_dest_at_each_hop = []
     mc_depart_dates_at_each_hop = []
@@ -282,10 +601,12 @@ with tab_multicity:
         orig_dest_cols = st.columns(2)
         with orig_dest_cols[0]:
             mc_origin_airport = st.selectbox(
-                f"From", airport_names, index=h-1, key=f"mc_origin_trip_{h}")
+                f"From", airport_codes, index=h-1, key=f"mc_origin_trip_{h}", format_func=airport_index.label)
         with orig_dest_cols[1]:
+            mc_destinations = airport_index.destinations(mc_origin_airport)
             mc_destination_airport = st.selectbox(
-                f"To", airport_names, index=h, key=f"mc_destination_trip_{h}")
+                f"To", mc_destinations, index=default_index(mc_destinations, airport_codes[h]), 
+                key=f"mc_destination_trip_{h}", format_func=airport_index.label)
         if mc_destination_airport == mc_origin_airport:
             st.error(error_same_orig_dest)
         # Append data for summary
@@ -329,32 +650,136 @@ with tab_multicity:
     summary_container = st.container(border=True)
     for i in range(len(mc_origin_at_each_hop)):
         summary_container.subheader(f"**Trip {i+1}:**")
-        summary_container.write(f"**From:** {mc_origin_at_each_hop[i]}")
-        summary_container.write(f"**To:** {mc_dest_at_each_hop[i]}")
+        summary_container.write(f"**From:** {airport_index.label(mc_origin_at_each_hop[i])}")
+        summary_container.write(f"**To:** {airport_index.label(mc_dest_at_each_hop[i])}")
         summary_container.write(f"**Date:** {mc_depart_dates_at_each_hop[i]}")
         summary_container.write(f"**Time:** {mc_depart_times_at_each_hop[i]}")
         summary_container.write(f"**Basic economy:** {'Yes' if mc_basic_econ else 'No'}")
         summary_container.write(f"**Cabin:** {mc_cabins_at_each_hop[i]}")
         summary_container.write("\n")
     
+    trip_datetimes_validator = [
+            d.combine(mc_depart_dates_at_each_hop[i], mc_depart_times_at_each_hop[i]) < d.combine(mc_depart_dates_at_each_hop[i-1], mc_depart_times_at_each_hop[i-1]) 
+            for i in range(1, len(mc_depart_dates_at_each_hop))
+        ]
+    mc_valid = mc_origin_at_each_hop[0] != mc_dest_at_each_hop[-1] and not any(trip_datetimes_validator)
+
+    # Start predicting as soon as the inputs are valid, so Predict is instant
+    mc_inputs = (tuple(mc_origin_at_each_hop), tuple(mc_dest_at_each_hop), tuple(mc_depart_dates_at_each_hop),
+                 tuple(mc_depart_times_at_each_hop), tuple(mc_cabins_at_each_hop), mc_basic_econ)
+    if mc_valid:
+        mc_future = speculate('multi_city', mc_inputs, lambda: tuple(values.item() for values in predict_neural_network(
+            origin=mc_origin_at_each_hop[0],
+            dest=mc_dest_at_each_hop[-1], 
+            search_date=todays_date,
+            depart_date=mc_depart_dates_at_each_hop[0], 
+            depart_time=mc_depart_times_at_each_hop[0],
+            is_basic_econ=mc_basic_econ,
+            n_hops=n_hops,
+            cabins=[i.lower() for i in mc_cabins_at_each_hop],
+            with_interval=True)))
+
     if st.button("Predict!", key="predict_multicity"):
-        trip_datetimes_validator = [
-                d.combine(mc_depart_dates_at_each_hop[i], mc_depart_times_at_each_hop[i]) < d.combine(mc_depart_dates_at_each_hop[i-1], mc_depart_times_at_each_hop[i-1]) 
-                for i in range(1, len(mc_depart_dates_at_each_hop))
-            ]
         if mc_origin_at_each_hop[0] == mc_dest_at_each_hop[-1]:
             st.error(error_mc)
         elif any(trip_datetimes_validator):
             st.error(f"💀 Departure date/time of **Trip {trip_datetimes_validator.index(True)+2}** needs to be after that of **Trip {trip_datetimes_validator.index(True)+1}**.")
         else:
-            with st.spinner(spinner_msg):
-                    predicted_fare = float(predict_neural_network(
-                    origin=mc_origin_at_each_hop[0],
-                    dest=mc_dest_at_each_hop[-1], 
-                    search_date=todays_date,
-                    depart_date=mc_depart_dates_at_each_hop[0], 
-                    depart_time=mc_depart_times_at_each_hop[0],
-                    is_basic_econ=mc_basic_econ,
-                    n_hops=n_hops,
-                    cabins=[i.lower() for i in mc_cabins_at_each_hop]).item())
-            st.write(f'Predicted fare for multi-city trip: **:green[${predicted_fare:.2f}]**')
+            with request('multi_city') as trace:
+                with st.spinner(spinner_msg), span('speculative'):
+                    predicted_fare = mc_future.result()
+                with span('rendering'):
+                    show_multi_city_result(predicted_fare)
+            remember_result('multi_city', mc_inputs, predicted_fare)
+            show_trace(trace)
+    else:
+        predicted_fare = last_result('multi_city', mc_inputs)
+        if predicted_fare is not None:
+            show_multi_city_result(predicted_fare)
+
+    # Itinerary optimizer
+    st.write("--------")
+    mc_optimize = st.toggle(
+        "Find the cheapest itinerary?", key="mc_optimize",
+        help="Try every order of the cities you want to visit, every first departure date in a window and every allowed cabin, and list the cheapest itineraries.")
+    if mc_optimize:
+        opt_cols = st.columns(2)
+        with opt_cols[0]:
+            opt_origin = st.selectbox(
+                "Start from", airport_codes, index=0, key="opt_origin", format_func=airport_index.label)
+        with opt_cols[1]:
+            opt_cities = st.multiselect(
+                "Cities to visit", [a for a in airport_codes if a != opt_origin],
+                max_selections=MAX_CITIES, key="opt_cities", format_func=airport_index.label)
+        opt_date_time_cols = st.columns(2)
+        with opt_date_time_cols[0]:
+            opt_dtes = st.date_input(
+                "First departure between",
+                value=(todays_date, todays_date + datetime.timedelta(days=30)),
+                min_value=todays_date, max_value=last_bookable_date,
+                format="YYYY/MM/DD", key="opt_dates")
+        with opt_date_time_cols[1]:
+            opt_hours = st.slider("Departure hours", min_value=0, max_value=23, value=(6, 22), key="opt_hours")
+        opt_cabin_cols = st.columns(2)
+        with opt_cabin_cols[0]:
+            opt_cabins = st.multiselect(
+                "Cabins allowed", ("Coach", "Premium coach", "Business", "First"),
+                default=["Coach"], key="opt_cabins", disabled=mc_basic_econ,
+                help="Basic economy (set above) only allows the 'Coach' cabin.")
+        with opt_cabin_cols[1]:
+            opt_top_k = st.number_input("Itineraries to show", min_value=1, max_value=50, value=10, key="opt_top_k")
+
+        opt_inputs = (opt_origin, tuple(opt_cities), tuple(opt_dtes), opt_hours, tuple(opt_cabins),
+                      opt_top_k, mc_basic_econ)
+        if st.button("Optimize!", key="optimize_multicity"):
+            if not opt_cities:
+                st.error("💀 Choose at least one city to visit.")
+            elif len(opt_dtes) != 2:
+                st.error("💀 Choose the last possible departure date too.")
+            elif not opt_cabins and not mc_basic_econ:
+                st.error("💀 Allow at least one cabin.")
+            else:
+                with request('multi_city_optimizer') as trace:
+                    with st.spinner(spinner_msg):
+                        opt_results = optimize_itineraries(
+                            origin=opt_origin,
+                            cities=opt_cities,
+                            first_departure=opt_dtes[0],
+                            last_departure=opt_dtes[1],
+                            search_date=todays_date,
+                            depart_times=[datetime.time(h, 0) for h in range(opt_hours[0], opt_hours[1] + 1)],
+                            cabins=[c.lower() for c in opt_cabins],
+                            is_basic_econ=mc_basic_econ,
+                            top_k=opt_top_k,
+                            workers=optimizer_workers,
+                            session=current_session_id())
+                    with span('rendering'):
+                        show_itineraries(opt_results)
+                remember_result('multi_city_optimizer', opt_inputs, opt_results)
+                show_trace(trace)
+        else:
+            opt_results = last_result('multi_city_optimizer', opt_inputs)
+            if opt_results is not None:
+                show_itineraries(opt_results)
+
+
+with tab_multicity:
+    multi_city_tab()
+
+
+###############################################################################
+#
+#   DEBUG PANEL
+#
+###############################################################################
+
+with st.sidebar:
+    if st.toggle("Show timings", key="show_timings", help="Show how long each stage of the last prediction took."):
+        last_trace = st.session_state.get("last_trace")
+        if last_trace is None:
+            st.caption("Press Predict! to time a request.")
+        else:
+            st.write(f"**Last request:** {last_trace.path} in {last_trace.total_seconds * 1000:.1f} ms")
+            st.dataframe(
+                [{"Stage": stage, "Time (ms)": round(seconds * 1000, 3)} for stage, seconds in last_trace.spans],
+                hide_index=True, use_container_width=True)
@@ -0,0 +1,253 @@
+"""
+Micro-batching of single predictions across sessions.
+
+When many sessions press "Predict!" at nearly the same moment, each would
+run its own one-row model call. A ``MicroBatcher`` sits in front of a batch
+predictor instead: callers submit their rows and wait, while one dispatcher
+thread per predictor collects the requests that arrive within a short window
+(``AIRFARE_BATCH_WINDOW_MS``, default 2 ms) or until ``AIRFARE_MAX_BATCH_SIZE``
+rows, scores them with one call and hands every caller its own rows back.
+Requests that arrive while a batch is being scored form the next batch, so
+under load batches grow without waiting for the window. A request arriving
+while no other is queued or being scored is scored straight away on its
+caller's thread, so a lone user never waits for the window.
+
+A latency SLO (``AIRFARE_LATENCY_SLO_MS``, default 100 ms) guards the
+waiting:
+
+- a batch is dispatched before its window ends if waiting longer would make
+  its oldest request miss the SLO, given how long recent batches took;
+- a request that would still miss it, because of the batches already
+  queued ahead of it, skips the queue and is scored on the caller's thread.
+
+Each batcher records, under its name, the queue depth seen by every request
+('batch_queue_depth'), the rows of every batch ('batch_size'), how long
+requests waited ('batch_wait_seconds') and the requests that bypassed the
+queue ('batch_slo_bypass'), all exported on ``/metrics``. The batches
+themselves are traced as '<name>_batch' requests.
+
+Once a batcher has scored its first rows, a caller waits at most
+``TIMEOUT_SLOS`` times the SLO for its batch and then gets a
+``TimeoutError``, so a stuck batch fails requests instead of hanging them.
+Until then the predictor may still be loading its model (or the fare cube)
+and callers wait for it however long it takes.
+
+Set ``AIRFARE_BATCH_WINDOW_MS=0`` to score every request on its caller's
+thread.
+"""
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from instrumentation import count, observe, request
+
+BATCH_WINDOW_MS = float(os.environ.get('AIRFARE_BATCH_WINDOW_MS', 2))
+MAX_BATCH_SIZE = int(os.environ.get('AIRFARE_MAX_BATCH_SIZE', 256))
+LATENCY_SLO_MS = float(os.environ.get('AIRFARE_LATENCY_SLO_MS', 100))
+
+# Longest wait for a batch result, in multiples of the SLO
+TIMEOUT_SLOS = 100
+
+# Weight of the last batch in the running estimate of a batch's duration
+_SMOOTHING = 0.2
+
+
+class _Request:
+    __slots__ = ('columns', 'rows', 'enqueued', 'future')
+
+    def __init__(self, columns: tuple, rows: int):
+        self.columns = columns
+        self.rows = rows
+        self.enqueued = time.perf_counter()
+        self.future = Future()
+
+
+def _split(result, offsets):
+    # Rows of every request in the batch result, an array or a tuple of arrays
+    if isinstance(result, tuple):
+        return list(zip(*(_split(values, offsets) for values in result)))
+    return [result[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent calls of a columnar batch predictor.
+
+    Parameters
+    ----------
+    name : str
+        Name of the batcher in the metrics (e.g. 'one_way').
+    predict : callable
+        Batch predictor taking one list per column and returning an array
+        with one value per row, or a tuple of such arrays.
+    window_ms : float
+        Longest time the first request of a batch waits for others.
+    max_batch_size : int
+        Most rows in a batch (a larger request is scored alone).
+    slo_ms : float
+        Latency every request should stay under.
+    """
+
+    def __init__(self, name: str, predict, window_ms: float = BATCH_WINDOW_MS,
+                 max_batch_size: int = MAX_BATCH_SIZE, slo_ms: float = LATENCY_SLO_MS):
+        self.name = name
+        self.predict = predict
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.slo = slo_ms / 1000
+        self.timeout = TIMEOUT_SLOS * self.slo
+        self._reset()
+        # A forked child (e.g. an optimizer or model server worker) starts
+        # with an empty queue and its own dispatcher
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._queue = []
+        self._queued_rows = 0
+        self._busy = False
+        self._inline = 0
+        self._batch_seconds = 0.0
+        # Whether the predictor has succeeded once, i.e. is past its cold load
+        self._warm = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def submit(self, *columns):
+        """
+        Queue the rows given by ``columns`` (one list per column) and return
+        a Future of their part of the batch result.
+        """
+        rows = len(columns[0])
+        if self.window <= 0 or rows >= self.max_batch_size:
+            return self._run_inline(columns)
+
+        with self._cond:
+            idle = not self._queue and not self._busy and not self._inline
+            # Batches of the queue ahead of this request, plus the one running
+            ahead = -(-(self._queued_rows + rows) // self.max_batch_size) + self._busy
+            bypass = not idle and ahead * self._batch_seconds > self.slo
+            if idle or bypass:
+                self._inline += 1
+            else:
+                observe('batch_queue_depth', len(self._queue), path=self.name)
+                pending = _Request(columns, rows)
+                self._queue.append(pending)
+                self._queued_rows += rows
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._dispatch, name=f'batch-{self.name}', daemon=True)
+                    self._thread.start()
+                self._cond.notify()
+                return pending.future
+
+        if bypass:
+            count('batch_slo_bypass', path=self.name)
+        try:
+            return self._run_inline(columns)
+        finally:
+            with self._cond:
+                self._inline -= 1
+
+    def __call__(self, *columns):
+        """
+        Score the rows given by ``columns`` and wait for the result, at most
+        ``self.timeout`` seconds once the predictor is warm.
+        """
+        future = self.submit(*columns)
+        try:
+            return future.result(self.timeout if self._warm else None)
+        except TimeoutError:
+            # Not scored later for nobody if it is still queued
+            with self._cond:
+                for i, pending in enumerate(self._queue):
+                    if pending.future is future:
+                        del self._queue[i]
+                        self._queued_rows -= pending.rows
+                        break
+            raise TimeoutError(f"No {self.name} prediction within {self.timeout:.1f} s") from None
+
+    def _run_inline(self, columns) -> Future:
+        future = Future()
+        try:
+            future.set_result(self.predict(*columns))
+            self._warm = True
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _next_batch(self) -> list:
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+            # Wait for more requests until the window ends, the batch is
+            # full or the oldest request would miss the SLO
+            first = self._queue[0].enqueued
+            deadline = min(first + self.window, first + self.slo - self._batch_seconds)
+            while self._queued_rows < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                self._cond.wait(timeout)
+
+            batch, rows = [], 0
+            while self._queue and (not batch or rows + self._queue[0].rows <= self.max_batch_size):
+                pending = self._queue.pop(0)
+                batch.append(pending)
+                rows += pending.rows
+            self._queued_rows -= rows
+            self._busy = True
+            return batch
+
+    def _dispatch(self):
+        try:
+            while True:
+                batch = self._next_batch()
+                start = time.perf_counter()
+                try:
+                    self._score(batch)
+                except BaseException as e:
+                    # Whatever failed, no caller is left waiting on this batch
+                    for pending in batch:
+                        if not pending.future.done():
+                            pending.future.set_exception(e)
+                    if not isinstance(e, Exception):
+                        raise
+                finally:
+                    elapsed = time.perf_counter() - start
+                    with self._cond:
+                        self._busy = False
+                        self._batch_seconds += _SMOOTHING * (elapsed - self._batch_seconds)
+        finally:
+            # The next request starts a new dispatcher
+            with self._cond:
+                self._thread = None
+
+    def _score(self, batch: list):
+        for pending in batch:
+            observe('batch_wait_seconds', time.perf_counter() - pending.enqueued, path=self.name)
+        observe('batch_size', sum(pending.rows for pending in batch), path=self.name)
+
+        columns = [[value for pending in batch for value in pending.columns[i]]
+                   for i in range(len(batch[0].columns))]
+        try:
+            with request(f'{self.name}_batch'):
+                result = self.predict(*columns)
+            self._warm = True
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].future.set_exception(e)
+                return
+            # Score every request alone, so one invalid request (e.g. an
+            # unknown airport) does not fail the others
+            for pending in batch:
+                try:
+                    pending.future.set_result(self.predict(*pending.columns))
+                except Exception as e:
+                    pending.future.set_exception(e)
+            return
+
+        offsets = np.cumsum([0] + [pending.rows for pending in batch])
+        for pending, rows in zip(batch, _split(result, offsets)):
+            pending.future.set_result(rows)
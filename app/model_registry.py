@@ -0,0 +1,370 @@
+import ctypes
+import gc
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+from joblib import load
+
+from startup import timed
+
+
+###############################################################################
+#
+#   LOADERS
+#
+###############################################################################
+
+MODELS_DIR = 'models'
+
+# Maps an artifact name to the versioned file that currently serves it (see
+# model_versions.py); artifacts not listed are read from models/<name>
+MANIFEST_FILE = 'manifest.json'
+
+# Dummy predictions run on a new version before it is swapped in
+WARM_UP_RUNS = 3
+
+logger = logging.getLogger(__name__)
+
+
+def _load_joblib(path: str):
+    return load(path)
+
+
+def _load_keras(path: str):
+    # Imported here so that processes which never touch the neural network do
+    # not pay for TensorFlow
+    with timed('import tensorflow'):
+        from tensorflow import keras
+    return keras.models.load_model(path)
+
+
+def _load_npz(path: str):
+    # Flattened tree ensembles are tagged, anything else is a NumPy network
+    import numpy as np
+    with np.load(path) as data:
+        is_trees = 'format' in data.files and str(data['format']) == 'trees'
+    if is_trees:
+        from tree_runtime import TreeEnsemble
+        return TreeEnsemble.load(path)
+    from nn_runtime import load_network
+    return load_network(path)
+
+
+LOADERS = {
+    '.joblib': _load_joblib,
+    '.keras': _load_keras,
+    '.npz': _load_npz,
+}
+
+
+###############################################################################
+#
+#   REGISTRY
+#
+###############################################################################
+
+def _fingerprint(file_stat: os.stat_result) -> str:
+    return f"{file_stat.st_mtime_ns}-{file_stat.st_size}"
+
+
+def _release_memory():
+    # Hand the pages freed by a swapped-out model back to the OS (glibc only)
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of the model artifacts stored in ``models/``.
+
+    Each artifact is deserialized once on first request and the loaded object
+    is handed out to every caller afterwards. Loads are serialized per
+    artifact, so concurrent Streamlit sessions asking for the same model wait
+    for a single load instead of racing each other.
+
+    When ``manifest.json`` in the models folder lists an artifact, its name
+    resolves to the versioned file the manifest points to. `swap` replaces a
+    loaded artifact with the file as it is now, loading and warming it up
+    while the old one keeps serving.
+
+    Parameters
+    ----------
+    models_dir : str
+        Folder containing the artifacts (default: 'models').
+    loaders : dict
+        Mapping of file extension to a callable taking a path and returning the
+        loaded object (default: joblib for '.joblib', Keras for '.keras' and
+        the NumPy network or tree runtime for '.npz').
+    """
+
+    def __init__(self, models_dir: str = MODELS_DIR, loaders: dict = None):
+        self.models_dir = models_dir
+        self.loaders = dict(LOADERS if loaders is None else loaders)
+        self._models = {}
+        self._versions = {}
+        self._stats = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._warm_ups = {}
+        self._manifest = (None, {})
+
+    def manifest(self) -> dict:
+        """Return the manifest of the models folder (empty without one), re-read when it changes."""
+        path = os.path.join(self.models_dir, MANIFEST_FILE)
+        try:
+            version = _fingerprint(os.stat(path))
+        except FileNotFoundError:
+            return {}
+        if self._manifest[0] != version:
+            with open(path) as f:
+                self._manifest = (version, json.load(f))
+        return self._manifest[1]
+
+    def path(self, name: str) -> str:
+        """Return the path of the artifact ``name`` (its current version if the manifest lists it)."""
+        entry = self.manifest().get(name)
+        if entry is not None:
+            return os.path.join(self.models_dir, entry['path'])
+        return os.path.join(self.models_dir, name)
+
+    def get(self, name: str):
+        """
+        Return the loaded artifact ``name``, loading it on the first call.
+
+        Raises
+        ------
+        FileNotFoundError
+            If the artifact does not exist in the models folder.
+        ValueError
+            If there is no loader registered for the artifact's extension.
+        """
+        model = self._models.get(name)
+        if model is not None:
+            self._count(name, 'hits')
+            return model
+        with self._name_lock(name):
+            # Another thread may have finished loading while we were waiting
+            model = self._models.get(name)
+            if model is not None:
+                self._count(name, 'hits')
+                return model
+            self._count(name, 'misses')
+            return self._load(name)
+
+    def get_with_version(self, name: str) -> tuple:
+        """Return the loaded artifact ``name`` and its version, read together (see `get`)."""
+        while True:
+            model = self.get(name)
+            with self._lock:
+                if self._models.get(name) is model:
+                    return model, self._versions[name]
+
+    def reload(self, name: str):
+        """Load ``name`` again from disk, replacing the cached object."""
+        with self._name_lock(name):
+            return self._load(name)
+
+    def register_warm_up(self, name: str, warm_up):
+        """
+        Run ``warm_up(model)`` on every new version of ``name`` before `swap`
+        hands it out, e.g. a dummy prediction that builds the model's graph.
+        """
+        self._warm_ups[name] = warm_up
+
+    def stale(self) -> list:
+        """Names of the loaded artifacts whose file has changed (or moved to a new version) since."""
+        with self._lock:
+            versions = dict(self._versions)
+        return [name for name, version in versions.items() if self.file_version(name) not in (None, version)]
+
+    def swap(self, name: str):
+        """
+        Load the artifact ``name`` as it is on disk now and replace the loaded
+        one with it.
+
+        Callers keep getting the old object while the new one loads and is
+        warmed up (see `register_warm_up`); requests already holding the old
+        one finish with it, and its memory is released once the last of them
+        drops it. If the load or the warm-up fails, the old one stays.
+        Loads of ``name`` by `get` and `reload` wait for the swap.
+        """
+        # Serialized with `_load`, so a concurrent reload or first load of
+        # the same artifact cannot put the old version back
+        with self._name_lock(name):
+            path = self.path(name)
+            extension = os.path.splitext(name)[1]
+            if extension not in self.loaders:
+                raise ValueError(f"No loader registered for '{extension}' files")
+            file_stat = os.stat(path)
+            start = time.perf_counter()
+            model = self.loaders[extension](path)
+            warm_up = self._warm_ups.get(name)
+            if warm_up is not None:
+                for _ in range(WARM_UP_RUNS):
+                    warm_up(model)
+            elapsed = time.perf_counter() - start
+
+            with self._lock:
+                old = self._models.get(name)
+                self._models[name] = model
+                self._versions[name] = _fingerprint(file_stat)
+                counters = self._counters(name)
+                counters['loads'] += 1
+                counters['swaps'] += 1
+                counters['last_load_seconds'] = elapsed
+                counters['total_load_seconds'] += elapsed
+        if old is not None:
+            try:
+                weakref.finalize(old, _release_memory)
+            except TypeError:
+                pass
+            del old
+            gc.collect()
+        logger.info("Swapped in %s (%s) in %.1fs", name, path, elapsed)
+        return model
+
+    def evict(self, name: str = None):
+        """Drop ``name`` from the cache, or every artifact when ``name`` is None."""
+        with self._lock:
+            names = list(self._models) if name is None else [name]
+            for n in names:
+                self._models.pop(n, None)
+                self._versions.pop(n, None)
+                if n in self._stats:
+                    self._stats[n]['evictions'] += 1
+
+    def warm_up(self, names, background: bool = True):
+        """
+        Load every artifact in ``names`` that is not loaded yet.
+
+        With ``background=True`` the loads run on a daemon thread, which is
+        returned, so the caller can keep serving while heavy frameworks are
+        imported. Missing artifacts are skipped.
+        """
+        names = [name for name in names if not self.is_loaded(name)]
+
+        def load_all():
+            for name in names:
+                try:
+                    self.get(name)
+                except (FileNotFoundError, ValueError):
+                    pass
+
+        if not names or not background:
+            load_all()
+            return None
+        thread = threading.Thread(target=load_all, name='model-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def version(self, name: str) -> str:
+        """
+        Return a fingerprint of the artifact file ``name`` as it was when last
+        loaded (modification time and size), or None if it is not loaded.
+        """
+        return self._versions.get(name)
+
+    def file_version(self, name: str) -> str:
+        """
+        Return the fingerprint of the artifact file ``name`` as it is on disk
+        now, without loading it, or None if the file does not exist.
+        """
+        try:
+            return _fingerprint(os.stat(self.path(name)))
+        except FileNotFoundError:
+            return None
+
+    def stats(self) -> dict:
+        """
+        Return a snapshot of the counters for every artifact requested so far.
+
+        Returns
+        -------
+        dict
+            Artifact name mapped to a dict with the keys 'hits', 'misses',
+            'loads', 'swaps', 'evictions', 'last_load_seconds',
+            'total_load_seconds' and 'loaded'.
+        """
+        with self._lock:
+            return {
+                name: {**counters, 'loaded': name in self._models}
+                for name, counters in self._stats.items()
+            }
+
+    def _load(self, name: str):
+        path = self.path(name)
+        extension = os.path.splitext(name)[1]
+        if extension not in self.loaders:
+            raise ValueError(f"No loader registered for '{extension}' files")
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"Model file not found: {path}")
+        file_stat = os.stat(path)
+        start = time.perf_counter()
+        model = self.loaders[extension](path)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._models[name] = model
+            self._versions[name] = _fingerprint(file_stat)
+            counters = self._counters(name)
+            counters['loads'] += 1
+            counters['last_load_seconds'] = elapsed
+            counters['total_load_seconds'] += elapsed
+        return model
+
+    def _name_lock(self, name: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def _counters(self, name: str) -> dict:
+        return self._stats.setdefault(name, {
+            'hits': 0,
+            'misses': 0,
+            'loads': 0,
+            'swaps': 0,
+            'evictions': 0,
+            'last_load_seconds': 0.0,
+            'total_load_seconds': 0.0,
+        })
+
+    def _count(self, name: str, key: str):
+        with self._lock:
+            self._counters(name)[key] += 1
+
+
+# Shared by all predictors in the process
+registry = ModelRegistry()
+
+
+def get_model(name: str):
+    """
+    Return the artifact ``name`` from the shared registry.
+
+    The errors raised match the ones the predictors have always surfaced: a
+    missing file raises FileNotFoundError, anything else going wrong while
+    deserializing raises RuntimeError.
+    """
+    try:
+        return registry.get(name)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Model file not found")
+    except Exception as e:
+        raise RuntimeError(f"An error occurred while loading the model: {e}")
+
+
+def get_model_with_version(name: str) -> tuple:
+    """Like `get_model`, also returning the version of the artifact handed out."""
+    try:
+        return registry.get_with_version(name)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Model file not found")
+    except Exception as e:
+        raise RuntimeError(f"An error occurred while loading the model: {e}")
@@ -0,0 +1,477 @@
+"""
+Pre-fork model server.
+
+Every Streamlit process (and every prediction service) normally loads its own
+copy of the XGBoost pipelines, the network and the lookup tables. This server
+loads them once in a parent process, freezes the garbage collector so that
+collections do not write to the pages holding those objects, then forks
+inference workers. The workers share the parent's pages copy-on-write: the
+model weights, fare cubes and route tables are only read, so they stay in
+memory once however many workers run.
+
+Workers accept connections on a Unix socket and run the predictors named in
+``FUNCTIONS`` for the clients, one request at a time each. A worker that dies
+is forked again from the parent, which still holds the loaded models.
+
+The parent also checks the models for new versions (see model_versions.py)
+from its main loop. When it has swapped one in, it forks fresh workers
+sharing it and stops the old ones, each once it has finished its current
+request. The parent runs no other thread, so a fork never copies a lock
+held by one (in logging, the registry or the instrumentation) into the
+workers.
+
+Run from the repository root (model paths are relative to it):
+
+    python app/model_server.py [--socket /tmp/airfare-model-server.sock] [--workers 4]
+
+then point the app or the HTTP service at it:
+
+    AIRFARE_MODEL_SERVER=/tmp/airfare-model-server.sock streamlit run app/main.py
+    python app/service.py --model-server /tmp/airfare-model-server.sock
+
+``python app/model_server.py --report`` prints the resident (RSS), shared
+and proportional (PSS) memory of the parent and of every worker.
+
+The Keras network cannot be shared this way (TensorFlow does not survive a
+fork), so with ``AIRFARE_NN_RUNTIME=keras`` each worker loads its own copy on
+first use.
+"""
+import argparse
+import functools
+import gc
+import importlib
+import logging
+import os
+import select
+import signal
+import sys
+import time
+from multiprocessing import Array
+from multiprocessing.connection import Client, Listener
+
+from instrumentation import span
+
+# Socket of the model server the app and the service send their predictions
+# to; unset to predict in-process
+MODEL_SERVER = os.environ.get('AIRFARE_MODEL_SERVER')
+
+SOCKET_PATH = MODEL_SERVER or '/tmp/airfare-model-server.sock'
+BACKLOG = 128
+
+# Functions the workers run for clients, by name
+FUNCTIONS = {
+    'predict_nohops_flight_fare': ('predict_nohops', 'predict_nohops_flight_fare'),
+    'predict_nohops_flight_fare_batch': ('predict_nohops', 'predict_nohops_flight_fare_batch'),
+    'predict_nohops_return_flight_fare_batch': ('predict_nohops_return', 'predict_nohops_return_flight_fare_batch'),
+    'predict_neural_network': ('predict_withhops', 'predict_neural_network'),
+    'predict_neural_network_batch': ('predict_withhops', 'predict_neural_network_batch'),
+    'one_way_fare_calendar': ('fare_calendar', 'one_way_fare_calendar'),
+    'return_fare_calendar': ('fare_calendar', 'return_fare_calendar'),
+    'optimize_itineraries': ('itinerary_optimizer', 'optimize_itineraries'),
+    'score_one_way': ('service', 'score_one_way'),
+    'score_return': ('service', 'score_return'),
+    'score_multi_city': ('service', 'score_multi_city'),
+    'memory_report': ('model_server', 'memory_report'),
+}
+
+logger = logging.getLogger(__name__)
+
+# PIDs of the workers by slot, in memory shared with them (set before forking)
+_worker_pids = None
+
+# In a worker: whether it is serving a connection, and whether it was asked to stop
+_busy = False
+_stopping = False
+
+
+###############################################################################
+#
+#   MEMORY
+#
+###############################################################################
+
+def process_memory(pid: int) -> dict:
+    """
+    Memory of process ``pid`` in bytes, from ``/proc/<pid>/smaps_rollup``.
+
+    Returns
+    -------
+    dict
+        'pid', 'rss' (resident), 'pss' (resident with shared pages divided
+        among the processes sharing them), 'shared' and 'private'; the sizes
+        are None where /proc is not available.
+    """
+    fields = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                value = value.split()
+                if len(value) == 2 and value[1] == 'kB':
+                    fields[key] = int(value[0]) * 1024
+    except OSError:
+        pass
+
+    def total(*keys):
+        return sum(fields[key] for key in keys) if all(key in fields for key in keys) else None
+
+    return {
+        'pid': pid,
+        'rss': fields.get('Rss'),
+        'pss': fields.get('Pss'),
+        'shared': total('Shared_Clean', 'Shared_Dirty'),
+        'private': total('Private_Clean', 'Private_Dirty'),
+    }
+
+
+def memory_report() -> list:
+    """
+    Memory of the server's parent and of every worker.
+
+    Runs in a worker, which finds its siblings in the PID table shared by the
+    parent.
+
+    Returns
+    -------
+    list of dict
+        `process_memory` of each process with its 'role' ('parent' or
+        'worker').
+    """
+    rows = [{'role': 'parent', **process_memory(os.getppid())}]
+    rows += [{'role': 'worker', **process_memory(pid)} for pid in _worker_pids or () if pid]
+    return rows
+
+
+def format_memory_report(rows: list) -> str:
+    def mib(value):
+        return f"{value / 2 ** 20:.1f}" if value is not None else 'n/a'
+
+    lines = [f"{'role':<8}{'pid':>8}{'rss MiB':>10}{'shared MiB':>12}{'private MiB':>13}{'pss MiB':>10}"]
+    for row in rows:
+        lines.append(f"{row['role']:<8}{row['pid']:>8}{mib(row['rss']):>10}{mib(row['shared']):>12}"
+                     f"{mib(row['private']):>13}{mib(row['pss']):>10}")
+    rss = [row['rss'] for row in rows]
+    pss = [row['pss'] for row in rows]
+    if None not in rss and None not in pss:
+        lines.append(f"Sum of RSS {sum(rss) / 2 ** 20:.1f} MiB, actually used (sum of PSS) {sum(pss) / 2 ** 20:.1f} MiB")
+    return '\n'.join(lines)
+
+
+###############################################################################
+#
+#   CLIENT
+#
+###############################################################################
+
+class ModelServerClient:
+    """
+    Runs the ``FUNCTIONS`` of a model server as if they were local.
+
+    Every call opens its own connection, so calls from several threads run on
+    different workers at the same time.
+
+    Parameters
+    ----------
+    path : str
+        Socket of the server.
+    """
+
+    def __init__(self, path: str = SOCKET_PATH):
+        self.path = path
+
+    def call(self, name: str, *args, **kwargs):
+        """
+        Run ``FUNCTIONS[name](*args, **kwargs)`` on a worker and return its result.
+
+        Exceptions raised by the function are raised again here.
+
+        Raises
+        ------
+        ConnectionError
+            If the server is not running.
+        """
+        with span('model_server'):
+            try:
+                status, value = self._request(name, args, kwargs)
+            except (EOFError, ConnectionResetError):
+                # The worker stopped (e.g. replaced by a new model version)
+                # before answering; predictions can safely be retried
+                status, value = self._request(name, args, kwargs)
+        if status == 'error':
+            raise value
+        return value
+
+    def _request(self, name: str, args, kwargs) -> tuple:
+        try:
+            conn = Client(self.path, family='AF_UNIX')
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise ConnectionError(f"Model server is not running at {self.path}") from e
+        with conn:
+            conn.send((name, args, kwargs))
+            return conn.recv()
+
+    def function(self, name: str):
+        """Return a callable running ``name`` on the server."""
+        return functools.partial(self.call, name)
+
+    def memory_report(self) -> list:
+        return self.call('memory_report')
+
+
+###############################################################################
+#
+#   WORKERS
+#
+###############################################################################
+
+def _resolve(name: str):
+    if name not in FUNCTIONS:
+        raise ValueError(f"Unknown function: {name}")
+    module, attribute = FUNCTIONS[name]
+    return getattr(importlib.import_module(module), attribute)
+
+
+def _handle(conn):
+    # Serve the requests of one connection until the client closes it
+    while True:
+        try:
+            name, args, kwargs = conn.recv()
+        except EOFError:
+            return
+        try:
+            reply = ('ok', _resolve(name)(*args, **kwargs))
+        except Exception as e:
+            logger.debug("%s failed", name, exc_info=True)
+            reply = ('error', e)
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # The result (or the exception) could not be pickled
+            conn.send(('error', RuntimeError(f"{name} returned an unpicklable result: {e!r}")))
+
+
+def _stop_worker(signum, frame):
+    # Stop now if idle, else once the current connection is served
+    global _stopping
+    if not _busy:
+        os._exit(0)
+    _stopping = True
+
+
+def _worker(listener):
+    global _busy
+    # The parent handles Ctrl+C and stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _stop_worker)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.set_wakeup_fd(-1)
+    while not _stopping:
+        try:
+            conn = listener.accept()
+        except OSError:
+            continue
+        _busy = True
+        with conn:
+            try:
+                _handle(conn)
+            except (OSError, EOFError):
+                pass
+        _busy = False
+
+
+def _fork_worker(listener, slot: int) -> int:
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            _worker(listener)
+        except BaseException:
+            logger.exception("Worker %d crashed", slot)
+            status = 1
+        finally:
+            # Skip the parent's exit handlers, which would remove the socket
+            os._exit(status)
+    return pid
+
+
+###############################################################################
+#
+#   PARENT
+#
+###############################################################################
+
+def preload():
+    """Import every module in ``FUNCTIONS`` and load the artifacts and tables they use."""
+    for module, _ in FUNCTIONS.values():
+        importlib.import_module(module)
+
+    import predict_nohops
+    import predict_nohops_return
+    import predict_withhops
+    from airport_index import get_airport_index
+    from fare_cube import get_fare_cube
+    from fare_intervals import get_interval_table
+    from model_registry import registry
+    from route_table import get_route_table
+
+    names = [predict_nohops.LIVE_MODEL_NAME, predict_nohops_return.LIVE_MODEL_NAME,
+             predict_withhops.CABIN_ENCODER_NAME, predict_withhops.NETWORK_NAME]
+    for name in names:
+        if name.endswith('.keras'):
+            logger.warning("%s is loaded by each worker, TensorFlow cannot be shared across a fork", name)
+            continue
+        try:
+            registry.get(name)
+        except FileNotFoundError:
+            logger.warning("Model %s not found, its predictions will fail", name)
+    for name in (predict_nohops.MODEL_NAME, predict_nohops_return.MODEL_NAME):
+        get_fare_cube(name)
+    for name in (predict_nohops.MODEL_NAME, predict_nohops_return.MODEL_NAME, predict_withhops.NETWORK_NAME):
+        get_interval_table(name)
+    get_airport_index()
+    get_route_table()
+
+
+def _replace_workers(listener):
+    # Fork workers sharing the models as they are now, then stop the old ones
+    gc.unfreeze()
+    gc.collect()
+    gc.freeze()
+    for slot, old in enumerate(list(_worker_pids)):
+        _worker_pids[slot] = _fork_worker(listener, slot)
+        try:
+            os.kill(old, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    logger.info("Replaced the %d workers with ones serving the new models", len(_worker_pids))
+
+
+def _restart_exited_workers(listener):
+    # Reap every exited child, forking again the workers still in a slot
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        pids = list(_worker_pids)
+        if pid in pids:
+            slot = pids.index(pid)
+            logger.warning("Worker %d (pid %d) exited with status %d, restarting it", slot, pid, status)
+            _worker_pids[slot] = _fork_worker(listener, slot)
+
+
+def _check_models(watcher, listener):
+    try:
+        swapped = watcher.check()
+    except Exception:
+        logger.exception("Model check failed")
+        return
+    if swapped:
+        _replace_workers(listener)
+
+
+def _listen(path: str) -> Listener:
+    if os.path.exists(path):
+        try:
+            Client(path, family='AF_UNIX').close()
+        except OSError:
+            # Left behind by a server that did not shut down cleanly
+            os.unlink(path)
+        else:
+            raise RuntimeError(f"A model server is already running at {path}")
+    previous_umask = os.umask(0o077)
+    try:
+        return Listener(path, family='AF_UNIX', backlog=BACKLOG)
+    finally:
+        os.umask(previous_umask)
+
+
+def serve(path: str = SOCKET_PATH, workers: int = None):
+    """
+    Load the models, fork ``workers`` processes serving ``path`` and keep
+    them running until interrupted.
+    """
+    global _worker_pids
+    workers = workers or os.cpu_count() or 1
+
+    start = time.perf_counter()
+    preload()
+    # Objects that survived until now are never collected, so collections in
+    # the workers do not touch (and copy) their pages
+    gc.collect()
+    gc.freeze()
+    logger.info("Models loaded in %.1fs", time.perf_counter() - start)
+
+    listener = _listen(path)
+    _worker_pids = Array('i', workers, lock=False)
+    for slot in range(workers):
+        _worker_pids[slot] = _fork_worker(listener, slot)
+    logger.info("Model server listening on %s with %d workers", path, workers)
+
+    # Checked from this loop rather than a watcher thread, so that every
+    # fork happens in a single-threaded process
+    from model_versions import WATCH_SECONDS, ModelWatcher
+    watcher = ModelWatcher(interval=WATCH_SECONDS) if WATCH_SECONDS > 0 else None
+    next_check = time.monotonic() + WATCH_SECONDS
+
+    # An exiting worker wakes the loop through the signal wakeup pipe
+    wakeup, wakeup_write = os.pipe()
+    os.set_blocking(wakeup, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while True:
+            timeout = max(0.0, next_check - time.monotonic()) if watcher is not None else None
+            if select.select([wakeup], [], [], timeout)[0]:
+                try:
+                    while os.read(wakeup, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+            _restart_exited_workers(listener)
+            if watcher is not None and time.monotonic() >= next_check:
+                _check_models(watcher, listener)
+                next_check = time.monotonic() + watcher.interval
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for pid in _worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        listener.close()
+
+
+###############################################################################
+#
+#   ENTRY POINT
+#
+###############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the fare models to local clients from pre-forked workers")
+    parser.add_argument('--socket', default=SOCKET_PATH, help=f"Unix socket to listen on (default: {SOCKET_PATH})")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Inference processes")
+    parser.add_argument('--report', action='store_true', help="Print the memory of a running server and exit")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.report:
+        print(format_memory_report(ModelServerClient(args.socket).memory_report()))
+        return
+    # One inference thread per worker, the workers are the parallelism
+    os.environ.setdefault('OMP_NUM_THREADS', '1')
+    serve(args.socket, args.workers)
+
+
+if __name__ == '__main__':
+    # Run through the importable module so the workers' function table and
+    # PID table are the ones `memory_report` reads
+    from model_server import main
+    main()
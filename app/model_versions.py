@@ -0,0 +1,257 @@
+"""
+Versioned model artifacts and hot-swapping.
+
+Publishing a retrained artifact copies it to
+``models/versions/<artifact>/<version><ext>`` and points
+``models/manifest.json`` at it. The manifest is rewritten atomically, so a
+process never reads a half-copied model. From the repository root:
+
+    python app/model_versions.py publish pine_xgb_pipeline_final.joblib path/to/retrained.joblib [--version v2]
+    python app/model_versions.py list
+    python app/model_versions.py rollback pine_xgb_pipeline_final.joblib v1
+
+Running processes pick up new versions without a restart. A ``ModelWatcher``
+thread checks every ``AIRFARE_MODEL_WATCH_SECONDS`` seconds (default: 10,
+``0`` disables it) for loaded artifacts whose file has changed, whether
+published or replaced in place under ``models/``. Once a file has not
+changed for one check, ``ModelRegistry.swap`` loads it, warms it up with a
+few dummy predictions and swaps it in while the old version keeps serving.
+Requests already running finish on the old version, whose memory is
+released when the last of them is done. If the new file fails to load, the
+old version keeps serving.
+
+The fare cube, interval tables and cached predictions are tied to the
+version they were computed with, so they stop being used once a new version
+is swapped in. Rebuild them for the new one (see fare_cube.py and
+fare_intervals.py). Re-export the NumPy trees (tree_runtime.py) after
+publishing a new pipeline when ``AIRFARE_TREE_RUNTIME=numpy``.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import shutil
+import threading
+
+from model_registry import MANIFEST_FILE, MODELS_DIR, registry
+
+WATCH_SECONDS = float(os.environ.get('AIRFARE_MODEL_WATCH_SECONDS', 10))
+
+VERSIONS_DIR = 'versions'
+
+logger = logging.getLogger(__name__)
+
+
+###############################################################################
+#
+#   MANIFEST
+#
+###############################################################################
+
+def read_manifest(models_dir: str = MODELS_DIR) -> dict:
+    """Return the manifest of ``models_dir``, empty if there is none."""
+    path = os.path.join(models_dir, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(manifest: dict, models_dir: str):
+    path = os.path.join(models_dir, MANIFEST_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def version_path(name: str, version: str) -> str:
+    """Path of ``version`` of the artifact ``name``, relative to the models folder."""
+    stem, extension = os.path.splitext(name)
+    return os.path.join(VERSIONS_DIR, stem, version + extension)
+
+
+def versions(name: str, models_dir: str = MODELS_DIR) -> list:
+    """Published versions of the artifact ``name``, oldest first."""
+    folder = os.path.dirname(os.path.join(models_dir, version_path(name, '_')))
+    if not os.path.isdir(folder):
+        return []
+    extension = os.path.splitext(name)[1]
+    files = [entry for entry in os.scandir(folder) if entry.name.endswith(extension)]
+    return [os.path.splitext(entry.name)[0] for entry in sorted(files, key=lambda entry: entry.stat().st_mtime_ns)]
+
+
+def published_names(models_dir: str = MODELS_DIR) -> list:
+    """Artifacts with at least one published version."""
+    root = os.path.join(models_dir, VERSIONS_DIR)
+    if not os.path.isdir(root):
+        return []
+    names = set()
+    for folder in os.scandir(root):
+        if folder.is_dir():
+            names.update(folder.name + os.path.splitext(entry.name)[1]
+                         for entry in os.scandir(folder.path) if not entry.name.endswith('.tmp'))
+    return sorted(names)
+
+
+def _point_to(name: str, version: str, models_dir: str):
+    manifest = read_manifest(models_dir)
+    manifest[name] = {
+        'version': version,
+        'path': version_path(name, version),
+        'activated': datetime.datetime.now().isoformat(timespec='seconds'),
+    }
+    _write_manifest(manifest, models_dir)
+
+
+def publish(name: str, source: str, version: str = None, models_dir: str = MODELS_DIR) -> str:
+    """
+    Copy ``source`` in as a new version of the artifact ``name`` and make it
+    the current one.
+
+    Parameters
+    ----------
+    name : str
+        Artifact name the predictors use (e.g. 'pine_xgb_pipeline_final.joblib').
+    source : str
+        Retrained artifact, with the same extension.
+    version : str
+        Name of the version (default: the current date and time).
+
+    Returns
+    -------
+    str
+        The version published.
+    """
+    if os.path.splitext(source)[1] != os.path.splitext(name)[1]:
+        raise ValueError(f"{source} does not have the extension of {name}")
+    version = version or datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+    destination = os.path.join(models_dir, version_path(name, version))
+    if os.path.exists(destination):
+        raise FileExistsError(f"Version {version} of {name} already exists")
+    os.makedirs(os.path.dirname(destination), exist_ok=True)
+    # Copied under a temporary name first, so the file appears complete
+    shutil.copyfile(source, destination + '.tmp')
+    os.replace(destination + '.tmp', destination)
+    _point_to(name, version, models_dir)
+    return version
+
+
+def rollback(name: str, version: str, models_dir: str = MODELS_DIR):
+    """Make the published ``version`` of ``name`` the current one again."""
+    if not os.path.isfile(os.path.join(models_dir, version_path(name, version))):
+        raise FileNotFoundError(f"Version {version} of {name} was never published")
+    _point_to(name, version, models_dir)
+
+
+###############################################################################
+#
+#   WATCHER
+#
+###############################################################################
+
+class ModelWatcher:
+    """
+    Swaps new versions of the loaded artifacts into the registry.
+
+    Parameters
+    ----------
+    registry : ModelRegistry
+        Registry to watch (default: the shared one).
+    interval : float
+        Seconds between checks (when started with `start`).
+    """
+
+    def __init__(self, registry=registry, interval: float = WATCH_SECONDS):
+        self.registry = registry
+        self.interval = interval
+        self._seen = {}
+        self._failed = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self) -> list:
+        """Swap in every changed artifact whose file is the same as at the last check; return their names."""
+        swapped = []
+        for name in self.registry.stale():
+            version = self.registry.file_version(name)
+            # A file still being written changes between two checks
+            if self._seen.get(name) != version:
+                self._seen[name] = version
+                continue
+            if self._failed.get(name) == version:
+                continue
+            try:
+                self.registry.swap(name)
+            except Exception:
+                logger.exception("Could not swap in the new version of %s, keeping the old one", name)
+                self._failed[name] = version
+            else:
+                swapped.append(name)
+        return swapped
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Model watcher check failed")
+
+    def start(self) -> 'ModelWatcher':
+        self._thread = threading.Thread(target=self.run, name='model-watcher', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def watch_models(interval: float = WATCH_SECONDS) -> ModelWatcher:
+    """Start the process-wide watcher of the shared registry (once), unless ``interval`` is 0."""
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None and interval > 0:
+            _watcher = ModelWatcher(interval=interval).start()
+        return _watcher
+
+
+###############################################################################
+#
+#   ENTRY POINT
+#
+###############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish, list and roll back versions of the model artifacts")
+    commands = parser.add_subparsers(dest='command', required=True)
+    publish_parser = commands.add_parser('publish', help="Make a retrained artifact the current version")
+    publish_parser.add_argument('name', help="Artifact name, e.g. pine_xgb_pipeline_final.joblib")
+    publish_parser.add_argument('source', help="Retrained artifact file")
+    publish_parser.add_argument('--version', help="Version name (default: current date and time)")
+    rollback_parser = commands.add_parser('rollback', help="Make an earlier version the current one")
+    rollback_parser.add_argument('name')
+    rollback_parser.add_argument('version')
+    commands.add_parser('list', help="Show the published versions of every artifact")
+    args = parser.parse_args()
+
+    if args.command == 'publish':
+        version = publish(args.name, args.source, args.version)
+        print(f"{args.name}: version {version} is now current")
+    elif args.command == 'rollback':
+        rollback(args.name, args.version)
+        print(f"{args.name}: version {args.version} is now current")
+    else:
+        manifest = read_manifest()
+        names = sorted(set(manifest) | set(published_names()))
+        for name in names:
+            current = manifest.get(name, {}).get('version')
+            listed = ', '.join(f"{version}{' (current)' if version == current else ''}" for version in versions(name))
+            print(f"{name}: {listed or 'no published versions'}")
+
+
+if __name__ == '__main__':
+    main()
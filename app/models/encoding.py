@@ -0,0 +1,63 @@
+import numpy as np
+
+
+# Period of each cyclical feature
+PERIODS = {
+    'dayofweek': 7,
+    'month': 12,
+    'hour': 24,
+    'minute': 60,
+}
+
+
+def _lookup_table(period: int) -> np.ndarray:
+    # Row k holds sin and cos of 2 * pi * k / period for k = 0..period, using
+    # the same expression as `cyclical` so the values are bit-identical
+    k = np.arange(period + 1)
+    return np.column_stack([np.sin(2 * np.pi * k / period), np.cos(2 * np.pi * k / period)])
+
+
+_TABLES = {period: _lookup_table(period) for period in set(PERIODS.values())}
+
+
+def encode_cyclical(values, periods, out=None, dtype=np.float32):
+    """
+    Encode several integer cyclical features into sine and cosine components in one pass.
+
+    All periods are small integers, so the encodings are looked up in
+    precomputed tables instead of calling sin and cos on every row. Values
+    outside ``[0, period]`` fall back to computing them directly.
+
+    Parameters
+    ----------
+    values : list of array-like of int
+        One array per feature, all of the same length.
+    periods : list of int or str
+        Period of each feature, either as a number or as a key of ``PERIODS``.
+    out : np.ndarray
+        Optional preallocated ``(n, 2 * len(values))`` buffer to write into.
+    dtype : np.dtype
+        Dtype of the buffer allocated when ``out`` is not given (default: float32).
+
+    Returns
+    -------
+    np.ndarray
+        ``(n, 2 * len(values))`` array with the sine and cosine of each
+        feature side by side: [sin_0, cos_0, sin_1, cos_1, ...].
+    """
+    values = [np.asarray(v) for v in values]
+    n = len(values[0]) if values else 0
+    if out is None:
+        out = np.empty((n, 2 * len(values)), dtype=dtype)
+    for i, (v, period) in enumerate(zip(values, periods)):
+        period = PERIODS.get(period, period)
+        table = _TABLES.get(period)
+        if table is None:
+            table = _TABLES.setdefault(period, _lookup_table(period))
+        if n and (not np.issubdtype(v.dtype, np.integer) or v.min() < 0 or v.max() > period):
+            angle = 2 * np.pi * v / period
+            out[:, 2 * i] = np.sin(angle)
+            out[:, 2 * i + 1] = np.cos(angle)
+        else:
+            out[:, 2 * i:2 * i + 2] = table[v]
+    return out
@@ -2,7 +2,10 @@ import os.path
 
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import MultiLabelBinarizer
+
+from models.encoding import encode_cyclical
+
+SPLITS = ('train', 'val', 'test')
 
 
 def save_sets(X_train=None, y_train=None, X_val=None, y_val=None, X_test=None, y_test=None, path='../data/processed/'):
@@ -43,13 +46,18 @@ def save_sets(X_train=None, y_train=None, X_val=None, y_val=None, X_test=None, y
         pd.Series(y_test).to_frame(name='target').to_parquet(f'{path}y_test.parquet', index=False)
 
 
-def load_sets(path='../data/processed/'):
+def load_sets(path='../data/processed/', columns=None, filters=None):
     """Load the different locally saved sets
 
     Parameters
     ----------
     path : str
         Path to the folder where the sets are saved (default: '../data/processed/')
+    columns : list
+        Features to load (default: all of them)
+    filters : list or pyarrow.compute.Expression
+        Only load the rows of every set matching this predicate on the
+        features, as accepted by `ParquetSet` (default: all the rows)
 
     Returns
     -------
@@ -66,20 +74,33 @@ def load_sets(path='../data/processed/'):
     pd.Series
         Target for the testing set
     """
-    
-    X_train = pd.read_parquet(f'{path}X_train.parquet') if os.path.isfile(f'{path}X_train.parquet') else None
-    X_val   = pd.read_parquet(f'{path}X_val.parquet') if os.path.isfile(f'{path}X_val.parquet') else None
-    X_test  = pd.read_parquet(f'{path}X_test.parquet') if os.path.isfile(f'{path}X_test.parquet') else None
-    y_train = pd.read_parquet(f'{path}y_train.parquet')['target'] if os.path.isfile(f'{path}y_train.parquet') else None
-    y_val   = pd.read_parquet(f'{path}y_val.parquet')['target'] if os.path.isfile(f'{path}y_val.parquet') else None
-    y_test  = pd.read_parquet(f'{path}y_test.parquet')['target'] if os.path.isfile(f'{path}y_test.parquet') else None
 
-    return X_train, y_train, X_val, y_val, X_test, y_test
+    sets = []
+    for split in SPLITS:
+        X, y = open_split(path, split)
+        if X is not None and filters is not None:
+            chunks = list(iter_pairs(X, y, columns=columns, filters=filters, arrow=False))
+            if chunks:
+                X_chunks, y_chunks = zip(*chunks)
+                X = pd.concat(X_chunks, ignore_index=True)
+                y = pd.concat(y_chunks, ignore_index=True) if y is not None else None
+            else:
+                X = X.to_pandas(columns, filters, arrow=False)
+                y = y.to_series(arrow=False).iloc[:0] if y is not None else None
+        else:
+            X = X.to_pandas(columns, arrow=False) if X is not None else None
+            y = y.to_series(arrow=False) if y is not None else None
+        sets += [X, y]
+
+    return tuple(sets)
 
 
 def split_sets_by_time(df, target_col, test_ratio=0.2):
     """Split sets by indexes for an ordered dataframe
 
+    The dataframe is copied; for data that does not fit in memory twice, see
+    `split_parquet_by_time`.
+
     Parameters
     ----------
     df : pd.DataFrame
@@ -122,6 +143,342 @@ def split_sets_by_time(df, target_col, test_ratio=0.2):
     return X_train, y_train, X_val, y_val, X_test, y_test
 
 
+###############################################################################
+#
+#   OUT-OF-CORE SETS
+#
+###############################################################################
+
+# pyarrow is imported by the functions reading or writing the sets: unpickling
+# the fare pipelines imports this module (for `cyclical_transform`), and
+# loading a model must not depend on pyarrow
+
+def _expression(filters):
+    # pyarrow expression from the filters accepted by pd.read_parquet
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+    if filters is None or isinstance(filters, ds.Expression):
+        return filters
+    return pq.filters_to_expression(filters)
+
+
+def _frame(table, arrow):
+    # Arrow-backed frames wrap the table's buffers instead of copying them
+    return table.to_pandas(types_mapper=pd.ArrowDtype) if arrow else table.to_pandas()
+
+
+class ParquetSet:
+    """
+    Lazy view of the rows of a Parquet file.
+
+    Only the footer is read when the view is created. Rows are read when
+    asked for, one row group at a time when iterating, with only the
+    requested columns (projection), skipping the row groups whose
+    statistics rule out the filters (predicate pushdown).
+
+    Parameters
+    ----------
+    path : str
+        Parquet file
+    columns : list
+        Columns of the view (default: all of them)
+    row_groups : list
+        Row groups of the view, in order (default: all of them)
+    """
+
+    def __init__(self, path, columns=None, row_groups=None):
+        import pyarrow.parquet as pq
+        self.path = path
+        self.file = pq.ParquetFile(path)
+        self.columns = list(columns) if columns is not None else list(self.file.schema_arrow.names)
+        self.row_groups = list(row_groups) if row_groups is not None else list(range(self.file.num_row_groups))
+        metadata = self.file.metadata
+        sizes = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+        # Offset of every row group of the file in the file's rows
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self._fragment = None
+
+    def __len__(self):
+        return int(sum(self.offsets[i + 1] - self.offsets[i] for i in self.row_groups))
+
+    def __repr__(self):
+        return (f"ParquetSet({self.path!r}, {len(self)} rows, {len(self.row_groups)} row groups, "
+                f"columns={self.columns})")
+
+    def select(self, columns=None, row_groups=None):
+        """Return a view of some of the columns or row groups of this one, without reading anything."""
+        return ParquetSet(self.path, self.columns if columns is None else columns,
+                          self.row_groups if row_groups is None else row_groups)
+
+    @property
+    def fragment(self) -> 'pyarrow.dataset.ParquetFileFragment':
+        """The file as a dataset fragment, which evaluates filters."""
+        import pyarrow.dataset as ds
+        if self._fragment is None:
+            self._fragment = next(iter(ds.dataset(self.path, format='parquet').get_fragments()))
+        return self._fragment
+
+    def matching_row_groups(self, filters=None):
+        """Row groups of the view whose statistics do not rule out ``filters``."""
+        expression = _expression(filters)
+        if expression is None:
+            return list(self.row_groups)
+        matching = {piece.row_groups[0].id for piece in self.fragment.split_by_row_group(expression)}
+        return [i for i in self.row_groups if i in matching]
+
+    def row_group_mask(self, i, filters) -> 'pyarrow.ChunkedArray':
+        """Which rows of row group ``i`` match ``filters``, reading only the columns they use."""
+        expression = _expression(filters)
+        return self.fragment.subset(row_group_ids=[i]).to_table(columns={'mask': expression}).column('mask')
+
+    def read_row_group(self, i, columns=None, filters=None) -> 'pyarrow.Table':
+        """
+        Read row group ``i`` of the file, with the rows matching ``filters``
+        only and the view's columns (or ``columns``).
+        """
+        table = self.file.read_row_group(i, columns=self.columns if columns is None else list(columns))
+        if filters is not None:
+            table = table.filter(self.row_group_mask(i, filters))
+        return table
+
+    def iter_tables(self, columns=None, filters=None, batch_size=None):
+        """
+        Yield the rows as Arrow tables, one per row group of the view (or
+        slices of at most ``batch_size`` rows of them, which do not copy).
+        """
+        for i in self.matching_row_groups(filters):
+            table = self.read_row_group(i, columns, filters)
+            if batch_size is None:
+                yield table
+                continue
+            for start in range(0, table.num_rows, batch_size):
+                yield table.slice(start, batch_size)
+
+    def iter_batches(self, columns=None, filters=None, batch_size=None, arrow=True):
+        """Yield the rows as DataFrames, like `iter_tables`."""
+        for table in self.iter_tables(columns, filters, batch_size):
+            yield _frame(table, arrow)
+
+    def to_arrow(self, columns=None, filters=None) -> 'pyarrow.Table':
+        """Read every row of the view matching ``filters`` into one table."""
+        import pyarrow as pa
+        columns = self.columns if columns is None else list(columns)
+        tables = list(self.iter_tables(columns, filters))
+        if not tables:
+            return self.file.schema_arrow.empty_table().select(columns)
+        return pa.concat_tables(tables)
+
+    def to_pandas(self, columns=None, filters=None, arrow=True) -> pd.DataFrame:
+        """
+        Read every row of the view matching ``filters`` into a DataFrame,
+        backed by the Arrow buffers unless ``arrow`` is False.
+        """
+        return _frame(self.to_arrow(columns, filters), arrow)
+
+    def to_series(self, column=None, filters=None, arrow=True) -> pd.Series:
+        """Read one column of the view (its only one by default) into a Series."""
+        column = column or self.columns[0]
+        return self.to_pandas([column], filters, arrow)[column]
+
+
+def _rows(view: ParquetSet, start: int, stop: int, column: str) -> 'pyarrow.ChunkedArray':
+    # Rows [start, stop) of one column of the file behind ``view``
+    first = int(np.searchsorted(view.offsets, start, side='right')) - 1
+    last = int(np.searchsorted(view.offsets, stop, side='left'))
+    table = view.file.read_row_groups(list(range(first, last)), columns=[column])
+    return table.column(column).slice(start - view.offsets[first], stop - start)
+
+
+def iter_pairs(X: ParquetSet, y: ParquetSet = None, columns=None, filters=None, batch_size=None, arrow=True):
+    """
+    Yield aligned ``(X_chunk, y_chunk)`` pairs, one per row group of ``X``.
+
+    ``filters`` apply to the features and select the same rows of the
+    target, whose file may be laid out in different row groups.
+
+    Parameters
+    ----------
+    X : ParquetSet
+        Features
+    y : ParquetSet
+        Target, with the same rows as the file of ``X`` (default: none,
+        the pairs then hold None)
+    columns : list
+        Features to read (default: the columns of ``X``)
+    filters : list or pyarrow.compute.Expression
+        Predicate on the features (default: all the rows)
+    batch_size : int
+        Largest number of rows of a pair (default: a row group)
+    arrow : bool
+        Return Arrow-backed frames, without copying (default: True)
+
+    Yields
+    ------
+    pd.DataFrame
+        Features of the chunk
+    pd.Series
+        Target of the chunk
+    """
+    columns = X.columns if columns is None else list(columns)
+    expression = _expression(filters)
+    for i in X.matching_row_groups(expression):
+        table = X.file.read_row_group(i, columns=columns)
+        if y is not None:
+            target = y.columns[0]
+            if y.path == X.path:
+                values = X.file.read_row_group(i, columns=[target]).column(target)
+            else:
+                values = _rows(y, int(X.offsets[i]), int(X.offsets[i + 1]), target)
+            table = table.append_column('__target__', values)
+        if expression is not None:
+            table = table.filter(X.row_group_mask(i, expression))
+
+        for start in range(0, table.num_rows, batch_size or max(table.num_rows, 1)):
+            chunk = table.slice(start, batch_size) if batch_size else table
+            X_chunk = _frame(chunk.select(columns), arrow)
+            y_chunk = _frame(chunk.select(['__target__']), arrow)['__target__'].rename(target) if y is not None else None
+            yield X_chunk, y_chunk
+
+
+def open_split(path='../data/processed/', split='train'):
+    """Open the features and target of one set saved by `save_sets` as `ParquetSet` views (None when missing)."""
+    X_path, y_path = f'{path}X_{split}.parquet', f'{path}y_{split}.parquet'
+    return (ParquetSet(X_path) if os.path.isfile(X_path) else None,
+            ParquetSet(y_path) if os.path.isfile(y_path) else None)
+
+
+def open_sets(path='../data/processed/'):
+    """Lazy counterpart of `load_sets`
+
+    Parameters
+    ----------
+    path : str
+        Path to the folder where the sets are saved (default: '../data/processed/')
+
+    Returns
+    -------
+    ParquetSet
+        Features for the training set (None for any missing set)
+    ParquetSet
+        Target for the training set
+    ParquetSet
+        Features for the validation set
+    ParquetSet
+        Target for the validation set
+    ParquetSet
+        Features for the testing set
+    ParquetSet
+        Target for the testing set
+    """
+
+    return tuple(view for split in SPLITS for view in open_split(path, split))
+
+
+def split_parquet_by_time(path, target_col, test_ratio=0.2):
+    """Lazy counterpart of `split_sets_by_time` for a Parquet file ordered by time
+
+    The cut-offs are moved to the nearest row group boundaries, so every set
+    is a `ParquetSet` view over whole row groups of the file and nothing is
+    read or copied. Write the file with row groups small enough for the
+    split to stay close to ``test_ratio``.
+
+    Parameters
+    ----------
+    path : str
+        Parquet file, ordered by time
+    target_col : str
+        Name of the target column
+    test_ratio : float
+        Ratio used for the validation and testing sets (default: 0.2)
+
+    Returns
+    -------
+    ParquetSet
+        Features for the training set
+    ParquetSet
+        Target for the training set
+    ParquetSet
+        Features for the validation set
+    ParquetSet
+        Target for the validation set
+    ParquetSet
+        Features for the testing set
+    ParquetSet
+        Target for the testing set
+    """
+
+    dataset = ParquetSet(path)
+    features = [column for column in dataset.columns if column != target_col]
+    n_rows = int(dataset.offsets[-1])
+    cutoff = int(n_rows * test_ratio)
+
+    # Row group boundaries closest to the cut-offs of split_sets_by_time
+    boundaries = [int(np.abs(dataset.offsets - (n_rows - cutoff * k)).argmin()) for k in (2, 1)]
+    groups = np.split(np.arange(len(dataset.offsets) - 1), boundaries)
+
+    sets = []
+    for row_groups in groups:
+        sets += [dataset.select(features, row_groups.tolist()), dataset.select([target_col], row_groups.tolist())]
+    return tuple(sets)
+
+
+class SetWriter:
+    """Streaming counterpart of `save_sets`
+
+    Appends chunks of every set to the files `save_sets` writes, so the sets
+    never need to fit in memory. Each chunk is one row group of both the
+    features and the target file, which `iter_pairs` then reads back
+    together.
+
+    Parameters
+    ----------
+    path : str
+        Path to the folder where the sets will be saved (default: '../data/processed/')
+
+    Examples
+    --------
+    >>> with SetWriter('data/processed/') as writer:
+    ...     for X_chunk, y_chunk in chunks:
+    ...         writer.write('train', X_chunk, y_chunk)
+    """
+
+    def __init__(self, path='../data/processed/'):
+        self.path = path
+        self._writers = {}
+
+    def _write(self, name, table):
+        import pyarrow.parquet as pq
+        writer = self._writers.get(name)
+        if writer is None:
+            writer = self._writers[name] = pq.ParquetWriter(f'{self.path}{name}.parquet', table.schema)
+        else:
+            table = table.cast(writer.schema)
+        writer.write_table(table, row_group_size=max(table.num_rows, 1))
+
+    def write(self, split, X=None, y=None):
+        """Append a chunk of features and (or) target to ``split`` ('train', 'val' or 'test')."""
+        import pyarrow as pa
+        if split not in SPLITS:
+            raise ValueError(f"split must be one of {SPLITS}, not {split!r}")
+        if X is not None:
+            X = pd.DataFrame(X)
+            X.columns = X.columns.astype(str)
+            self._write(f'X_{split}', pa.Table.from_pandas(X, preserve_index=False))
+        if y is not None:
+            self._write(f'y_{split}', pa.Table.from_pandas(pd.Series(y).to_frame(name='target'), preserve_index=False))
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def cyclical_transform(X):
     """
     Transform cyclical features into sine and cosine components.
@@ -150,13 +507,14 @@ def cyclical_transform(X):
         - 'minute_cos': Cosine transformation of the minute.
     """
     
-    X_transformed = pd.DataFrame()
-    X_transformed['month_sin'] = np.sin(2 * np.pi * X['departure_month'] / 12)
-    X_transformed['month_cos'] = np.cos(2 * np.pi * X['departure_month'] / 12)
-    X_transformed['hour_sin'] = np.sin(2 * np.pi * X['departure_hour'] / 24)
-    X_transformed['hour_cos'] = np.cos(2 * np.pi * X['departure_hour'] / 24)
-    X_transformed['minute_sin'] = np.sin(2 * np.pi * X['departure_minute'] / 60)
-    X_transformed['minute_cos'] = np.cos(2 * np.pi * X['departure_minute'] / 60)
+    encoded = encode_cyclical(
+        [X['departure_month'], X['departure_hour'], X['departure_minute']],
+        ['month', 'hour', 'minute'],
+        dtype=np.float64)
+    X_transformed = pd.DataFrame(
+        encoded,
+        columns=['month_sin', 'month_cos', 'hour_sin', 'hour_cos', 'minute_sin', 'minute_cos'],
+        index=X.index)
     
     return X_transformed
 
@@ -0,0 +1,158 @@
+"""
+Reduced-precision versions of the multi-city network.
+
+Writes two variants of the float32 NumPy network next to it:
+
+- float16: weights stored and evaluated in half precision;
+- int8: int8 weights, scaled by the input magnitudes calibrated on sample
+  itineraries (see `nn_runtime.Int8DenseNetwork`).
+
+The calibration inputs and the held-out inputs used for the report are both
+drawn from the space of requests the app can make (covered routes, departure
+up to a year ahead, any time of day, 1 to 4 trips, any cabins), with
+different seeds. The report gives, for every variant, the fare error against
+float32 on the held-out set, the memory taken by the weights, the resident
+memory (RSS) measured in a fresh process that loads the variant and scores
+the held-out set, and the latency at several batch sizes, so the trade-off can be picked per deployment with
+``AIRFARE_NN_RUNTIME`` (numpy, float16, int8 or keras).
+
+From the repository root:
+
+    python app/nn_quantize.py [--keras] [--output quantization.json]
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from airport_index import get_airport_index
+from model_registry import MODELS_DIR, registry
+from nn_runtime import DenseNetwork, Int8DenseNetwork, _latency
+from predict_withhops import (
+    FLOAT16_MODEL_NAME, INT8_MODEL_NAME, MODEL_NAME, NUMPY_MODEL_NAME, build_neural_network_input)
+
+CABINS = ('coach', 'premium coach', 'business', 'first')
+
+
+def sample_inputs(n: int, seed: int, search_date: datetime.date = None) -> np.ndarray:
+    """Network inputs of ``n`` random itineraries the app could be asked about."""
+    rng = np.random.default_rng(seed)
+    airport_index = get_airport_index()
+    search_date = search_date or datetime.date.today()
+    destinations = {code: airport_index.destinations(code) for code in airport_index.airports}
+
+    origins = rng.choice(airport_index.airports, size=n)
+    dests = [destinations[origin][rng.integers(len(destinations[origin]))] for origin in origins]
+    depart_dates = [search_date + datetime.timedelta(days=int(days)) for days in rng.integers(0, 366, size=n)]
+    depart_times = [datetime.time(int(h), int(m)) for h, m in zip(rng.integers(0, 24, size=n), rng.integers(0, 60, size=n))]
+    is_basic_econ = rng.random(n) < 0.3
+    n_hops = rng.integers(1, 5, size=n)
+    cabins = [['coach'] * hops if basic else list(rng.choice(CABINS, size=hops))
+              for hops, basic in zip(n_hops, is_basic_econ)]
+    return build_neural_network_input(
+        origins, dests, [search_date] * n, depart_dates, depart_times, is_basic_econ, n_hops, cabins)
+
+
+def _peak_rss_mib() -> float:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _rss_mib() -> float:
+    # Current resident set size (Linux)
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def _measure_rss(artifact: str, X: np.ndarray) -> dict:
+    # Run in a fresh process: memory added by loading the artifact and by scoring X
+    start = _rss_mib()
+    network = registry.get(artifact)
+    loaded = _rss_mib()
+    peak = max(_peak_rss_mib(), loaded)
+    network.predict(X, verbose=0)
+    return {'load_rss_mib': loaded - start, 'predict_peak_rss_mib': max(_peak_rss_mib() - peak, 0.0)}
+
+
+def measure_rss(artifact: str, X: np.ndarray) -> dict:
+    """
+    Resident memory taken by loading ``artifact`` and by scoring ``X`` with
+    it, measured in a new (spawned) process so no other runtime is counted.
+    """
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(_measure_rss, artifact, X).result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write and evaluate reduced-precision multi-city networks")
+    parser.add_argument('--calibration-size', type=int, default=20_000)
+    parser.add_argument('--holdout-size', type=int, default=20_000)
+    parser.add_argument('--percentile', type=float, default=100.0,
+                        help="Percentile of each input's absolute values taken as its magnitude")
+    parser.add_argument('--group-size', type=int, default=4, help="Input rows sharing an int8 scale")
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--keras', action='store_true', help="Also measure the Keras model (imports TensorFlow)")
+    parser.add_argument('--output', help="Write the report to this JSON file")
+    args = parser.parse_args()
+
+    network = registry.get(NUMPY_MODEL_NAME)
+    calibration = sample_inputs(args.calibration_size, seed=0)
+    holdout = sample_inputs(args.holdout_size, seed=1)
+
+    variants = {
+        'float16': (FLOAT16_MODEL_NAME, DenseNetwork(network.kernels, network.biases, network.activations, dtype=np.float16)),
+        'int8': (INT8_MODEL_NAME, Int8DenseNetwork.quantize(
+            network, calibration, percentile=args.percentile, group_size=args.group_size)),
+    }
+    for name, (artifact, variant) in variants.items():
+        path = os.path.join(MODELS_DIR, artifact)
+        variant.save(path)
+        print(f"Wrote {path}")
+
+    artifacts = {'float32': NUMPY_MODEL_NAME, **{name: artifact for name, (artifact, _) in variants.items()}}
+    runtimes = {'float32': network, **{name: registry.reload(artifact) for name, (artifact, _) in variants.items()}}
+    if args.keras:
+        artifacts['keras'] = MODEL_NAME
+        runtimes['keras'] = registry.get(MODEL_NAME)
+
+    reference = network.predict(holdout)[:, 0].astype(np.float64)
+    report = {}
+    for name, runtime in runtimes.items():
+        fares = np.asarray(runtime.predict(holdout, verbose=0), dtype=np.float64)[:, 0]
+        error = np.abs(fares - reference)
+        report[name] = {
+            'mean_abs_error': float(error.mean()),
+            'p99_abs_error': float(np.percentile(error, 99)),
+            'max_abs_error': float(error.max()),
+            'mean_rel_error_pct': float((error / np.abs(reference)).mean() * 100),
+            'weights_bytes': getattr(runtime, 'nbytes', None),
+            **measure_rss(artifacts[name], holdout),
+            'latency_ms': {n: _latency(lambda x: runtime.predict(x, verbose=0), holdout[:n], args.repeats) * 1e3
+                           for n in (1, 100, 10_000)},
+        }
+
+    print(f"\nError vs float32 on {len(holdout)} held-out itineraries ($), weights, RSS added by loading and by "
+          f"scoring them, and latency per batch size:")
+    print(f"{'runtime':>8}  {'mean':>8}  {'p99':>8}  {'max':>8}  {'rel %':>7}  {'weights':>9}  {'load RSS':>10}  "
+          f"{'score RSS':>10}  {'1 row':>9}  {'100 rows':>9}  {'10k rows':>9}")
+    for name, r in report.items():
+        weights = f"{r['weights_bytes']} B" if r['weights_bytes'] is not None else 'n/a'
+        latency = r['latency_ms']
+        print(f"{name:>8}  {r['mean_abs_error']:8.4f}  {r['p99_abs_error']:8.4f}  {r['max_abs_error']:8.4f}  "
+              f"{r['mean_rel_error_pct']:7.4f}  {weights:>9}  {r['load_rss_mib']:6.1f} MiB  "
+              f"{r['predict_peak_rss_mib']:6.1f} MiB  "
+              f"{latency[1]:7.3f}ms  {latency[100]:7.3f}ms  {latency[10_000]:7.3f}ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+"""
+Framework-free inference for the multi-city neural network.
+
+The network is a stack of dense layers, so once the weights are extracted the
+forward pass is a couple of NumPy matmuls. That avoids importing TensorFlow
+and the per-call overhead of the Keras predict loop.
+
+The weights can also be stored in reduced precision (see nn_quantize.py):
+float16 (``DenseNetwork`` with ``dtype=np.float16``) or int8
+(``Int8DenseNetwork``, weights only). ``load_network`` loads any of them.
+
+Export the Keras model, check parity and benchmark both runtimes from the
+repository root with:
+
+    python app/nn_runtime.py
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0, out=x),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'tanh': np.tanh,
+}
+
+
+class DenseNetwork:
+    """
+    Feed-forward network of dense layers evaluated with NumPy.
+
+    Parameters
+    ----------
+    kernels : list of np.ndarray
+        ``(n_in, n_out)`` weight matrix of each layer.
+    biases : list of np.ndarray
+        ``(n_out,)`` bias of each layer.
+    activations : list of str
+        Activation of each layer, one of the keys of ``ACTIVATIONS``.
+    dtype : np.dtype
+        Dtype the weights are stored and evaluated in (default: float32, as
+        in Keras).
+    """
+
+    def __init__(self, kernels, biases, activations, dtype=np.float32):
+        unknown = set(activations) - set(ACTIVATIONS)
+        if unknown:
+            raise ValueError(f"Unsupported activations: {', '.join(sorted(unknown))}")
+        self.dtype = np.dtype(dtype)
+        self.kernels = [np.ascontiguousarray(k, dtype=self.dtype) for k in kernels]
+        self.biases = [np.ascontiguousarray(b, dtype=self.dtype) for b in biases]
+        self.activations = list(activations)
+
+    @classmethod
+    def from_keras(cls, model) -> 'DenseNetwork':
+        """
+        Extract the weights of a Keras model made only of Dense layers.
+
+        Raises
+        ------
+        ValueError
+            If the model contains any other kind of layer.
+        """
+        kernels, biases, activations = [], [], []
+        for layer in model.layers:
+            if type(layer).__name__ != 'Dense':
+                raise ValueError(f"Cannot export layer '{layer.name}' of type {type(layer).__name__}")
+            config = layer.get_config()
+            kernel, *bias = layer.get_weights()
+            kernels.append(kernel)
+            biases.append(bias[0] if bias else np.zeros(config['units'], dtype=kernel.dtype))
+            activations.append(config['activation'])
+        return cls(kernels, biases, activations)
+
+    @classmethod
+    def load(cls, path: str) -> 'DenseNetwork':
+        """Load a network written by `save`, in the dtype it was saved in."""
+        with np.load(path) as data:
+            n_layers = len(data['activations'])
+            return cls(
+                [data[f'kernel_{i}'] for i in range(n_layers)],
+                [data[f'bias_{i}'] for i in range(n_layers)],
+                [str(a) for a in data['activations']],
+                dtype=data['kernel_0'].dtype)
+
+    def save(self, path: str):
+        arrays = {'activations': np.array(self.activations), 'precision': np.array(self.precision)}
+        for i, (kernel, bias) in enumerate(zip(self.kernels, self.biases)):
+            arrays[f'kernel_{i}'] = kernel
+            arrays[f'bias_{i}'] = bias
+        np.savez(path, **arrays)
+
+    @property
+    def precision(self) -> str:
+        return self.dtype.name
+
+    @property
+    def nbytes(self) -> int:
+        """Memory taken by the weights."""
+        return sum(a.nbytes for a in self.kernels + self.biases)
+
+    def predict(self, X, verbose=0) -> np.ndarray:
+        """
+        Return the network output for the rows of ``X``, shaped ``(n, n_out)``.
+
+        ``verbose`` is ignored; it is accepted so the network is a drop-in
+        replacement for a Keras model.
+        """
+        x = np.asarray(X, dtype=self.dtype)
+        for kernel, bias, activation in zip(self.kernels, self.biases, self.activations):
+            x = x @ kernel
+            x += bias
+            x = ACTIVATIONS[activation](x)
+        return x
+
+
+class Int8DenseNetwork:
+    """
+    Feed-forward network of dense layers with int8 weights.
+
+    Weights are quantized per group of ``group_size`` input rows and per
+    output unit, after scaling each input row by the largest magnitude its
+    input reaches on calibration data. The scaling spreads the int8 steps
+    according to how much each weight actually contributes: the inputs of
+    this network range from sin/cos values to distances in miles, so plain
+    per-unit scales would round the weights of the small inputs to zero.
+
+    Layers are evaluated in float32, one group of input rows at a time:
+
+        x @ W  ~  sum over groups g of (x / s_in)[:, g] @ (q[g] * s_w[g])
+
+    Only the group being multiplied is dequantized, into a buffer reused for
+    every group, so the float32 kernels are never held in memory.
+
+    Parameters
+    ----------
+    kernels : list of np.ndarray
+        ``(n_in, n_out)`` int8 kernel of each layer.
+    kernel_scales : list of np.ndarray
+        ``(ceil(n_in / group_size), n_out)`` float32 scale of each group of
+        each layer.
+    input_scales : list of np.ndarray
+        ``(n_in,)`` float32 calibrated magnitude of each input of each layer.
+    biases : list of np.ndarray
+        ``(n_out,)`` float32 bias of each layer.
+    activations : list of str
+        Activation of each layer, one of the keys of ``ACTIVATIONS``.
+    group_size : int
+        Input rows sharing a scale.
+    """
+
+    precision = 'int8'
+
+    def __init__(self, kernels, kernel_scales, input_scales, biases, activations, group_size: int = 4):
+        unknown = set(activations) - set(ACTIVATIONS)
+        if unknown:
+            raise ValueError(f"Unsupported activations: {', '.join(sorted(unknown))}")
+        self.kernels = [np.ascontiguousarray(k, dtype=np.int8) for k in kernels]
+        self.kernel_scales = [np.ascontiguousarray(s, dtype=np.float32) for s in kernel_scales]
+        self.input_scales = [np.ascontiguousarray(s, dtype=np.float32) for s in input_scales]
+        self.biases = [np.ascontiguousarray(b, dtype=np.float32) for b in biases]
+        self.activations = list(activations)
+        self.group_size = int(group_size)
+
+    @classmethod
+    def quantize(cls, network: DenseNetwork, calibration, percentile: float = 100.0,
+                 group_size: int = 4) -> 'Int8DenseNetwork':
+        """
+        Quantize ``network`` using the magnitudes its layers see on ``calibration``.
+
+        Parameters
+        ----------
+        network : DenseNetwork
+            Full-precision network.
+        calibration : array-like
+            ``(n, n_in)`` representative inputs.
+        percentile : float
+            Percentile of the absolute values of each input taken as its
+            magnitude.
+        group_size : int
+            Input rows sharing a scale; smaller groups are more accurate and
+            store more scales.
+        """
+        x = np.asarray(calibration, dtype=np.float32)
+        kernels, kernel_scales, input_scales = [], [], []
+        for kernel, bias, activation in zip(network.kernels, network.biases, network.activations):
+            kernel = kernel.astype(np.float32)
+            input_scale = np.percentile(np.abs(x), percentile, axis=0).astype(np.float32)
+            input_scale[input_scale == 0] = 1.0
+            scaled = kernel * input_scale[:, None]
+            quantized, scales = np.empty(kernel.shape, dtype=np.int8), []
+            for start in range(0, len(scaled), group_size):
+                group = scaled[start:start + group_size]
+                scale = np.abs(group).max(axis=0) / 127
+                scale[scale == 0] = 1.0
+                quantized[start:start + group_size] = np.clip(np.rint(group / scale), -127, 127)
+                scales.append(scale)
+            kernels.append(quantized)
+            kernel_scales.append(np.stack(scales))
+            input_scales.append(input_scale)
+            # The next layer is calibrated on the full-precision activations
+            x = ACTIVATIONS[activation](x @ kernel + bias.astype(np.float32))
+        return cls(kernels, kernel_scales, input_scales, network.biases, network.activations, group_size)
+
+    @classmethod
+    def load(cls, path: str) -> 'Int8DenseNetwork':
+        with np.load(path) as data:
+            n_layers = len(data['activations'])
+            return cls(
+                *([data[f'{key}_{i}'] for i in range(n_layers)] for key in ('kernel', 'kernel_scale', 'input_scale', 'bias')),
+                [str(a) for a in data['activations']],
+                group_size=int(data['group_size']))
+
+    def save(self, path: str):
+        arrays = {
+            'activations': np.array(self.activations),
+            'precision': np.array(self.precision),
+            'group_size': np.array(self.group_size),
+        }
+        for i in range(len(self.kernels)):
+            arrays[f'kernel_{i}'] = self.kernels[i]
+            arrays[f'kernel_scale_{i}'] = self.kernel_scales[i]
+            arrays[f'input_scale_{i}'] = self.input_scales[i]
+            arrays[f'bias_{i}'] = self.biases[i]
+        np.savez(path, **arrays)
+
+    @property
+    def nbytes(self) -> int:
+        """Memory taken by the weights and scales."""
+        return sum(a.nbytes for a in self.kernels + self.kernel_scales + self.input_scales + self.biases)
+
+    def predict(self, X, verbose=0) -> np.ndarray:
+        """
+        Return the network output for the rows of ``X``, shaped ``(n, n_out)``.
+
+        ``verbose`` is ignored, as in `DenseNetwork.predict`.
+        """
+        x = np.asarray(X, dtype=np.float32)
+        for kernel, kernel_scale, input_scale, bias, activation in zip(
+                self.kernels, self.kernel_scales, self.input_scales, self.biases, self.activations):
+            x = x / input_scale
+            out = np.zeros((len(x), kernel.shape[1]), dtype=np.float32)
+            weights = np.empty((self.group_size, kernel.shape[1]), dtype=np.float32)
+            for group, start in enumerate(range(0, len(kernel), self.group_size)):
+                stop = min(start + self.group_size, len(kernel))
+                group_weights = weights[:stop - start]
+                np.multiply(kernel[start:stop], kernel_scale[group], out=group_weights)
+                out += x[:, start:stop] @ group_weights
+            out += bias
+            x = ACTIVATIONS[activation](out)
+        return x
+
+
+def load_network(path: str):
+    """Load a network saved by `DenseNetwork.save` or `Int8DenseNetwork.save`."""
+    with np.load(path) as data:
+        precision = str(data['precision']) if 'precision' in data.files else 'float32'
+    if precision == 'int8':
+        return Int8DenseNetwork.load(path)
+    return DenseNetwork.load(path)
+
+
+###############################################################################
+#
+#   EXPORT, PARITY CHECK AND BENCHMARK
+#
+###############################################################################
+
+def _latency(predict, X, repeats: int) -> float:
+    predict(X)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        predict(X)
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    from model_registry import MODELS_DIR, registry
+    from predict_withhops import MODEL_NAME, NUMPY_MODEL_NAME
+
+    parser = argparse.ArgumentParser(description="Export the multi-city network to the NumPy runtime")
+    parser.add_argument('--tolerance', type=float, default=1e-3, help="Largest allowed difference in predicted fare")
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    model = registry.get(MODEL_NAME)
+    network = DenseNetwork.from_keras(model)
+    path = os.path.join(MODELS_DIR, NUMPY_MODEL_NAME)
+    network.save(path)
+    network = DenseNetwork.load(path)
+    print(f"Wrote {path}")
+
+    # Parity on random inputs spanning the ranges seen by the model
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, size=(10_000, network.kernels[0].shape[0])).astype(np.float32)
+    X[:, 8] = rng.integers(0, 366, size=len(X))
+    X[:, 10] = rng.uniform(0, 3000, size=len(X))
+    difference = np.abs(model.predict(X, verbose=0) - network.predict(X)).max()
+    print(f"Max abs difference vs Keras: {difference:.2e}")
+    if difference > args.tolerance:
+        raise SystemExit(f"Parity check failed (tolerance {args.tolerance:.0e})")
+
+    print(f"{'rows':>8}  {'keras':>12}  {'numpy':>12}")
+    for n in (1, 100, 10_000):
+        keras_seconds = _latency(lambda x: model.predict(x, verbose=0), X[:n], args.repeats)
+        numpy_seconds = _latency(network.predict, X[:n], args.repeats)
+        print(f"{n:>8}  {keras_seconds * 1e3:10.3f}ms  {numpy_seconds * 1e3:10.3f}ms")
+
+
+if __name__ == '__main__':
+    main()
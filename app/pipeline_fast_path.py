@@ -0,0 +1,153 @@
+"""
+NumPy replica of the fitted XGBoost fare pipelines.
+
+The sklearn pipelines run a ColumnTransformer (one-hot encoding plus the
+cyclical sin/cos transform) and then XGBoost. For a single request, the
+DataFrame handling and sparse matrix construction cost more than the trees
+themselves. ``PipelineEncoder`` reads the fitted categories out of the
+pipeline once and builds the exact model input as a contiguous float32 array
+in the training column order, which is fed straight to the booster.
+
+When the ColumnTransformer emits sparse output, XGBoost treats the absent
+entries as missing rather than zero, so the replica writes NaN wherever the
+sparse matrix would have no entry.
+
+Only the transformers these pipelines use are supported (one-hot encoders,
+`cyclical_transform` and dropped columns). ``get_fast_path`` returns None for
+anything else, and callers fall back to the full pipeline.
+"""
+import weakref
+
+import numpy as np
+import pandas as pd
+
+from models.encoding import encode_cyclical
+from tree_runtime import TreeEnsemble
+
+CYCLICAL_COLUMNS = ['departure_month', 'departure_hour', 'departure_minute']
+
+
+class PipelineEncoder:
+    """
+    Builds the booster input of a fitted one-hot + cyclical + XGBoost pipeline.
+
+    Parameters
+    ----------
+    pipeline : sklearn.pipeline.Pipeline
+        Fitted pipeline made of a ColumnTransformer followed by an XGBoost
+        estimator.
+
+    Raises
+    ------
+    ValueError
+        If the pipeline uses anything the replica does not support.
+    """
+
+    def __init__(self, pipeline):
+        if len(pipeline.steps) != 2:
+            raise ValueError("Expected a preprocessor followed by a model")
+        preprocessor, model = pipeline.steps[0][1], pipeline.steps[1][1]
+        if not hasattr(model, 'get_booster'):
+            raise ValueError("The final step is not an XGBoost model")
+        if not hasattr(preprocessor, 'transformers_'):
+            raise ValueError("The first step is not a fitted ColumnTransformer")
+
+        # One (kind, columns, details) entry per output block, in output order
+        self.blocks = []
+        for name, transformer, columns in preprocessor.transformers_:
+            if isinstance(transformer, str) and transformer == 'drop':
+                continue
+            step = transformer.steps[0][1] if hasattr(transformer, 'steps') and len(transformer.steps) == 1 else transformer
+            kind = type(step).__name__
+            if kind == 'OneHotEncoder':
+                if step.drop is not None or getattr(step, 'min_frequency', None) is not None \
+                        or getattr(step, 'max_categories', None) is not None:
+                    raise ValueError("One-hot encoders with dropped or infrequent categories are not supported")
+                # Categories sorted for np.searchsorted, with their original positions
+                lookups = []
+                for categories in step.categories_:
+                    order = np.argsort(categories, kind='stable')
+                    lookups.append((np.asarray(categories, dtype=object)[order], order))
+                self.blocks.append(('onehot', list(columns), (lookups, step.handle_unknown == 'ignore')))
+            elif kind == 'FunctionTransformer' and getattr(step.func, '__name__', None) == 'cyclical_transform' \
+                    and not step.kw_args and list(columns) == CYCLICAL_COLUMNS:
+                self.blocks.append(('cyclical', list(columns), None))
+            else:
+                raise ValueError(f"Unsupported transformer '{name}' ({kind})")
+
+        self.n_features = sum(
+            sum(len(categories) for categories, _ in details[0]) if kind == 'onehot' else 2 * len(columns)
+            for kind, columns, details in self.blocks)
+        self.sparse = bool(getattr(preprocessor, 'sparse_output_', False))
+        self.booster = model.get_booster()
+        if self.booster.num_features() != self.n_features:
+            raise ValueError(f"Replica builds {self.n_features} features, the model expects {self.booster.num_features()}")
+
+    def transform(self, columns) -> np.ndarray:
+        """
+        Build the model input for the rows given as ``columns``, a mapping
+        (dict or DataFrame) of input column name to values.
+        """
+        n = len(columns[self.blocks[0][1][0]])
+        X = np.zeros((n, self.n_features), dtype=np.float32)
+        offset = 0
+        for kind, names, details in self.blocks:
+            if kind == 'onehot':
+                lookups, ignore_unknown = details
+                for name, (categories, order) in zip(names, lookups):
+                    values = np.asarray(columns[name], dtype=object)
+                    position = np.searchsorted(categories, values).clip(max=len(categories) - 1)
+                    known = categories[position] == values
+                    if not known.all() and not ignore_unknown:
+                        raise ValueError(f"Found unknown category {values[~known][0]!r} in column '{name}'")
+                    X[np.nonzero(known)[0], offset + order[position[known]]] = 1.0
+                    offset += len(categories)
+            else:
+                encode_cyclical(
+                    [np.asarray(columns[name]) for name in names], ['month', 'hour', 'minute'],
+                    out=X[:, offset:offset + 2 * len(names)])
+                offset += 2 * len(names)
+        if self.sparse:
+            # Entries absent from the sparse matrix are missing values to XGBoost
+            X[X == 0] = np.nan
+        return X
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        return self.booster.inplace_predict(X, missing=np.nan)
+
+
+_fast_paths = weakref.WeakKeyDictionary()
+
+
+def get_fast_path(pipeline):
+    """
+    Return the ``PipelineEncoder`` for a loaded pipeline, building it on first
+    use, or None if the pipeline cannot be replicated.
+    """
+    try:
+        return _fast_paths[pipeline]
+    except KeyError:
+        pass
+    try:
+        encoder = PipelineEncoder(pipeline)
+    except (ValueError, AttributeError):
+        encoder = None
+    _fast_paths[pipeline] = encoder
+    return encoder
+
+
+def model_inputs(pipeline, columns):
+    """
+    Return the features to cache and score for ``columns`` and the function
+    that scores them: the flattened trees for a `TreeEnsemble`, the NumPy
+    replica when the pipeline supports it, the pipeline itself on a
+    DataFrame otherwise.
+    """
+    if isinstance(pipeline, TreeEnsemble):
+        return pipeline.transform(columns), pipeline.predict
+    fast = get_fast_path(pipeline)
+    if fast is not None:
+        return fast.transform(columns), fast.predict
+    if not isinstance(columns, pd.DataFrame):
+        columns = pd.DataFrame(columns)
+    return columns, pipeline.predict
@@ -1,54 +1,199 @@
 import pandas as pd
-from joblib import load
+import numpy as np
 from datetime import datetime
 import os
 
-from models.sets import cyclical_transform
+from airport_index import get_airport_index
+from fare_cube import lookup_fares, select_rows
+from fare_intervals import fare_intervals
+from instrumentation import count, span
+from micro_batch import MicroBatcher
+from model_registry import get_model_with_version, registry
+from pipeline_fast_path import model_inputs
+from prediction_cache import get_cache
+from tree_runtime import TREE_RUNTIMES, trees_name
 
+MODEL_NAME = 'pine_xgb_pipeline_final.joblib'
 
-def predict_nohops_flight_fare(input_date, input_time, starting_airport, destination_airport, cabin_type):
+# 'xgboost' scores live rows with the fitted pipeline, 'numpy' with the
+# flattened trees exported by tree_runtime.py (no scikit-learn or XGBoost)
+TREE_RUNTIME = os.environ.get('AIRFARE_TREE_RUNTIME', 'xgboost')
+if TREE_RUNTIME not in TREE_RUNTIMES:
+    raise ValueError(f"Unknown AIRFARE_TREE_RUNTIME {TREE_RUNTIME!r}, expected one of {', '.join(TREE_RUNTIMES)}")
+LIVE_MODEL_NAME = trees_name(MODEL_NAME) if TREE_RUNTIME == 'numpy' else MODEL_NAME
+
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Origin, destination, day name, month, hour, minute and cabin columns, as indexed by the fare cube
+CUBE_COLUMNS = ('startingAirport', 'destinationAirport', 'departure_dayofweek',
+                'departure_month', 'departure_hour', 'departure_minute', 'cabin_type')
+
+
+def build_nohops_input_frame(input_dates, input_times, starting_airports, destination_airports, cabin_types):
     """
-    Load the prediction model and make a fare prediction.
+    Build the model input frame for a batch of one-way flights.
 
     Parameters:
-        input_date (str): The departure date in 'YYYY-MM-DD' format.
-        input_time (str): The departure time in 'HH:MM' format.
-        starting_airport (str): The starting airport code.
-        destination_airport (str): The destination airport code.
-        cabin_type (str): The cabin type (e.g., 'economy', 'business').
+        input_dates (list-like of str): Departure dates in 'YYYY-MM-DD' format.
+        input_times (list-like of str): Departure times in 'HH:MM' format.
+        starting_airports (list-like of str): Starting airport IATA codes (or "Name (IATA)" labels).
+        destination_airports (list-like of str): Destination airport IATA codes (or "Name (IATA)" labels).
+        cabin_types (list-like of str): Cabin types (e.g., 'coach', 'business').
 
     Returns:
-        float: Predicted fare.
+        pd.DataFrame: One row per flight, in the columns expected by the pipeline.
     """
-    
-    try:
-        xgb_pipe = load('models/pine_xgb_pipeline_final.joblib')
-    except FileNotFoundError:
-        raise FileNotFoundError(f"Model file not found")
-    except Exception as e:
-        raise RuntimeError(f"An error occurred while loading the model: {e}")
 
-    # Combine date and time into a single string
-    datetime_string = f"{input_date} {input_time}"
-
-    # Convert the string to a pandas datetime object
-    departure_datetime = pd.to_datetime(datetime_string, format="%Y-%m-%d %H:%M")
+    # Combine dates and times into single strings and parse them in one go
+    datetime_strings = pd.Series(input_dates, dtype=str) + " " + pd.Series(input_times, dtype=str)
+    departure_datetimes = pd.to_datetime(datetime_strings, format="%Y-%m-%d %H:%M")
 
     # Extract the necessary features
-    input_data = {
-        'startingAirport': starting_airport,
-        'destinationAirport': destination_airport,
-        'departure_dayofweek': departure_datetime.day_name(),  
-        'departure_month': departure_datetime.month,            
-        'departure_hour': departure_datetime.hour,              
-        'departure_minute': departure_datetime.minute,          
-        'cabin_type': cabin_type
+    airport_index = get_airport_index()
+    return pd.DataFrame({
+        'startingAirport': np.asarray(airport_index.codes(starting_airports), dtype=object),
+        'destinationAirport': np.asarray(airport_index.codes(destination_airports), dtype=object),
+        'departure_dayofweek': departure_datetimes.dt.day_name().to_numpy(),
+        'departure_month': departure_datetimes.dt.month.to_numpy(dtype=np.int64),
+        'departure_hour': departure_datetimes.dt.hour.to_numpy(dtype=np.int64),
+        'departure_minute': departure_datetimes.dt.minute.to_numpy(dtype=np.int64),
+        'cabin_type': np.asarray(cabin_types, dtype=object),
+    })
+
+
+def build_nohops_input_columns(input_date, input_time, starting_airport, destination_airport, cabin_type):
+    """
+    Build the model input columns for a single one-way flight without pandas.
+
+    Takes the same arguments as `predict_nohops_flight_fare` and returns a
+    dict of one-element columns, in the same columns as
+    `build_nohops_input_frame`.
+    """
+
+    departure_datetime = datetime.strptime(f"{input_date} {input_time}", "%Y-%m-%d %H:%M")
+    airport_index = get_airport_index()
+    return {
+        'startingAirport': [airport_index.code(starting_airport)],
+        'destinationAirport': [airport_index.code(destination_airport)],
+        'departure_dayofweek': [DAY_NAMES[departure_datetime.weekday()]],
+        'departure_month': np.array([departure_datetime.month]),
+        'departure_hour': np.array([departure_datetime.hour]),
+        'departure_minute': np.array([departure_datetime.minute]),
+        'cabin_type': [cabin_type],
     }
 
-    # Convert to DataFrame
-    input_df = pd.DataFrame([input_data])
 
-    # Make predictions using the loaded model
-    prediction = xgb_pipe.predict(input_df)
+def predict_nohops_fares(input_columns, with_interval=False):
+    """
+    Predict the fares of the flights described by ``input_columns``, as built
+    by `build_nohops_input_frame` or `build_nohops_input_columns`.
+
+    Flights on the precomputed fare cube (see fare_cube.py) are looked up;
+    the others are scored by the model, skipping feature rows already scored.
+
+    Returns:
+        np.ndarray: Predicted fares, one per flight, or with ``with_interval``
+        the tuple of fares and the lower and upper bounds of their
+        intervals (NaN without a calibrated table, see fare_intervals.py).
+    """
+
+    with span('lookup'):
+        fares, hit = lookup_fares(MODEL_NAME, input_columns, CUBE_COLUMNS)
+    count('cube_hits', int(hit.sum()))
+
+    if not hit.all():
+        missed = np.flatnonzero(~hit)
+        with span('model'):
+            xgb_pipe, version = get_model_with_version(LIVE_MODEL_NAME)
+
+        with span('features'):
+            live_columns = input_columns if len(missed) == len(hit) else select_rows(input_columns, missed)
+            features, predict = model_inputs(xgb_pipe, live_columns)
+
+        with span('inference'):
+            fares[missed] = get_cache(LIVE_MODEL_NAME).predict(features, predict, version)
+    count('rows', len(fares))
+
+    if with_interval:
+        with span('interval'):
+            lower, upper = fare_intervals(
+                MODEL_NAME, fares, input_columns['startingAirport'], 
+                input_columns['destinationAirport'], input_columns['cabin_type'])
+        return fares, lower, upper
+    return fares
+
+
+def predict_nohops_flight_fare_batch(input_dates, input_times, starting_airports, destination_airports, cabin_types,
+                                     with_interval=False):
+    """
+    Make fare predictions for a batch of one-way flights with a single model call.
+
+    All arguments are columnar: the i-th element of each describes the i-th
+    flight. See `build_nohops_input_frame` for the expected formats.
+
+    Returns:
+        np.ndarray: Predicted fares, one per flight (with ``with_interval``,
+        see `predict_nohops_fares`).
+    """
+
+    with span('features'):
+        input_df = build_nohops_input_frame(
+            input_dates, input_times, starting_airports, destination_airports, cabin_types)
+
+    return predict_nohops_fares(input_df, with_interval)
+
+
+def _warm_up(xgb_pipe):
+    # Dummy prediction on a new version of the model before it is swapped in
+    columns = build_nohops_input_columns('2024-01-01', '10:00', 'ATL', 'BOS', 'coach')
+    features, predict = model_inputs(xgb_pipe, columns)
+    predict(features)
+
+
+registry.register_warm_up(LIVE_MODEL_NAME, _warm_up)
+
+
+def _predict_nohops_rows(input_dates, input_times, starting_airports, destination_airports, cabin_types):
+    # Fares and intervals of the flights coalesced by `batcher`; a single
+    # flight skips the DataFrame entirely
+    if len(input_dates) == 1:
+        with span('features'):
+            input_columns = build_nohops_input_columns(
+                input_dates[0], input_times[0], starting_airports[0], destination_airports[0], cabin_types[0])
+        return predict_nohops_fares(input_columns, with_interval=True)
+    return predict_nohops_flight_fare_batch(
+        input_dates, input_times, starting_airports, destination_airports, cabin_types, with_interval=True)
+
+
+# Scores the single flights requested at the same time by different sessions together
+batcher = MicroBatcher('one_way', _predict_nohops_rows)
+
+
+def predict_nohops_flight_fare(input_date, input_time, starting_airport, destination_airport, cabin_type,
+                               with_interval=False):
+    """
+    Fetch the prediction model from the shared registry and make a fare prediction.
+
+    Concurrent calls are scored in one batch (see micro_batch.py).
+
+    Parameters:
+        input_date (str): The departure date in 'YYYY-MM-DD' format.
+        input_time (str): The departure time in 'HH:MM' format.
+        starting_airport (str): The starting airport IATA code (or "Name (IATA)" label).
+        destination_airport (str): The destination airport IATA code (or "Name (IATA)" label).
+        cabin_type (str): The cabin type (e.g., 'economy', 'business').
+        with_interval (bool): Also return the bounds of the fare's interval.
+
+    Returns:
+        float: Predicted fare, or the tuple of the fare and its lower and
+        upper bounds with ``with_interval``.
+    """
+
+    with span('batched'):
+        fares, lower, upper = batcher(
+            [input_date], [input_time], [starting_airport], [destination_airport], [cabin_type])
+
+    if with_interval:
+        return fares[0], lower[0], upper[0]
 
-    return prediction[0]
+    return fares[0]
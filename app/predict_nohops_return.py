@@ -1,66 +1,159 @@
 import pandas as pd
 import numpy as np
-from joblib import load
-from datetime import datetime
 import os
-import re
 
-from models.sets import cyclical_transform
+from airport_index import get_airport_index
+from fare_cube import lookup_fares, select_rows
+from fare_intervals import fare_intervals
+from instrumentation import count, span
+from micro_batch import MicroBatcher
+from model_registry import get_model_with_version, registry
+from pipeline_fast_path import model_inputs
+from prediction_cache import get_cache
+from tree_runtime import TREE_RUNTIMES, trees_name
+from models.encoding import encode_cyclical
+
+MODEL_NAME = 'alex_xgboost_hyperopt_new.joblib'
+
+# 'xgboost' scores live rows with the fitted pipeline, 'numpy' with the
+# flattened trees exported by tree_runtime.py (no scikit-learn or XGBoost)
+TREE_RUNTIME = os.environ.get('AIRFARE_TREE_RUNTIME', 'xgboost')
+if TREE_RUNTIME not in TREE_RUNTIMES:
+    raise ValueError(f"Unknown AIRFARE_TREE_RUNTIME {TREE_RUNTIME!r}, expected one of {', '.join(TREE_RUNTIMES)}")
+LIVE_MODEL_NAME = trees_name(MODEL_NAME) if TREE_RUNTIME == 'numpy' else MODEL_NAME
+
+# Origin, destination, day name, month, hour, minute and cabin columns, as indexed by the fare cube
+CUBE_COLUMNS = ('startingAirport', 'destinationAirport', 'day', 'month', 'hour', 'minute', 'cabin_type')
 
 
 def encode_cyclical_features(df):
-    df = df.copy()
-    df['hour_sin'] = np.sin(2 * np.pi * df['hour'] / 24)
-    df['hour_cos'] = np.cos(2 * np.pi * df['hour'] / 24)
-    df['month_sin'] = np.sin(2 * np.pi * df['month'] / 12)
-    df['month_cos'] = np.cos(2 * np.pi * df['month'] / 12)
+    encoded = encode_cyclical([df['hour'], df['month']], ['hour', 'month'], dtype=np.float64)
     df = df.drop(columns=['year', 'month', 'day', 'hour', 'minute'])  # Drop raw datetime features after encoding
+    df['hour_sin'] = encoded[:, 0]
+    df['hour_cos'] = encoded[:, 1]
+    df['month_sin'] = encoded[:, 2]
+    df['month_cos'] = encoded[:, 3]
     return df
 
-def predict_nohops_return_flight_fare(input_date, input_time, starting_airport, destination_airport, cabin_type):
+def build_nohops_return_input_frame(input_dates, input_times, starting_airports, destination_airports, cabin_types):
     """
-    Load the prediction model and make a fare prediction.
+    Build the model input frame for a batch of return-trip legs.
 
     Parameters:
-        input_date (str): The departure date in 'YYYY-MM-DD' format.
-        input_time (str): The departure time in 'HH:MM' format.
-        starting_airport (str): The starting airport code.
-        destination_airport (str): The destination airport code.
-        cabin_type (str): The cabin type (e.g., 'economy', 'business').
+        input_dates (list-like of str): Departure dates in 'YYYY-MM-DD' format.
+        input_times (list-like of str): Departure times in 'HH:MM' format.
+        starting_airports (list-like of str): Starting airport IATA codes (or "Name (IATA)" labels).
+        destination_airports (list-like of str): Destination airport IATA codes (or "Name (IATA)" labels).
+        cabin_types (list-like of str): Cabin types (e.g., 'coach', 'business').
 
     Returns:
-        float: Predicted fare.
+        pd.DataFrame: One row per leg, in the columns expected by the pipeline.
     """
-    
-    try:
-        xgb_pipe = load('models/alex_xgboost_hyperopt_new.joblib')
-    except FileNotFoundError:
-        raise FileNotFoundError(f"Model file not found")
-    except Exception as e:
-        raise RuntimeError(f"An error occurred while loading the model: {e}")
-
-    # Combine date and time into a single string
-    datetime_string = f"{input_date} {input_time}"
 
-    # Convert the string to a pandas datetime object
-    departure_datetime = pd.to_datetime(datetime_string, format="%Y-%m-%d %H:%M")
+    # Combine dates and times into single strings and parse them in one go
+    datetime_strings = pd.Series(input_dates, dtype=str) + " " + pd.Series(input_times, dtype=str)
+    departure_datetimes = pd.to_datetime(datetime_strings, format="%Y-%m-%d %H:%M")
 
     # Extract the necessary features
-    input_data = {
-        'startingAirport': re.search(r'\((.*?)\)', starting_airport).group(1),
-        'destinationAirport': re.search(r'\((.*?)\)', destination_airport).group(1),
-        'day': departure_datetime.day_name(),  
-        'month': departure_datetime.month,            
-        'hour': departure_datetime.hour, 
+    airport_index = get_airport_index()
+    return pd.DataFrame({
+        'startingAirport': np.asarray(airport_index.codes(starting_airports), dtype=object),
+        'destinationAirport': np.asarray(airport_index.codes(destination_airports), dtype=object),
+        'day': departure_datetimes.dt.day_name().to_numpy(),
+        'month': departure_datetimes.dt.month.to_numpy(dtype=np.int64),
+        'hour': departure_datetimes.dt.hour.to_numpy(dtype=np.int64),
         'year': "2024",
-        'minute': departure_datetime.minute,          
-        'cabin_type': cabin_type
-    }
+        'minute': departure_datetimes.dt.minute.to_numpy(dtype=np.int64),
+        'cabin_type': np.asarray(cabin_types, dtype=object),
+    })
+
+
+def predict_nohops_return_flight_fare_batch(input_dates, input_times, starting_airports, destination_airports, cabin_types,
+                                            with_interval=False):
+    """
+    Make fare predictions for a batch of return-trip legs with a single model call.
+
+    All arguments are columnar: the i-th element of each describes the i-th
+    leg. See `build_nohops_return_input_frame` for the expected formats.
+
+    Returns:
+        np.ndarray: Predicted fares, one per leg, or with ``with_interval``
+        the tuple of fares and the lower and upper bounds of their
+        intervals (NaN without a calibrated table, see fare_intervals.py).
+    """
+
+    with span('features'):
+        input_df = build_nohops_return_input_frame(
+            input_dates, input_times, starting_airports, destination_airports, cabin_types)
+
+    # Legs on the precomputed fare cube are looked up, the others scored live
+    with span('lookup'):
+        fares, hit = lookup_fares(MODEL_NAME, input_df, CUBE_COLUMNS)
+    count('cube_hits', int(hit.sum()))
+
+    if not hit.all():
+        missed = np.flatnonzero(~hit)
+        with span('model'):
+            xgb_pipe, version = get_model_with_version(LIVE_MODEL_NAME)
+
+        with span('features'):
+            live_df = input_df if len(missed) == len(hit) else select_rows(input_df, missed)
+            features, predict = model_inputs(xgb_pipe, live_df)
+
+        # Make predictions using the loaded model, skipping feature rows already scored
+        with span('inference'):
+            fares[missed] = get_cache(LIVE_MODEL_NAME).predict(features, predict, version)
+    count('rows', len(fares))
+
+    if with_interval:
+        with span('interval'):
+            lower, upper = fare_intervals(
+                MODEL_NAME, fares, input_df['startingAirport'], 
+                input_df['destinationAirport'], input_df['cabin_type'])
+        return fares, lower, upper
+    return fares
+
+
+def _warm_up(xgb_pipe):
+    # Dummy prediction on a new version of the model before it is swapped in
+    input_df = build_nohops_return_input_frame(['2024-01-01'], ['10:00'], ['ATL'], ['BOS'], ['coach'])
+    features, predict = model_inputs(xgb_pipe, input_df)
+    predict(features)
+
+
+registry.register_warm_up(LIVE_MODEL_NAME, _warm_up)
+
+
+# Scores the single legs requested at the same time by different sessions together
+batcher = MicroBatcher(
+    'return', lambda *columns: predict_nohops_return_flight_fare_batch(*columns, with_interval=True))
+
+
+def predict_nohops_return_flight_fare(input_date, input_time, starting_airport, destination_airport, cabin_type,
+                                      with_interval=False):
+    """
+    Fetch the prediction model from the shared registry and make a fare prediction.
+
+    Concurrent calls are scored in one batch (see micro_batch.py).
+
+    Parameters:
+        input_date (str): The departure date in 'YYYY-MM-DD' format.
+        input_time (str): The departure time in 'HH:MM' format.
+        starting_airport (str): The starting airport IATA code (or "Name (IATA)" label).
+        destination_airport (str): The destination airport IATA code (or "Name (IATA)" label).
+        cabin_type (str): The cabin type (e.g., 'economy', 'business').
+        with_interval (bool): Also return the bounds of the fare's interval.
+
+    Returns:
+        float: Predicted fare, or the tuple of the fare and its lower and
+        upper bounds with ``with_interval``.
+    """
 
-    # Convert to DataFrame
-    input_df = pd.DataFrame([input_data])
+    with span('batched'):
+        fares, lower, upper = batcher(
+            [input_date], [input_time], [starting_airport], [destination_airport], [cabin_type])
 
-    # Make predictions using the loaded model
-    prediction = xgb_pipe.predict(input_df)
+    if with_interval:
+        return fares[0], lower[0], upper[0]
 
-    return prediction[0]
\ No newline at end of file
+    return fares[0]
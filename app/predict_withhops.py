@@ -1,26 +1,40 @@
 import datetime
-import json
-from joblib import load
+import os
 
 import pandas as pd
 import numpy as np
-from tensorflow import keras
 
-from models.sets import cyclical
+from airport_index import get_airport_index
+from fare_intervals import fare_intervals, top_cabins
+from instrumentation import count, span
+from micro_batch import MicroBatcher
+from model_registry import get_model, get_model_with_version, registry
+from prediction_cache import get_cache
+from models.encoding import encode_cyclical
 
-###############################################################################
-#
-#   LOAD METADATA AND MODELS
-#
-###############################################################################
-
-with open('models/distance_data.json') as dist:
-    distance_data = json.load(dist)
+MODEL_NAME = 'nicholas_neuralnetwork_best.keras'
+NUMPY_MODEL_NAME = 'nicholas_neuralnetwork_best.npz'
+CABIN_ENCODER_NAME = 'nicholas_mlbCabinCode.joblib'
 
-with open('models/travel_duration_data.json') as duration:
-    duration_data = json.load(duration)
+FLOAT16_MODEL_NAME = 'nicholas_neuralnetwork_best_float16.npz'
+INT8_MODEL_NAME = 'nicholas_neuralnetwork_best_int8.npz'
 
+# 'numpy' runs the weights exported by nn_runtime.py without TensorFlow,
+# 'float16' and 'int8' the reduced-precision weights written by
+# nn_quantize.py, 'keras' runs the original model
+NN_RUNTIME = os.environ.get('AIRFARE_NN_RUNTIME', 'numpy')
+NETWORK_NAMES = {
+    'numpy': NUMPY_MODEL_NAME,
+    'float16': FLOAT16_MODEL_NAME,
+    'int8': INT8_MODEL_NAME,
+    'keras': MODEL_NAME,
+}
+if NN_RUNTIME not in NETWORK_NAMES:
+    raise ValueError(f"Unknown AIRFARE_NN_RUNTIME {NN_RUNTIME!r}, expected one of {', '.join(NETWORK_NAMES)}")
+NETWORK_NAME = NETWORK_NAMES[NN_RUNTIME]
 
+# Input columns before the one-hot encoded cabins
+N_NUMERIC_FEATURES = 15
 
 ###############################################################################
 #
@@ -28,6 +42,119 @@ with open('models/travel_duration_data.json') as duration:
 #
 ###############################################################################
 
+def build_neural_network_input(
+        origins, 
+        dests, 
+        search_dates, 
+        depart_dates, 
+        depart_times, 
+        is_basic_econ, 
+        n_hops, 
+        cabins) -> np.ndarray:
+    """
+    Build the model input for a batch of multi-city itineraries.
+
+    All arguments are columnar: the i-th element of each describes the i-th
+    itinerary. Airports are IATA codes or "Name (IATA)" labels, dates are datetime.date,
+    times are datetime.time and each element of ``cabins`` is the list of
+    cabins booked on that itinerary.
+
+    Returns a float32 array with one row per itinerary and the columns in
+    the order the network was trained on: the 8 cyclical features (day of
+    week, month, hour, minute), 'timeDeltaDays', 'travelDurationDay',
+    'totalTravelDistance', 'isBasicEconomy', 'isRefundable', 'isNonStop',
+    'numLegs' and one column per cabin class of the encoder.
+    """
+    mlbCabinCode = get_model(CABIN_ENCODER_NAME)
+    airport_index = get_airport_index()
+    origin_ids = airport_index.ids(origins)
+    dest_ids = airport_index.ids(dests)
+    depart_dates = pd.DatetimeIndex(depart_dates)
+    search_dates = pd.DatetimeIndex(search_dates)
+    depart_hours = np.fromiter((t.hour for t in depart_times), dtype=np.int64)
+    depart_minutes = np.fromiter((t.minute for t in depart_times), dtype=np.int64)
+    is_basic_econ = np.asarray(is_basic_econ, dtype=bool)
+    n_hops = np.asarray(n_hops, dtype=np.int64)
+    distances, durations = airport_index.route_table.lookup(origin_ids, dest_ids)
+
+    # Every feature is written straight into one buffer
+    X = np.zeros((len(depart_dates), N_NUMERIC_FEATURES + len(mlbCabinCode.classes_)), dtype=np.float32)
+    encode_cyclical(
+        [depart_dates.weekday.to_numpy(), depart_dates.month.to_numpy(), depart_hours, depart_minutes],
+        ['dayofweek', 'month', 'hour', 'minute'], out=X[:, :8])
+    X[:, 8] = (depart_dates - search_dates).days.to_numpy()
+    X[:, 9] = durations
+    X[:, 10] = distances
+    X[:, 11] = is_basic_econ
+    X[:, 12] = ~is_basic_econ
+    X[:, 13] = n_hops == 0
+    X[:, 14] = n_hops
+
+    # Same result as mlbCabinCode.transform: one column per known cabin, unknown cabins ignored
+    class_columns = {label: N_NUMERIC_FEATURES + j for j, label in enumerate(mlbCabinCode.classes_)}
+    rows, columns = [], []
+    for i, itinerary_cabins in enumerate(cabins):
+        for cabin in set(itinerary_cabins):
+            column = class_columns.get(cabin)
+            if column is not None:
+                rows.append(i)
+                columns.append(column)
+    X[rows, columns] = 1.0
+    return X
+
+
+def predict_neural_network_batch(
+        origins, 
+        dests, 
+        search_dates, 
+        depart_dates, 
+        depart_times, 
+        is_basic_econ, 
+        n_hops, 
+        cabins,
+        with_interval=False) -> np.ndarray:
+    """
+    Predict fares for a batch of multi-city itineraries with a single model
+    call. See `build_neural_network_input` for the expected inputs.
+
+    Returns one predicted fare per itinerary, or with ``with_interval`` the
+    tuple of fares and the lower and upper bounds of their intervals (NaN
+    without a calibrated table, see fare_intervals.py).
+    """
+    with span('model'):
+        model, version = get_model_with_version(NETWORK_NAME)
+    with span('features'):
+        features = build_neural_network_input(
+            origins, dests, search_dates, depart_dates, depart_times, 
+            is_basic_econ, n_hops, cabins)
+    with span('inference'):
+        fares = get_cache(NETWORK_NAME).predict(
+            features, lambda features: model.predict(features, verbose=0)[:, 0], version)
+    count('rows', len(fares))
+
+    if with_interval:
+        with span('interval'):
+            lower, upper = fare_intervals(NETWORK_NAME, fares, np.asarray(n_hops), top_cabins(cabins))
+        return fares, lower, upper
+    return fares
+
+
+def _warm_up(model):
+    # Dummy prediction on a new version of the network before it is swapped
+    # in (with Keras, this builds the prediction graph)
+    features = build_neural_network_input(
+        ['ATL'], ['BOS'], [datetime.date(2024, 1, 1)], [datetime.date(2024, 1, 8)], [datetime.time(10, 0)],
+        [False], [1], [['coach']])
+    model.predict(features, verbose=0)
+
+
+registry.register_warm_up(NETWORK_NAME, _warm_up)
+
+
+# Scores the single itineraries requested at the same time by different sessions together
+batcher = MicroBatcher('multi_city', lambda *columns: predict_neural_network_batch(*columns, with_interval=True))
+
+
 def predict_neural_network(
         origin: str, 
         dest: str, 
@@ -36,38 +163,13 @@ def predict_neural_network(
         depart_time: datetime.time, 
         is_basic_econ: bool,
         n_hops: int,
-        cabins: str) -> float:
-    try:
-        model = keras.models.load_model("models/nicholas_neuralnetwork_best.keras")
-        mlbCabinCode = load("models/nicholas_mlbCabinCode.joblib")
-    except FileNotFoundError:
-        raise FileNotFoundError(f"Model file not found")
-    except Exception as e:
-        raise RuntimeError(f"An error occurred while loading the model: {e}")
-    origin_iata_code = origin[-4:-1]
-    dest_iata_code = dest[-4:-1]
-    cabins_series = pd.Series([cabins], name='segmentsCabinCode')
-    input_data = {
-        'flightDayOfWeekSin': cyclical(depart_date.weekday(), 7, np.sin), 
-        'flightDayOfWeekCos': cyclical(depart_date.weekday(), 7, np.cos), 
-        'flightMonthSin': cyclical(depart_date.month, 12, np.sin), 
-        'flightMonthCos': cyclical(depart_date.month, 12, np.cos), 
-        'flightHourSin': cyclical(depart_time.hour, 24, np.sin), 
-        'flightHourCos': cyclical(depart_time.hour, 24, np.cos), 
-        'flightMinuteSin': cyclical(depart_time.minute, 60, np.sin), 
-        'flightMinuteCos': cyclical(depart_time.minute, 60, np.cos),
-        'timeDeltaDays': (depart_date - search_date).days,
-        'travelDurationDay': duration_data[origin_iata_code][dest_iata_code],
-        'totalTravelDistance': distance_data[origin_iata_code][dest_iata_code],
-        'isBasicEconomy': is_basic_econ,
-        'isRefundable': False if is_basic_econ else True,
-        'isNonStop': False if n_hops != 0 else True,
-        'numLegs': n_hops,
-    }
-    input_df = pd.DataFrame(input_data, index=[0])
-    cabins_df = pd.DataFrame(
-        mlbCabinCode.transform(cabins_series), 
-        columns=mlbCabinCode.classes_)
-    input_df = pd.concat([input_df, cabins_df], axis=1, ignore_index=True)
-    pred = model.predict(input_df)
-    return pred
+        cabins: str,
+        with_interval: bool = False) -> float:
+    # Concurrent calls are scored in one batch (see micro_batch.py)
+    with span('batched'):
+        pred = batcher(
+            [origin], [dest], [search_date], [depart_date], [depart_time], 
+            [is_basic_econ], [n_hops], [cabins])
+    if with_interval:
+        return tuple(values.reshape(1, 1) for values in pred)
+    return pred[0].reshape(1, 1)
@@ -0,0 +1,272 @@
+"""
+Cache of predicted fares keyed on normalized feature rows.
+
+The predictors only depend on the features they derive (weekday, month, hour,
+minute, airports, cabin, ...), not on the raw date strings, so two requests
+for different dates that share a weekday and month hit the same entry. Each
+entry is also keyed on the version of the model artifact that produced it, so
+reloading or replacing a model invalidates everything computed with the old
+one.
+
+Rows of a DataFrame are keyed on their ``repr``; rows of a NumPy array (the
+inputs built by the fast paths) on their raw bytes.
+
+Entries live in an in-memory LRU with an optional time-to-live. Setting
+``AIRFARE_CACHE_PATH`` adds a SQLite file shared by every process on the
+machine (Streamlit workers, the HTTP service) behind the in-memory layer.
+
+Configuration (environment variables):
+
+- ``AIRFARE_CACHE_SIZE``: entries kept in memory per model, 0 disables the
+  cache (default: 100000);
+- ``AIRFARE_CACHE_TTL``: seconds an entry stays valid, 0 for no expiry
+  (default: 0);
+- ``AIRFARE_CACHE_PATH``: SQLite file shared across processes (default: none).
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from model_registry import registry
+
+CACHE_SIZE = int(os.environ.get('AIRFARE_CACHE_SIZE', 100_000))
+CACHE_TTL = float(os.environ.get('AIRFARE_CACHE_TTL', 0))
+CACHE_PATH = os.environ.get('AIRFARE_CACHE_PATH')
+
+# SQLite caps the number of parameters in one statement
+_SQL_CHUNK = 500
+
+
+###############################################################################
+#
+#   DISK STORE
+#
+###############################################################################
+
+class DiskStore:
+    """Predictions shared across processes through a SQLite file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS predictions ('
+            'model TEXT, version TEXT, key TEXT, fare REAL, created REAL, '
+            'PRIMARY KEY (model, version, key))')
+        self._lock = threading.Lock()
+
+    def get_many(self, model: str, version: str, keys: list, min_created: float) -> dict:
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), _SQL_CHUNK):
+                chunk = keys[i:i + _SQL_CHUNK]
+                rows = self._connection.execute(
+                    f'SELECT key, fare FROM predictions WHERE model = ? AND version = ? AND created >= ? '
+                    f'AND key IN ({", ".join("?" * len(chunk))})',
+                    [model, version, min_created, *chunk])
+                found.update(rows)
+        return found
+
+    def put_many(self, model: str, version: str, items: list):
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)',
+                [(model, version, key, fare, now) for key, fare in items])
+
+    def drop_other_versions(self, model: str, version: str):
+        with self._lock:
+            self._connection.execute(
+                'DELETE FROM predictions WHERE model = ? AND version != ?', (model, version))
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM predictions')
+
+
+###############################################################################
+#
+#   CACHE
+#
+###############################################################################
+
+class PredictionCache:
+    """
+    LRU cache of predicted fares for one model, with optional TTL and disk store.
+
+    Parameters
+    ----------
+    model_name : str
+        Artifact name of the model in the registry; its version is part of
+        every key.
+    maxsize : int
+        Entries kept in memory; 0 disables the cache.
+    ttl : float
+        Seconds an entry stays valid; 0 or None for no expiry.
+    store : DiskStore
+        Optional store shared with other processes.
+    """
+
+    def __init__(self, model_name: str, maxsize: int = CACHE_SIZE, ttl: float = CACHE_TTL, store: DiskStore = None):
+        self.model_name = model_name
+        self.maxsize = maxsize
+        self.ttl = ttl or None
+        self.store = store
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def predict(self, features, predict, version: str = None) -> np.ndarray:
+        """
+        Return ``predict(features)`` for the rows of ``features`` (a DataFrame
+        or a 2-D array), only calling ``predict`` on the rows that are not
+        cached.
+
+        ``version`` is the version of the model behind ``predict`` when the
+        caller got it from the registry (see `ModelRegistry.get_with_version`).
+        """
+        if not self.maxsize:
+            return np.asarray(predict(features), dtype=np.float64)
+
+        current = registry.version(self.model_name)
+        if version is not None and version != current:
+            # The model was swapped out while this request held it: its fares
+            # are neither read from nor written to the new version's entries
+            return np.asarray(predict(features), dtype=np.float64)
+        version = current
+        self._check_version(version)
+        if isinstance(features, np.ndarray):
+            features = np.ascontiguousarray(features)
+            keys = [row.tobytes() for row in features]
+        else:
+            keys = [repr(row) for row in features.itertuples(index=False, name=None)]
+        fares = np.empty(len(keys), dtype=np.float64)
+        missing = self._get_many(version, keys, fares)
+
+        if missing:
+            # Rows repeated within the batch are only scored once
+            first_rows = {}
+            for i in missing:
+                first_rows.setdefault(keys[i], i)
+            rows = list(first_rows.values())
+            subset = features[rows] if isinstance(features, np.ndarray) else features.iloc[rows]
+            computed = np.asarray(predict(subset), dtype=np.float64)
+            computed_by_key = dict(zip(first_rows, computed.tolist()))
+            fares[missing] = [computed_by_key[keys[i]] for i in missing]
+            self._put_many(version, list(computed_by_key.items()))
+        return fares
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.store is not None:
+            self.store.clear()
+
+    def stats(self) -> dict:
+        """
+        Return a snapshot of the counters.
+
+        Returns
+        -------
+        dict
+            'hits' (memory), 'disk_hits', 'misses', 'evictions', 'expirations',
+            'invalidations', 'size' and 'hit_rate' (memory and disk hits over
+            all lookups).
+        """
+        with self._lock:
+            stats = dict(self._stats, size=len(self._entries))
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
+
+    def _check_version(self, version: str):
+        # A new model version makes every cached fare stale
+        with self._lock:
+            if version == self._version:
+                return
+            if self._version is not None:
+                self._stats['invalidations'] += 1
+            self._entries.clear()
+            self._version = version
+        if self.store is not None:
+            self.store.drop_other_versions(self.model_name, version)
+
+    def _get_many(self, version: str, keys: list, fares: np.ndarray) -> list:
+        now = time.time()
+        missing = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                entry = self._entries.get(key)
+                if entry is not None and self.ttl and now - entry[1] > self.ttl:
+                    del self._entries[key]
+                    self._stats['expirations'] += 1
+                    entry = None
+                if entry is None:
+                    missing.append(i)
+                    continue
+                self._entries.move_to_end(key)
+                fares[i] = entry[0]
+                self._stats['hits'] += 1
+
+        if missing and self.store is not None:
+            min_created = now - self.ttl if self.ttl else 0.0
+            found = self.store.get_many(self.model_name, version, [keys[i] for i in missing], min_created)
+            if found:
+                self._remember([(key, fare) for key, fare in found.items()])
+                still_missing = []
+                for i in missing:
+                    if keys[i] in found:
+                        fares[i] = found[keys[i]]
+                    else:
+                        still_missing.append(i)
+                with self._lock:
+                    self._stats['disk_hits'] += len(missing) - len(still_missing)
+                missing = still_missing
+
+        with self._lock:
+            self._stats['misses'] += len(missing)
+        return missing
+
+    def _put_many(self, version: str, items: list):
+        self._remember(items)
+        if self.store is not None:
+            self.store.put_many(self.model_name, version, items)
+
+    def _remember(self, items: list):
+        now = time.time()
+        with self._lock:
+            for key, fare in items:
+                self._entries[key] = (fare, now)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+_store = None
+
+
+def get_cache(model_name: str) -> PredictionCache:
+    """Return the process-wide cache for ``model_name``, configured from the environment."""
+    global _store
+    with _caches_lock:
+        if model_name not in _caches:
+            if CACHE_PATH and _store is None:
+                _store = DiskStore(CACHE_PATH)
+            _caches[model_name] = PredictionCache(model_name, store=_store)
+        return _caches[model_name]
+
+
+def cache_stats() -> dict:
+    """Return the stats of every cache created so far, keyed by model name."""
+    with _caches_lock:
+        caches = dict(_caches)
+    return {name: cache.stats() for name, cache in caches.items()}
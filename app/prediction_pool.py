@@ -0,0 +1,108 @@
+"""
+Shared thread pool for running independent predictions concurrently.
+
+XGBoost and NumPy release the GIL while they predict, so independent model
+calls (one per model in a comparison, or unrelated legs) overlap on threads
+without the cost of shipping models to other processes.
+
+Concurrency is bounded twice:
+
+- globally, by the size of the pool shared by every session in the process
+  (``AIRFARE_MAX_CONCURRENCY``, default: number of CPUs);
+- per session, by a semaphore held for every task a session has in flight
+  (``AIRFARE_SESSION_CONCURRENCY``, default: 2). A session that reaches its
+  cap waits before queueing more work, so one user cannot fill the pool's
+  queue and starve the others.
+
+Tasks run in a copy of the submitting thread's context, so instrumentation
+spans opened inside them attach to the caller's request.
+"""
+import contextvars
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_CONCURRENCY = int(os.environ.get('AIRFARE_MAX_CONCURRENCY', os.cpu_count() or 4))
+SESSION_CONCURRENCY = int(os.environ.get('AIRFARE_SESSION_CONCURRENCY', 2))
+
+
+class PredictionPool:
+    """
+    Thread pool with a global cap and a per-session cap on tasks in flight.
+
+    Parameters
+    ----------
+    max_workers : int
+        Threads shared by every session.
+    per_session : int
+        Tasks a single session may have queued or running at once.
+    """
+
+    def __init__(self, max_workers: int = MAX_CONCURRENCY, per_session: int = SESSION_CONCURRENCY):
+        self.max_workers = max_workers
+        self.per_session = per_session
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prediction')
+        # Semaphores stay alive while a task holds them and are dropped with
+        # the last one, so idle sessions do not accumulate
+        self._sessions = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def _slots(self, session) -> threading.BoundedSemaphore:
+        with self._lock:
+            slots = self._sessions.get(session)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.per_session)
+                self._sessions[session] = slots
+            return slots
+
+    def submit(self, func, *args, session=None, blocking: bool = True, **kwargs):
+        """
+        Queue ``func(*args, **kwargs)`` and return its Future.
+
+        Blocks while ``session`` already has ``per_session`` tasks in flight,
+        or returns None then if ``blocking`` is False.
+        """
+        slots = self._slots(session)
+        if not slots.acquire(blocking):
+            return None
+        try:
+            future = self._executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        return future
+
+    def run(self, tasks: dict, session=None, return_exceptions: bool = False) -> dict:
+        """
+        Run every callable in ``tasks`` concurrently and wait for all of them.
+
+        Parameters
+        ----------
+        tasks : dict
+            Name mapped to a callable taking no arguments.
+        session : hashable
+            Key of the caller's session (e.g. the Streamlit session ID).
+        return_exceptions : bool
+            Return a task's exception as its result instead of raising it.
+
+        Returns
+        -------
+        dict
+            Name mapped to the task's result, in the order of ``tasks``.
+        """
+        futures = {name: self.submit(func, session=session) for name, func in tasks.items()}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results[name] = e
+        return results
+
+
+# Shared by every session in the process
+pool = PredictionPool()
@@ -0,0 +1,187 @@
+"""
+Dense distance and travel duration tables for every airport pair.
+
+Airports are identified by integer IDs (their position in the sorted list of
+IATA codes), so lookups for a whole batch of routes are a single fancy-index
+into two ``(n_airports, n_airports)`` arrays.
+
+Pairs missing from the CSVs are filled in when the table is built:
+
+- distance: the reverse route if known, otherwise the great-circle distance
+  between the airports in ``airport_coordinates.csv``;
+- duration: the reverse route if known, otherwise a linear fit of duration on
+  distance over the known routes.
+
+The ``estimated`` mask records which cells came from a fallback.
+
+The table can be saved to a binary ``.npy`` file and memory-mapped back, which
+is what ``get_route_table`` does when ``models/route_table.npy`` exists. Build
+that file from the repository root with:
+
+    python app/route_table.py
+"""
+import functools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from model_registry import MODELS_DIR
+
+DISTANCE_FILE = 'distance_data.csv'
+DURATION_FILE = 'travel_duration_data.csv'
+COORDINATES_FILE = 'airport_coordinates.csv'
+ROUTE_TABLE_FILE = 'route_table.npy'
+
+EARTH_RADIUS_MILES = 3958.8
+
+# Layers of the stacked array written by RouteTable.save
+DISTANCE, DURATION, ESTIMATED = range(3)
+
+
+###############################################################################
+#
+#   FALLBACKS
+#
+###############################################################################
+
+def great_circle_miles(lat1, lon1, lat2, lon2):
+    """Haversine distance in miles between points given in degrees."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+
+
+def _fill_from_reverse(table: np.ndarray) -> np.ndarray:
+    return np.where(np.isnan(table), table.T, table)
+
+
+###############################################################################
+#
+#   ROUTE TABLE
+#
+###############################################################################
+
+class RouteTable:
+    """
+    Distance (miles) and travel duration (days) for every ordered airport pair.
+
+    Parameters
+    ----------
+    codes : list of str
+        Sorted IATA codes; the position of a code is its airport ID.
+    distance : np.ndarray
+        ``(n, n)`` distances, ``distance[origin_id, dest_id]``.
+    duration : np.ndarray
+        ``(n, n)`` travel durations in days.
+    estimated : np.ndarray
+        ``(n, n)`` boolean mask of the cells filled by a fallback.
+    """
+
+    def __init__(self, codes, distance, duration, estimated):
+        self.codes = list(codes)
+        self.ids = {code: i for i, code in enumerate(self.codes)}
+        self.distance = distance
+        self.duration = duration
+        self.estimated = estimated
+
+    @classmethod
+    def from_csv(cls, models_dir: str = MODELS_DIR) -> 'RouteTable':
+        """Build the table from the distance, duration and coordinates CSVs."""
+        distances = pd.read_csv(os.path.join(models_dir, DISTANCE_FILE))
+        durations = pd.read_csv(os.path.join(models_dir, DURATION_FILE))
+        coordinates = pd.read_csv(os.path.join(models_dir, COORDINATES_FILE), index_col='IATA')
+
+        codes = sorted(set(distances['ORIGIN']) | set(distances['DEST'])
+                       | set(durations['startingAirport']) | set(durations['destinationAirport']))
+        ids = {code: i for i, code in enumerate(codes)}
+        n = len(codes)
+
+        distance = np.full((n, n), np.nan)
+        distance[distances['ORIGIN'].map(ids), distances['DEST'].map(ids)] = distances['DISTANCE IN MILES']
+        duration = np.full((n, n), np.nan)
+        duration[durations['startingAirport'].map(ids), durations['destinationAirport'].map(ids)] = durations['travelDurationDay']
+        np.fill_diagonal(distance, 0.0)
+        np.fill_diagonal(duration, 0.0)
+        estimated = np.isnan(distance) | np.isnan(duration)
+
+        # Distance: reverse route, then great circle
+        distance = _fill_from_reverse(distance)
+        if np.isnan(distance).any():
+            missing = sorted({codes[i] for i in np.nonzero(np.isnan(distance))[0]} - set(coordinates.index))
+            if missing:
+                raise KeyError(f"No coordinates for airports: {', '.join(missing)}")
+            lat = coordinates.loc[codes, 'LATITUDE'].to_numpy()
+            lon = coordinates.loc[codes, 'LONGITUDE'].to_numpy()
+            circle = great_circle_miles(lat[:, None], lon[:, None], lat[None, :], lon[None, :])
+            distance = np.where(np.isnan(distance), circle, distance)
+
+        # Duration: reverse route, then linear fit on distance
+        duration = _fill_from_reverse(duration)
+        known = ~np.isnan(duration) & ~np.eye(n, dtype=bool)
+        slope, intercept = np.polyfit(distance[known], duration[known], 1)
+        duration = np.where(np.isnan(duration), intercept + slope * distance, duration)
+
+        return cls(codes, distance, duration, estimated)
+
+    @classmethod
+    def load(cls, path: str, mmap_mode: str = 'r') -> 'RouteTable':
+        """
+        Load a table written by `save`, memory-mapping the arrays by default.
+
+        The airport codes are read from the JSON file next to ``path``.
+        """
+        with open(os.path.splitext(path)[0] + '.json') as f:
+            codes = json.load(f)
+        stacked = np.load(path, mmap_mode=mmap_mode)
+        return cls(codes, stacked[DISTANCE], stacked[DURATION], stacked[ESTIMATED].astype(bool))
+
+    def save(self, path: str):
+        """Write the arrays to ``path`` (.npy) and the codes to a .json next to it."""
+        np.save(path, np.stack([self.distance, self.duration, self.estimated.astype(np.float64)]))
+        with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+            json.dump(self.codes, f)
+
+    def airport_ids(self, codes) -> np.ndarray:
+        """
+        Map IATA codes to airport IDs.
+
+        Raises
+        ------
+        KeyError
+            If a code is not covered by the table.
+        """
+        try:
+            return np.fromiter((self.ids[code] for code in codes), dtype=np.intp)
+        except KeyError as e:
+            raise KeyError(f"Unknown airport code: {e.args[0]}") from None
+
+    def lookup(self, origin_ids, dest_ids) -> tuple:
+        """Return the ``(distance, duration)`` arrays for a batch of routes given by ID."""
+        origin_ids = np.asarray(origin_ids, dtype=np.intp)
+        dest_ids = np.asarray(dest_ids, dtype=np.intp)
+        return self.distance[origin_ids, dest_ids], self.duration[origin_ids, dest_ids]
+
+    def lookup_codes(self, origins, dests) -> tuple:
+        """Return the ``(distance, duration)`` arrays for a batch of routes given by IATA code."""
+        return self.lookup(self.airport_ids(origins), self.airport_ids(dests))
+
+
+@functools.lru_cache(maxsize=None)
+def get_route_table() -> RouteTable:
+    """
+    Return the process-wide route table, memory-mapping ``models/route_table.npy``
+    if it has been built and reading the CSVs otherwise.
+    """
+    binary = os.path.join(MODELS_DIR, ROUTE_TABLE_FILE)
+    if os.path.isfile(binary):
+        return RouteTable.load(binary)
+    return RouteTable.from_csv()
+
+
+if __name__ == '__main__':
+    table = RouteTable.from_csv()
+    table.save(os.path.join(MODELS_DIR, ROUTE_TABLE_FILE))
+    print(f"Wrote {len(table.codes)} airports, {int(table.estimated.sum())} estimated routes")
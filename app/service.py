@@ -0,0 +1,286 @@
+"""
+Headless HTTP prediction service.
+
+Exposes the one-way, return and multi-city predictors as JSON endpoints so
+fares can be requested without going through the Streamlit UI. Models are
+loaded once at startup and stay resident in the shared registry; inference
+runs on a worker pool so the event loop never blocks.
+
+Run from the repository root (model paths are relative to it):
+
+    python app/service.py --port 8000
+
+Airports are given as IATA codes; ``GET /airports?q=...`` searches them.
+
+Every prediction endpoint accepts either a single JSON object or a batch of
+the form ``{"items": [{...}, {...}]}``. Batches are scored with one model
+call. Errors come back with their status code and a JSON body of the form
+``{"error": "..."}``.
+
+Retrained models are swapped in without a restart (see model_versions.py).
+
+With ``--model-server PATH`` (or ``AIRFARE_MODEL_SERVER``) the service loads
+no model and sends the predictions to a running `model_server` instead, so
+several services share one copy of the models.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.web
+
+from airport_index import get_airport_index
+from instrumentation import prometheus_text, request
+from model_registry import registry
+from model_server import MODEL_SERVER, ModelServerClient
+from model_versions import watch_models
+from prediction_cache import cache_stats
+from predict_nohops import LIVE_MODEL_NAME as NOHOPS_MODEL_NAME, predict_nohops_flight_fare_batch
+from predict_nohops_return import LIVE_MODEL_NAME as RETURN_MODEL_NAME, predict_nohops_return_flight_fare_batch
+from predict_withhops import NETWORK_NAME as NN_MODEL_NAME, CABIN_ENCODER_NAME, predict_neural_network_batch
+
+logger = logging.getLogger(__name__)
+
+CABINS = ('coach', 'premium coach', 'business', 'first')
+
+
+###############################################################################
+#
+#   REQUEST PARSING
+#
+###############################################################################
+
+def _items(payload) -> tuple:
+    """Return the list of request items and whether the payload was a batch."""
+    if isinstance(payload, dict) and 'items' in payload:
+        if not isinstance(payload['items'], list):
+            raise ValueError("'items' must be a list")
+        return payload['items'], True
+    if isinstance(payload, dict):
+        return [payload], False
+    raise ValueError("Request body must be a JSON object")
+
+
+def _date(value: str) -> datetime.date:
+    return datetime.date.fromisoformat(value)
+
+
+def _time(value: str) -> datetime.time:
+    return datetime.time.fromisoformat(value)
+
+
+def _airports(items: list) -> tuple:
+    """Origin and destination codes of every item, rejecting unknown or identical airports."""
+    airport_index = get_airport_index()
+    origins = [item['origin'] for item in items]
+    destinations = [item['destination'] for item in items]
+    for origin, destination in zip(origins, destinations):
+        for code in (origin, destination):
+            if code not in airport_index:
+                raise ValueError(f"Unknown airport code: {code}")
+        if origin == destination:
+            raise ValueError(f"Origin and destination are the same: {origin}")
+    return origins, destinations
+
+
+def _cabin(value: str) -> str:
+    cabin = value.lower()
+    if cabin not in CABINS:
+        raise ValueError(f"Unknown cabin: {value} (expected one of {', '.join(CABINS)})")
+    return cabin
+
+
+###############################################################################
+#
+#   PREDICTION JOBS (run on the worker pool)
+#
+###############################################################################
+
+def score_one_way(items: list) -> list:
+    origins, destinations = _airports(items)
+    fares = predict_nohops_flight_fare_batch(
+        [item['date'] for item in items],
+        [item.get('time', '10:00') for item in items],
+        origins,
+        destinations,
+        [_cabin(item.get('cabin', 'coach')) for item in items])
+    return [{'fare': float(fare)} for fare in fares]
+
+
+def score_return(items: list) -> list:
+    n = len(items)
+    origins, destinations = _airports(items)
+    # Both legs of every trip go through the model in one call
+    fares = predict_nohops_return_flight_fare_batch(
+        [item['depart_date'] for item in items] + [item['return_date'] for item in items],
+        [item.get('depart_time', '10:00') for item in items] + [item.get('return_time', '10:00') for item in items],
+        origins + destinations,
+        destinations + origins,
+        [_cabin(item.get('depart_cabin', 'coach')) for item in items] + [_cabin(item.get('return_cabin', 'coach')) for item in items])
+    return [
+        {'depart_fare': float(dep), 'return_fare': float(ret), 'fare': float(dep + ret)}
+        for dep, ret in zip(fares[:n], fares[n:])
+    ]
+
+
+def score_multi_city(items: list) -> list:
+    today = datetime.date.today().isoformat()
+    origins, destinations = _airports(items)
+    fares = predict_neural_network_batch(
+        origins=origins,
+        dests=destinations,
+        search_dates=[_date(item.get('search_date', today)) for item in items],
+        depart_dates=[_date(item['depart_date']) for item in items],
+        depart_times=[_time(item.get('depart_time', '10:00')) for item in items],
+        is_basic_econ=[bool(item.get('basic_economy', False)) for item in items],
+        n_hops=[len(item['cabins']) for item in items],
+        cabins=[[_cabin(cabin) for cabin in item['cabins']] for item in items])
+    return [{'fare': float(fare)} for fare in fares]
+
+
+###############################################################################
+#
+#   HANDLERS
+#
+###############################################################################
+
+class JSONHandler(tornado.web.RequestHandler):
+    """Handler answering errors with ``{"error": message}`` instead of an HTML page."""
+
+    def write_error(self, status_code, **kwargs):
+        error = kwargs.get('exc_info', (None, None))[1]
+        if isinstance(error, tornado.web.HTTPError) and error.log_message:
+            message = error.log_message % error.args if error.args else error.log_message
+        else:
+            message = self._reason
+        self.finish({'error': message})
+
+
+class PredictHandler(JSONHandler):
+    """POST handler running ``job`` on the shared worker pool."""
+
+    def initialize(self, path, job, executor):
+        self.path = path
+        self.job = job
+        self.executor = executor
+
+    def traced_job(self, items):
+        # Runs on the worker thread, so the trace is opened there
+        with request(self.path):
+            return self.job(items)
+
+    async def post(self):
+        try:
+            items, is_batch = _items(json.loads(self.request.body or b'null'))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, '%s', e)
+        if not items:
+            self.write({'items': []})
+            return
+        try:
+            loop = asyncio.get_running_loop()
+            results = await loop.run_in_executor(self.executor, self.traced_job, items)
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            raise tornado.web.HTTPError(400, "Invalid request: %r", e)
+        except (FileNotFoundError, ConnectionError, TimeoutError) as e:
+            raise tornado.web.HTTPError(503, '%s', e)
+        self.write({'items': results} if is_batch else results[0])
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(prometheus_text())
+
+
+class AirportsHandler(JSONHandler):
+    """Airport search: ``?q=`` text to match, optional ``origin=`` to only list covered destinations."""
+
+    def get(self):
+        airport_index = get_airport_index()
+        origin = self.get_query_argument('origin', None)
+        if origin is not None and origin not in airport_index:
+            raise tornado.web.HTTPError(400, "Unknown airport code: %s", origin)
+        try:
+            limit = int(self.get_query_argument('limit', '10'))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "'limit' must be an integer")
+        codes = airport_index.search(
+            self.get_query_argument('q', ''), limit=limit,
+            codes=airport_index.destinations(origin) if origin is not None else None)
+        self.write({'items': [{'code': code, 'name': airport_index.names[code]} for code in codes]})
+
+
+class HealthHandler(JSONHandler):
+    def initialize(self, model_server):
+        self.model_server = model_server
+
+    def get(self):
+        if self.model_server is None:
+            self.write({'status': 'ok', 'models': registry.stats(), 'caches': cache_stats()})
+            return
+        try:
+            self.write({'status': 'ok', 'model_server': self.model_server.memory_report()})
+        except ConnectionError as e:
+            raise tornado.web.HTTPError(503, '%s', e)
+
+
+def make_app(executor, model_server: ModelServerClient = None) -> tornado.web.Application:
+    if model_server is None:
+        jobs = {'one_way': score_one_way, 'return': score_return, 'multi_city': score_multi_city}
+    else:
+        jobs = {path: model_server.function(f'score_{path}') for path in ('one_way', 'return', 'multi_city')}
+    return tornado.web.Application([
+        (r'/predict/one-way', PredictHandler, {'path': 'one_way', 'job': jobs['one_way'], 'executor': executor}),
+        (r'/predict/return', PredictHandler, {'path': 'return', 'job': jobs['return'], 'executor': executor}),
+        (r'/predict/multi-city', PredictHandler, {'path': 'multi_city', 'job': jobs['multi_city'], 'executor': executor}),
+        (r'/airports', AirportsHandler),
+        (r'/health', HealthHandler, {'model_server': model_server}),
+        (r'/metrics', MetricsHandler),
+    ])
+
+
+def preload_models():
+    """Load every artifact used by the endpoints so the first request is not slow."""
+    for name in (NOHOPS_MODEL_NAME, RETURN_MODEL_NAME, NN_MODEL_NAME, CABIN_ENCODER_NAME):
+        try:
+            registry.get(name)
+        except FileNotFoundError:
+            logger.warning("Model %s not found, its endpoint will return 503", name)
+
+
+###############################################################################
+#
+#   ENTRY POINT
+#
+###############################################################################
+
+async def serve(port: int, workers: int, model_server: str = None):
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='predict')
+    if model_server is None:
+        await asyncio.get_running_loop().run_in_executor(executor, preload_models)
+        watch_models()
+        make_app(executor).listen(port)
+    else:
+        make_app(executor, ModelServerClient(model_server)).listen(port)
+        logger.info("Predictions are sent to the model server at %s", model_server)
+    logger.info("Prediction service listening on port %d with %d workers", port, workers)
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Airfare prediction HTTP service")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=4, help="Size of the inference worker pool")
+    parser.add_argument('--model-server', default=MODEL_SERVER,
+                        help="Socket of a running model server to send the predictions to, instead of loading the models")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve(args.port, args.workers, args.model_server))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Cold start bookkeeping.
+
+Heavy frameworks (scikit-learn, XGBoost, TensorFlow) are only imported when
+the first model that needs them is deserialized. This module records how long
+each of those steps takes so the cold start can be kept under a budget:
+
+- ``timed`` wraps an import (or any other startup step) and records its
+  duration the first time it runs in the process;
+- model loads are timed by the shared model registry;
+- ``report`` merges both into one table.
+
+Run from the repository root to measure a full cold start and check it
+against the budget (exits with status 1 when over):
+
+    python app/startup.py --budget 10
+"""
+import argparse
+import contextlib
+import os
+import sys
+import threading
+import time
+
+# Budget for the whole cold start, in seconds
+STARTUP_BUDGET_SECONDS = float(os.environ.get('AIRFARE_STARTUP_BUDGET', 10.0))
+
+# Set AIRFARE_WARM_UP=0 to load the neural network on first use instead of in
+# the background as soon as the app starts
+WARM_UP = os.environ.get('AIRFARE_WARM_UP', '1') != '0'
+
+_steps = {}
+_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def timed(label: str):
+    """
+    Record how long the body takes under ``label``.
+
+    Only the first run in the process is kept, so wrapping imports in a
+    Streamlit script does not overwrite the cold timing with a cached one on
+    every rerun.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _steps.setdefault(label, elapsed)
+
+
+def report() -> list:
+    """
+    Return the startup steps recorded so far, slowest first.
+
+    Returns
+    -------
+    list of dict
+        One dict per step with the keys 'step', 'kind' ('import' or 'model
+        load') and 'seconds'. A model load includes any import it triggered,
+        e.g. the 'import tensorflow' step is part of loading the Keras model.
+    """
+    from model_registry import registry
+
+    with _lock:
+        rows = [{'step': label, 'kind': 'import', 'seconds': seconds} for label, seconds in _steps.items()]
+    for name, counters in registry.stats().items():
+        if counters['loads']:
+            rows.append({'step': name, 'kind': 'model load', 'seconds': counters['total_load_seconds']})
+    return sorted(rows, key=lambda row: row['seconds'], reverse=True)
+
+
+def format_report(rows: list, total: float, budget: float = STARTUP_BUDGET_SECONDS) -> str:
+    lines = [f"{row['seconds']:8.3f}s  {row['kind']:<10}  {row['step']}" for row in rows]
+    lines.append(f"{total:8.3f}s  total (budget {budget:.1f}s)")
+    return '\n'.join(lines)
+
+
+###############################################################################
+#
+#   ENTRY POINT
+#
+###############################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the cold start of the prediction backends")
+    parser.add_argument('--budget', type=float, default=STARTUP_BUDGET_SECONDS, help="Cold start budget in seconds")
+    parser.add_argument('--skip-multi-city', action='store_true', help="Do not load the neural network")
+    args = parser.parse_args()
+    start = time.perf_counter()
+
+    with timed('import predict_nohops'):
+        import predict_nohops
+    with timed('import predict_nohops_return'):
+        import predict_nohops_return
+    with timed('import predict_withhops'):
+        import predict_withhops
+    from model_registry import registry
+
+    names = [predict_nohops.LIVE_MODEL_NAME, predict_nohops_return.LIVE_MODEL_NAME]
+    if not args.skip_multi_city:
+        names += [predict_withhops.CABIN_ENCODER_NAME, predict_withhops.NETWORK_NAME]
+    for name in names:
+        try:
+            registry.get(name)
+        except FileNotFoundError:
+            print(f"Skipping missing model {name}", file=sys.stderr)
+
+    total = time.perf_counter() - start
+    print(format_report(report(), total, args.budget))
+    sys.exit(0 if total <= args.budget else 1)
+
+
+if __name__ == '__main__':
+    # Run through the importable module so the timings recorded by the model
+    # registry land in the same place as ours
+    from startup import main
+    main()
@@ -0,0 +1,367 @@
+"""
+Framework-free inference for the XGBoost fare pipelines.
+
+``TreeEnsemble.from_pipeline`` flattens a fitted one-hot + cyclical +
+XGBoost pipeline into a handful of NumPy arrays:
+
+- the one-hot encoders are folded into the trees: a split on the one-hot
+  column of category ``c`` becomes an equality test on the integer code of
+  the input column, so the model reads one code per categorical column
+  instead of the one-hot matrix;
+- every tree is padded to a complete binary tree of the ensemble's depth
+  (a leaf above the last level is repeated below itself), so a node's
+  children are ``2 * i + 1`` and ``2 * i + 2`` and the whole batch walks
+  down all the trees level by level with a few vectorized operations;
+- each node keeps its input column and a ``[low, high)`` interval the
+  value must fall in to go left (``[-inf, threshold)`` for a numeric split,
+  the category code for a folded one-hot split);
+- missing numeric values are replaced by ``-MISSING`` in one copy of their
+  column and ``+MISSING`` in another, and each node reads the copy that
+  sends them to its default side, so walking the trees never tests for
+  NaN.
+
+Loading the arrays needs neither scikit-learn nor XGBoost. The predictors
+use them instead of the pipeline when ``AIRFARE_TREE_RUNTIME=numpy``.
+
+Export every fare pipeline present, check parity and benchmark against the
+pipeline from the repository root with:
+
+    python app/tree_runtime.py
+"""
+import argparse
+import os
+
+import numpy as np
+
+from models.encoding import encode_cyclical
+
+# Values of AIRFARE_TREE_RUNTIME: the fitted pipeline, or these arrays
+TREE_RUNTIMES = ('xgboost', 'numpy')
+
+# Objectives whose prediction is the raw sum of the leaves
+IDENTITY_OBJECTIVES = {'reg:squarederror', 'reg:absoluteerror', 'reg:pseudohubererror', 'reg:quantileerror'}
+
+# Deepest ensemble padded to complete trees (2 ** depth leaves per tree)
+MAX_DEPTH = 16
+
+# Stands in for missing values: beyond every threshold
+MISSING = np.float32(3e38)
+
+# Rows walked down the trees at a time, so the (rows, trees) node indices stay in cache
+BLOCK_SIZE = 4096
+
+
+class TreeEnsemble:
+    """
+    Complete-binary-tree layout of a gradient boosted ensemble, with its
+    one-hot encoders folded in.
+
+    Parameters
+    ----------
+    feature : np.ndarray
+        ``(n_trees, 2 ** depth - 1)`` input column tested by each internal node.
+    low, high : np.ndarray
+        ``(n_trees, 2 ** depth - 1)`` float32 bounds of the values going left.
+    missing_right : np.ndarray
+        ``(n_trees, 2 ** depth - 1)`` whether missing values go right.
+    leaf_values : np.ndarray
+        ``(n_trees, 2 ** depth)`` float32 leaf values.
+    base_score : float
+        Added to the sum of the leaves.
+    columns : list of str
+        Input columns, in model input order.
+    categories : list
+        Categories of each input column (codes are positions in this list),
+        or None for numeric columns.
+    cyclical : list of str
+        Names of the cyclical input columns, encoded as sine and cosine.
+    sparse : bool
+        Whether zero numeric values are missing to the model (when the
+        pipeline's ColumnTransformer emits sparse output).
+    """
+
+    def __init__(self, feature, low, high, missing_right, leaf_values, base_score: float,
+                 columns, categories, cyclical, sparse: bool):
+        self.feature = np.ascontiguousarray(feature, dtype=np.int32)
+        self.low = np.ascontiguousarray(low, dtype=np.float32)
+        self.high = np.ascontiguousarray(high, dtype=np.float32)
+        self.missing_right = np.ascontiguousarray(missing_right, dtype=bool)
+        self.leaf_values = np.ascontiguousarray(leaf_values, dtype=np.float32)
+        self.base_score = float(base_score)
+        self.columns = list(columns)
+        self.categories = [None if c is None else list(c) for c in categories]
+        self.cyclical = list(cyclical)
+        self.sparse = bool(sparse)
+        self.n_trees, n_leaves = self.leaf_values.shape
+        self.depth = int(np.log2(n_leaves))
+
+        # Sorted categories of each categorical column for np.searchsorted, with their codes
+        self._lookups = {
+            i: (np.asarray(c, dtype=object)[np.argsort(c, kind='stable')], np.argsort(c, kind='stable'))
+            for i, c in enumerate(self.categories) if c is not None
+        }
+        # Numeric columns get a second copy at the end of the input, holding
+        # +MISSING for missing values; nodes sending them right read that copy
+        self._numeric = np.flatnonzero([c is None for c in self.categories])
+        right_copy = np.arange(len(self.columns))
+        right_copy[self._numeric] = len(self.columns) + np.arange(len(self._numeric))
+        self._read = np.where(self.missing_right, right_copy[self.feature], self.feature).astype(np.int32)
+
+    @classmethod
+    def from_pipeline(cls, pipeline) -> 'TreeEnsemble':
+        """
+        Flatten a fitted pipeline supported by `pipeline_fast_path.PipelineEncoder`.
+
+        Raises
+        ------
+        ValueError
+            If the pipeline, its booster or its categories cannot be flattened.
+        """
+        import json
+        from pipeline_fast_path import PipelineEncoder
+
+        encoder = PipelineEncoder(pipeline)
+
+        # Model input column and category code (None for numeric) of every one-hot/cyclical output
+        columns, categories, cyclical, outputs = [], [], [], []
+        for kind, names, details in encoder.blocks:
+            if kind == 'onehot':
+                for name, (sorted_categories, order) in zip(names, details[0]):
+                    original = [None] * len(order)
+                    for category, position in zip(sorted_categories, order):
+                        original[position] = category
+                    if not all(isinstance(category, str) for category in original):
+                        raise ValueError(f"Column '{name}' has non-string categories")
+                    outputs.extend((len(columns), code) for code in range(len(original)))
+                    columns.append(name)
+                    categories.append(original)
+            else:
+                for name in names:
+                    for component in ('sin', 'cos'):
+                        outputs.append((len(columns), None))
+                        columns.append(f"{name}_{component}")
+                        categories.append(None)
+                    cyclical.append(name)
+
+        model = json.loads(encoder.booster.save_raw('json'))
+        learner = model['learner']
+        objective = learner['objective']['name']
+        if objective not in IDENTITY_OBJECTIVES:
+            raise ValueError(f"Unsupported objective '{objective}'")
+        booster = learner['gradient_booster']
+        if booster['name'] != 'gbtree':
+            raise ValueError(f"Unsupported booster '{booster['name']}'")
+        trees = booster['model']['trees']
+        if int(learner['learner_model_param'].get('num_target', 1)) > 1 or any(booster['model']['tree_info']):
+            raise ValueError("Only single-output models are supported")
+
+        depth = max(_tree_depth(tree) for tree in trees)
+        if depth > MAX_DEPTH:
+            raise ValueError(f"Trees of depth {depth} are deeper than {MAX_DEPTH}")
+        n_internal, n_leaves = 2 ** depth - 1, 2 ** depth
+        feature = np.zeros((len(trees), n_internal), dtype=np.int32)
+        low = np.full((len(trees), n_internal), -np.inf, dtype=np.float32)
+        high = np.full((len(trees), n_internal), np.inf, dtype=np.float32)
+        missing_right = np.zeros((len(trees), n_internal), dtype=bool)
+        leaf_values = np.zeros((len(trees), n_leaves), dtype=np.float32)
+
+        for t, tree in enumerate(trees):
+            if any(tree['split_type']):
+                raise ValueError("Native categorical splits are not supported")
+            left, right = tree['left_children'], tree['right_children']
+            split_index, condition = tree['split_indices'], np.float32(tree['split_conditions'])
+            default_left = tree['default_left']
+            # (original node, padded position, depth)
+            stack = [(0, 0, 0)]
+            while stack:
+                node, position, level = stack.pop()
+                if left[node] == -1:
+                    # Repeat the leaf over every padded leaf below it
+                    span = 2 ** (depth - level)
+                    first = (position + 1) * span - 1 - n_internal
+                    leaf_values[t, first:first + span] = condition[node]
+                    continue
+                column, code = outputs[split_index[node]]
+                yes, no = left[node], right[node]
+                if code is None:
+                    feature[t, position] = column
+                    high[t, position] = condition[node]
+                    missing_right[t, position] = not default_left[node]
+                else:
+                    # One-hot value 1 for this category, else 0 (missing when sparse)
+                    one = yes if np.float32(1) < condition[node] else no
+                    zero = (yes if default_left[node] else no) if encoder.sparse else \
+                        (yes if np.float32(0) < condition[node] else no)
+                    if one == zero:
+                        # The split does not depend on the value
+                        feature[t, position] = column
+                        missing_right[t, position] = False
+                        yes = no = one
+                    else:
+                        feature[t, position] = column
+                        low[t, position] = code - 0.5
+                        high[t, position] = code + 0.5
+                        yes, no = one, zero
+                stack.append((yes, 2 * position + 1, level + 1))
+                stack.append((no, 2 * position + 2, level + 1))
+
+        base_score = float(learner['learner_model_param']['base_score'])
+        return cls(feature, low, high, missing_right, leaf_values, base_score,
+                   columns, categories, cyclical, encoder.sparse)
+
+    @classmethod
+    def load(cls, path: str) -> 'TreeEnsemble':
+        """Load an ensemble written by `save`."""
+        with np.load(path) as data:
+            columns = [str(c) for c in data['columns']]
+            categories = [
+                [str(c) for c in data[f'categories_{i}']] if f'categories_{i}' in data.files else None
+                for i in range(len(columns))
+            ]
+            return cls(data['feature'], data['low'], data['high'], data['missing_right'], data['leaf_values'],
+                       float(data['base_score']), columns, categories, [str(c) for c in data['cyclical']],
+                       bool(data['sparse']))
+
+    def save(self, path: str):
+        np.savez(
+            path, format='trees', feature=self.feature, low=self.low, high=self.high,
+            missing_right=self.missing_right, leaf_values=self.leaf_values, base_score=self.base_score,
+            columns=np.array(self.columns), cyclical=np.array(self.cyclical, dtype=str), sparse=self.sparse,
+            **{f'categories_{i}': np.array(c) for i, c in enumerate(self.categories) if c is not None})
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.feature, self.low, self.high, self.missing_right, self.leaf_values))
+
+    def transform(self, columns) -> np.ndarray:
+        """
+        Build the model input for the rows given as ``columns``, a mapping
+        (dict or DataFrame) of pipeline input column name to values: one
+        category code per categorical column (-1 for unknown categories),
+        the sine and cosine of each cyclical column, then the second copy
+        of the numeric columns.
+        """
+        n = len(columns[self.cyclical[0] if self.cyclical else self.columns[0]])
+        X = np.empty((n, len(self.columns) + len(self._numeric)), dtype=np.float32)
+        for i, (categories, order) in self._lookups.items():
+            values = np.asarray(columns[self.columns[i]], dtype=object)
+            position = np.searchsorted(categories, values).clip(max=len(categories) - 1)
+            X[:, i] = np.where(categories[position] == values, order[position], -1)
+        if self.cyclical:
+            first = self.columns.index(f"{self.cyclical[0]}_sin")
+            encode_cyclical([np.asarray(columns[name]) for name in self.cyclical],
+                            [name.split('_')[-1] for name in self.cyclical],
+                            out=X[:, first:first + 2 * len(self.cyclical)])
+        numeric = X[:, self._numeric]
+        # Zeros are absent from the sparse matrix the trees were fitted on
+        missing = np.isnan(numeric) | (numeric == 0) if self.sparse else np.isnan(numeric)
+        X[:, len(self.columns):] = np.where(missing, MISSING, numeric)
+        X[:, self._numeric] = np.where(missing, -MISSING, numeric)
+        return X
+
+    def predict(self, X: np.ndarray, verbose=0) -> np.ndarray:
+        """Predict the rows of a matrix built by `transform`."""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        out = np.empty(len(X), dtype=np.float32)
+        for start in range(0, len(X), BLOCK_SIZE):
+            out[start:start + BLOCK_SIZE] = self._predict_block(X[start:start + BLOCK_SIZE])
+        return out
+
+    def _predict_block(self, X: np.ndarray) -> np.ndarray:
+        n, n_columns = X.shape
+        n_internal = self.feature.shape[1]
+        tree_offsets = np.arange(self.n_trees, dtype=np.int32) * n_internal
+        row_offsets = np.arange(n, dtype=np.int32)[:, None] * np.int32(n_columns)
+        read, low, high = self._read.ravel(), self.low.ravel(), self.high.ravel()
+        flat_X = X.ravel()
+
+        # Node of every (row, tree) as a flat index into the node arrays: the
+        # children of tree offset + i are at tree offset + 2 * i + 1 (+ 1)
+        node = np.broadcast_to(tree_offsets, (n, self.n_trees)).copy()
+        step = 1 - tree_offsets
+        value = np.empty((n, self.n_trees), dtype=np.float32)
+        go_right = np.empty((n, self.n_trees), dtype=bool)
+        for _ in range(self.depth):
+            flat_X.take(read.take(node) + row_offsets, out=value)
+            np.less(value, low.take(node), out=go_right)
+            go_right |= value >= high.take(node)
+            node *= 2
+            node += step
+            node += go_right
+        leaves = node - (tree_offsets + n_internal) + np.arange(self.n_trees, dtype=np.int32) * (n_internal + 1)
+        return self.leaf_values.ravel().take(leaves).sum(axis=1, dtype=np.float32) + np.float32(self.base_score)
+
+
+def _tree_depth(tree: dict) -> int:
+    left, right = tree['left_children'], tree['right_children']
+    depth = [0] * len(left)
+    for node in range(len(left)):
+        if left[node] != -1:
+            depth[left[node]] = depth[right[node]] = depth[node] + 1
+    return max(depth)
+
+
+def trees_name(model_name: str) -> str:
+    """Artifact name of the flattened trees of the pipeline ``model_name``."""
+    return f"{os.path.splitext(model_name)[0]}_trees.npz"
+
+
+###############################################################################
+#
+#   EXPORT, PARITY CHECK AND BENCHMARK
+#
+###############################################################################
+
+def main():
+    from benchmark import make_requests
+    from model_registry import MODELS_DIR, registry
+    from nn_runtime import _latency
+    from pipeline_fast_path import get_fast_path
+    import predict_nohops
+    import predict_nohops_return
+
+    parser = argparse.ArgumentParser(description="Export the fare pipelines to the NumPy tree runtime")
+    parser.add_argument('--tolerance', type=float, default=1e-2, help="Largest allowed difference in predicted fare")
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--max-rows', type=int, default=1_000_000, help="Largest batch benchmarked")
+    args = parser.parse_args()
+
+    for model_name, build_frame in (
+            (predict_nohops.MODEL_NAME, predict_nohops.build_nohops_input_frame),
+            (predict_nohops_return.MODEL_NAME, predict_nohops_return.build_nohops_return_input_frame)):
+        if registry.file_version(model_name) is None:
+            print(f"{model_name}: not found, skipped")
+            continue
+        pipeline = registry.get(model_name)
+        ensemble = TreeEnsemble.from_pipeline(pipeline)
+        path = os.path.join(MODELS_DIR, trees_name(model_name))
+        ensemble.save(path)
+        ensemble = registry.reload(trees_name(model_name))
+        print(f"Wrote {path}: {ensemble.n_trees} trees of depth {ensemble.depth}, {ensemble.nbytes} bytes")
+
+        # Parity on random requests, including unknown categories
+        requests = make_requests(args.max_rows)
+        frame = build_frame(requests['dates'], requests['times'], requests['origins'], requests['dests'], requests['cabins'])
+        frame.iloc[::97, frame.columns.get_loc('cabin_type')] = 'unknown cabin'
+        expected = np.asarray(pipeline.predict(frame.iloc[:100_000]), dtype=np.float64)
+        X = ensemble.transform(frame)
+        difference = np.abs(ensemble.predict(X[:100_000]) - expected).max()
+        print(f"Max abs difference vs the pipeline on 100000 rows: {difference:.2e}")
+        if difference > args.tolerance:
+            raise SystemExit(f"Parity check failed (tolerance {args.tolerance:.0e})")
+
+        fast = get_fast_path(pipeline)
+        print(f"{'rows':>8}  {'pipeline':>12}  {'xgboost':>12}  {'numpy':>12}")
+        for n in (1, 100, 10_000, 100_000, 1_000_000):
+            if n > args.max_rows:
+                break
+            repeats = max(1, min(args.repeats, 200_000 // n))
+            rows = frame.iloc[:n]
+            pipeline_seconds = _latency(pipeline.predict, rows, repeats)
+            xgboost_seconds = _latency(lambda rows: fast.predict(fast.transform(rows)), rows, repeats)
+            numpy_seconds = _latency(lambda rows: ensemble.predict(ensemble.transform(rows)), rows, repeats)
+            print(f"{n:>8}  {pipeline_seconds * 1e3:10.3f}ms  {xgboost_seconds * 1e3:10.3f}ms  {numpy_seconds * 1e3:10.3f}ms")
+
+
+if __name__ == '__main__':
+    main()
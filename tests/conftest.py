@@ -0,0 +1,11 @@
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def repository_root(monkeypatch):
+    # Model and data paths are relative to the repository root, as in the app
+    monkeypatch.chdir(ROOT)
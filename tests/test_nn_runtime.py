@@ -0,0 +1,44 @@
+import datetime
+
+import numpy as np
+import pytest
+
+from nn_runtime import DenseNetwork
+
+pytest.importorskip('tensorflow')
+
+
+def _itineraries(n: int = 500) -> np.ndarray:
+    from fare_intervals import CABINS
+    from predict_withhops import build_neural_network_input
+
+    rng = np.random.default_rng(0)
+    airports = ['ATL', 'BOS', 'LAX', 'JFK', 'ORD', 'DFW', 'DEN', 'SFO']
+    pairs = [(origin, dest) for origin in airports for dest in airports if origin != dest]
+    routes = [pairs[i] for i in rng.integers(0, len(pairs), size=n)]
+    search_date = datetime.date(2026, 1, 1)
+    n_hops = rng.integers(1, 5, size=n)
+    return build_neural_network_input(
+        origins=[origin for origin, _ in routes],
+        dests=[dest for _, dest in routes],
+        search_dates=[search_date] * n,
+        depart_dates=[search_date + datetime.timedelta(days=int(days)) for days in rng.integers(1, 365, size=n)],
+        depart_times=[datetime.time(int(hour), int(minute)) for hour, minute in zip(rng.integers(0, 24, size=n),
+                                                                                    rng.integers(0, 60, size=n))],
+        is_basic_econ=rng.random(n) < 0.2,
+        n_hops=n_hops,
+        cabins=[list(rng.choice(CABINS, size=hops)) for hops in n_hops])
+
+
+def test_dense_network_matches_keras(tmp_path):
+    from model_registry import registry
+    from predict_withhops import MODEL_NAME
+
+    model = registry.get(MODEL_NAME)
+    X = _itineraries()
+    path = tmp_path / 'network.npz'
+    DenseNetwork.from_keras(model).save(str(path))
+    network = DenseNetwork.load(str(path))
+
+    expected = model.predict(X, verbose=0)
+    np.testing.assert_allclose(network.predict(X), expected, rtol=1e-4, atol=1e-2)
@@ -0,0 +1,43 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip('tornado')
+
+from tornado.testing import AsyncHTTPTestCase
+
+from service import make_app
+
+
+class ServiceErrorsTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.executor = ThreadPoolExecutor(1)
+        return make_app(self.executor)
+
+    def tearDown(self):
+        super().tearDown()
+        self.executor.shutdown()
+
+    def assert_error(self, response, code, message):
+        assert response.code == code
+        assert response.reason == {400: 'Bad Request', 503: 'Service Unavailable'}[code]
+        assert response.headers['Content-Type'].startswith('application/json')
+        assert json.loads(response.body) == {'error': message}
+
+    def predict(self, payload):
+        return self.fetch('/predict/one-way', method='POST', body=json.dumps(payload))
+
+    def test_invalid_body(self):
+        self.assert_error(self.predict([1, 2]), 400, "Request body must be a JSON object")
+        self.assert_error(self.predict({'items': 'x'}), 400, "'items' must be a list")
+
+    def test_invalid_item(self):
+        item = {'date': '2024-06-01', 'time': '10:00', 'origin': 'ZZZ', 'destination': 'BOS', 'cabin': 'coach'}
+        self.assert_error(self.predict(item), 400, "Invalid request: ValueError('Unknown airport code: ZZZ')")
+        del item['origin']
+        self.assert_error(self.predict(item), 400, "Invalid request: KeyError('origin')")
+
+    def test_invalid_airport_query(self):
+        self.assert_error(self.fetch('/airports?origin=ZZZ'), 400, "Unknown airport code: ZZZ")
+        self.assert_error(self.fetch('/airports?limit=many'), 400, "'limit' must be an integer")
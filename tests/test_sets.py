@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+pq = pytest.importorskip('pyarrow.parquet')
+
+from models.sets import (ParquetSet, SetWriter, iter_pairs, load_sets, open_sets, save_sets,
+                         split_parquet_by_time, split_sets_by_time)
+
+N_ROWS = 1_000
+FILTERS = [('startingAirport', '==', 'ATL'), ('departure_month', '>', 6)]
+
+
+@pytest.fixture
+def sets():
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame({
+        'startingAirport': rng.choice(['ATL', 'BOS', 'LAX'], N_ROWS),
+        'departure_month': rng.integers(1, 13, N_ROWS),
+        'distance': rng.random(N_ROWS),
+        # Row number, to check which target every feature row was paired with
+        'row': np.arange(N_ROWS),
+    })
+    y = pd.Series(rng.random(N_ROWS) * 500, name='target')
+    return X, y
+
+
+def _write(frame, path, row_group_size):
+    pq.write_table(pa.Table.from_pandas(frame, preserve_index=False), path, row_group_size=row_group_size)
+
+
+def test_iter_pairs_aligns_different_row_groups(sets, tmp_path):
+    X, y = sets
+    _write(X, tmp_path / 'X.parquet', 70)
+    _write(y.to_frame(), tmp_path / 'y.parquet', 110)
+    X_set, y_set = ParquetSet(str(tmp_path / 'X.parquet')), ParquetSet(str(tmp_path / 'y.parquet'))
+
+    for filters in (None, FILTERS):
+        pairs = list(iter_pairs(X_set, y_set, filters=filters, batch_size=30, arrow=False))
+        assert all(len(X_chunk) <= 30 for X_chunk, _ in pairs)
+        rows = np.concatenate([X_chunk['row'].to_numpy() for X_chunk, _ in pairs])
+        targets = np.concatenate([y_chunk.to_numpy() for _, y_chunk in pairs])
+        expected = np.arange(N_ROWS) if filters is None else X.index[
+            (X['startingAirport'] == 'ATL') & (X['departure_month'] > 6)].to_numpy()
+        np.testing.assert_array_equal(rows, expected)
+        np.testing.assert_array_equal(targets, y.to_numpy()[rows])
+
+
+def test_filter_matching_nothing(sets, tmp_path):
+    X, y = sets
+    path = f'{tmp_path}/'
+    save_sets(X, y, path=path)
+    filters = [('departure_month', '>', 12)]
+
+    X_train, y_train, *_ = open_sets(path)
+    assert X_train.matching_row_groups(filters) == []
+    assert list(iter_pairs(X_train, y_train, filters=filters)) == []
+
+    X_train, y_train, X_val, y_val, X_test, y_test = load_sets(path, columns=['distance'], filters=filters)
+    assert X_train.columns.tolist() == ['distance'] and len(X_train) == 0
+    assert y_train.name == 'target' and len(y_train) == 0
+    assert X_val is None and y_val is None and X_test is None and y_test is None
+
+
+@pytest.mark.parametrize('layout', ['save_sets', 'SetWriter'])
+def test_load_sets_filters_match_pandas(layout, sets, tmp_path):
+    X, y = sets
+    path = f'{tmp_path}/'
+    if layout == 'save_sets':
+        save_sets(X, y, X.iloc[:100], y.iloc[:100], path=path)
+    else:
+        with SetWriter(path) as writer:
+            for start in range(0, N_ROWS, 150):
+                writer.write('train', X.iloc[start:start + 150], y.iloc[start:start + 150])
+            writer.write('val', X.iloc[:100], y.iloc[:100])
+
+    X_train, y_train, X_val, y_val, _, _ = load_sets(path)
+    pd.testing.assert_frame_equal(X_train, X)
+    pd.testing.assert_series_equal(y_train, y)
+
+    X_train, y_train, X_val, y_val, _, _ = load_sets(path, columns=['distance', 'row'], filters=FILTERS)
+    for X_loaded, y_loaded, X_expected, y_expected in ((X_train, y_train, X, y),
+                                                       (X_val, y_val, X.iloc[:100], y.iloc[:100])):
+        mask = (X_expected['startingAirport'] == 'ATL') & (X_expected['departure_month'] > 6)
+        pd.testing.assert_frame_equal(X_loaded, X_expected.loc[mask, ['distance', 'row']].reset_index(drop=True))
+        pd.testing.assert_series_equal(y_loaded, y_expected[mask].reset_index(drop=True))
+
+
+def test_set_writer_casts_later_chunks(sets, tmp_path):
+    X, y = sets
+    with SetWriter(f'{tmp_path}/') as writer:
+        writer.write('train', X.iloc[:500], y.iloc[:500])
+        writer.write('train', X.iloc[500:].astype({'departure_month': np.int32}), y.iloc[500:].astype(np.float32))
+
+    X_train, y_train, *_ = open_sets(f'{tmp_path}/')
+    assert X_train.row_groups == [0, 1]
+    pd.testing.assert_frame_equal(X_train.to_pandas(arrow=False), X)
+    np.testing.assert_allclose(y_train.to_series(arrow=False).to_numpy(), y.to_numpy(), rtol=1e-6)
+
+
+def test_split_parquet_by_time_matches_split_sets_by_time(sets, tmp_path):
+    X, y = sets
+    frame = X.assign(price=y)
+    # Row groups of 100 rows put the cut-offs (at 600 and 800) on group boundaries
+    _write(frame, tmp_path / 'flights.parquet', 100)
+
+    lazy = split_parquet_by_time(str(tmp_path / 'flights.parquet'), 'price')
+    eager = split_sets_by_time(frame, 'price')
+    for X_lazy, y_lazy, X_eager, y_eager in zip(lazy[::2], lazy[1::2], eager[::2], eager[1::2]):
+        pd.testing.assert_frame_equal(X_lazy.to_pandas(arrow=False), X_eager.reset_index(drop=True))
+        pd.testing.assert_series_equal(y_lazy.to_series(arrow=False), y_eager.reset_index(drop=True))
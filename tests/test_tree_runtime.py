@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+from tree_runtime import TreeEnsemble
+
+pytest.importorskip('xgboost')
+
+
+@pytest.mark.parametrize('module_name', ['predict_nohops', 'predict_nohops_return'])
+def test_tree_ensemble_matches_pipeline(module_name, tmp_path):
+    import importlib
+
+    from benchmark import make_requests
+    from model_registry import registry
+
+    module = importlib.import_module(module_name)
+    if registry.file_version(module.MODEL_NAME) is None:
+        pytest.skip(f"{module.MODEL_NAME} not found")
+    build_frame = getattr(module, 'build_nohops_input_frame', None) or module.build_nohops_return_input_frame
+    pipeline = registry.get(module.MODEL_NAME)
+
+    path = tmp_path / 'trees.npz'
+    TreeEnsemble.from_pipeline(pipeline).save(str(path))
+    ensemble = TreeEnsemble.load(str(path))
+    # The one-hot encoders were folded into equality splits on category codes
+    assert (ensemble.low > -np.inf).any()
+
+    requests = make_requests(20_000)
+    frame = build_frame(requests['dates'], requests['times'], requests['origins'], requests['dests'], requests['cabins'])
+    # Unknown categories fall on the same side as in the ignored one-hot columns
+    frame.iloc[::97, frame.columns.get_loc('cabin_type')] = 'unknown cabin'
+    frame.iloc[::89, frame.columns.get_loc('startingAirport')] = 'ZZZ'
+    frame.iloc[::83, frame.columns.get_loc('destinationAirport')] = 'ZZZ'
+
+    expected = np.asarray(pipeline.predict(frame), dtype=np.float64)
+    np.testing.assert_allclose(ensemble.predict(ensemble.transform(frame)), expected, rtol=1e-5, atol=1e-2)